@@ -1,6 +1,8 @@
 import React, { useState } from 'react';
 import './styles/App.css';
 import Home from './pages/Home';
+import DocumentExport from './pages/DocumentExport';
+import DocumentUpload from './pages/DocumentUpload';
 import PdfViewer from 'components/PDFViewer';
 import { Routes, Route } from 'react-router-dom';
 
@@ -9,6 +11,8 @@ function App() {
     <Routes>
       <Route path="/" element={<Home />} />
       <Route path="/viewer/:fileName" element={<PdfViewer />} />
+      <Route path="/export" element={<DocumentExport />} />
+      <Route path="/upload" element={<DocumentUpload />} />
     </Routes>
   );
 }
@@ -3,12 +3,19 @@ import { defaultLayoutPlugin } from '@react-pdf-viewer/default-layout';
 import '@react-pdf-viewer/core/lib/styles/index.css';
 import '@react-pdf-viewer/default-layout/lib/styles/index.css';
 
-import { useNavigate } from 'react-router-dom';
+import { useNavigate, useParams, useSearchParams } from 'react-router-dom';
 
+// /viewer/:fileName?page=N opens a cited document at a page. The backend serves it with range
+// requests, so only the pages being looked at are downloaded
 const PdfViewer = () => {
   const navigate = useNavigate();
+  const { fileName } = useParams();
+  const [searchParams] = useSearchParams();
   const defaultLayoutPluginInstance = defaultLayoutPlugin();
 
+  const documentId = (fileName || '').replace(/\.pdf$/i, '');
+  const initialPage = Math.max(Number(searchParams.get('page') || 1) - 1, 0);
+
   return (
     <div style={{ height: '100vh', display: 'flex', flexDirection: 'column' }}>
       {/* Back Button */}
@@ -31,7 +38,8 @@ const PdfViewer = () => {
       <div style={{ flex: 1, height: 0 }}>
         <Worker workerUrl="https://unpkg.com/pdfjs-dist@3.11.174/build/pdf.worker.min.js">
           <Viewer
-            fileUrl="/me.pdf"
+            fileUrl={`http://localhost:8000/documents/${encodeURIComponent(documentId)}/pdf`}
+            initialPage={initialPage}
             plugins={[defaultLayoutPluginInstance]}
           />
         </Worker>
@@ -1,4 +1,4 @@
-import React, { useState } from "react";
+import React, { useEffect, useState } from "react";
 import '../styles/Sidebar.css'
 import {MenuOutlined, EditOutlined, MoreOutlined} from "@ant-design/icons";
 import { Dropdown, Menu } from "antd";
@@ -8,14 +8,56 @@ interface SidebarProps {
   toggleSidebar: () => void;
   newChat: () => void;
   loadMessages: (conversationId: string) => void;
-  conversationHistory: Array<{ id: string; title: string; timestamp: string }>;
+  conversationHistory: Array<{ id: string; title: string; timestamp: string; last_activity?: string; last_message?: string | null }>;
   activeConversationId: string | null;
   onRenameConversation: (id: string, newTitle: string) => void;
   onDeleteConversation: (id: string) => void;
+  userId: string;
 }
 
-const Sidebar: React.FC<SidebarProps> = ({ isOpen, toggleSidebar, newChat, loadMessages, conversationHistory, activeConversationId, onRenameConversation, onDeleteConversation }) => {
+interface SearchResult {
+  message_id: string;
+  conversation_id: string;
+  conversation_title: string | null;
+  sender: string;
+  timestamp: string;
+  snippet: string;
+}
+
+// Snippets mark the matched terms with <mark></mark> around plain text, render them as elements
+// instead of as HTML so the message text stays escaped
+const renderSnippet = (snippet: string) =>
+  snippet.split(/(<mark>.*?<\/mark>)/g).map((part, i) =>
+    part.startsWith('<mark>') ? <mark key={i}>{part.slice(6, -7)}</mark> : <React.Fragment key={i}>{part}</React.Fragment>
+  );
+
+const Sidebar: React.FC<SidebarProps> = ({ isOpen, toggleSidebar, newChat, loadMessages, conversationHistory, activeConversationId, onRenameConversation, onDeleteConversation, userId }) => {
   const [hoveredId, setHoveredId] = useState<string | null>(null);
+  const [searchQuery, setSearchQuery] = useState('');
+  const [searchResults, setSearchResults] = useState<SearchResult[]>([]);
+
+  // Search once typing pauses, a newer query aborts the request of the previous one
+  useEffect(() => {
+    const q = searchQuery.trim();
+    if (!q) {
+      setSearchResults([]);
+      return;
+    }
+    const controller = new AbortController();
+    const timer = setTimeout(async () => {
+      try {
+        const params = new URLSearchParams({ user_id: userId, q });
+        const res = await fetch(`http://localhost:8000/messages/search?${params}`, { signal: controller.signal });
+        if (res.ok) setSearchResults(await res.json());
+      } catch (err) {
+        if (err.name !== 'AbortError') console.error('Error searching messages:', err);
+      }
+    }, 250);
+    return () => {
+      clearTimeout(timer);
+      controller.abort();
+    };
+  }, [searchQuery, userId]);
 
   const getMenuItems = (id: string, title: string) => ({
     items: [
@@ -48,6 +90,30 @@ const Sidebar: React.FC<SidebarProps> = ({ isOpen, toggleSidebar, newChat, loadM
             <EditOutlined className="sidebar-icon" onClick={newChat}/>
         </div>
         <div className={`sidebar-content ${isOpen ? "" : "hidden"}`}>
+          <input
+            className='sidebar-search'
+            placeholder='Search chats'
+            value={searchQuery}
+            onChange={e => setSearchQuery(e.target.value)}
+          />
+          {searchQuery.trim() ? (
+          <div className='past-chats'>
+            <span className='time-title'>Results</span>
+            {searchResults.map(result => (
+              <div
+                key={result.message_id}
+                className={`chat-title ${activeConversationId === result.conversation_id ? 'active' : ''}`}
+                onClick={() => loadMessages(result.conversation_id)}
+              >
+                <div>
+                  <span>{result.conversation_title}</span>
+                  <span className='chat-time'>{new Date(result.timestamp).toLocaleDateString()}</span>
+                  <div className='search-snippet'>{renderSnippet(result.snippet)}</div>
+                </div>
+              </div>
+            ))}
+          </div>
+          ) : (
           <div className='past-chats'>
             <span className='time-title'>Recent</span>
             {conversationHistory.map(convo => (
@@ -60,9 +126,10 @@ const Sidebar: React.FC<SidebarProps> = ({ isOpen, toggleSidebar, newChat, loadM
                 key={convo.id}
                 // className={`chat-title ${activeConversationId === convo.id ? 'active' : ''}`}
                 onClick={() => loadMessages(convo.id)}
+                title={convo.last_message ?? undefined}
               >
                 <span>{convo.title}</span>
-                <span className='chat-time'>{new Date(convo.timestamp).toLocaleDateString()}</span>
+                <span className='chat-time'>{new Date(convo.last_activity ?? convo.timestamp).toLocaleDateString()}</span>
               </div>
               {hoveredId === convo.id && (
                   <Dropdown menu={getMenuItems(convo.id, convo.title)} trigger={['click']}>
@@ -72,6 +139,7 @@ const Sidebar: React.FC<SidebarProps> = ({ isOpen, toggleSidebar, newChat, loadM
               </div>
             ))}
           </div>
+          )}
         </div>
     </div>
     // <div className={`fixed top-0 left-0 h-full bg-gray-800 text-white w-64 transition-transform ${isOpen ? "translate-x-0" : "-translate-x-64"} duration-300`}>
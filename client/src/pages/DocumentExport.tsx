@@ -0,0 +1,43 @@
+import React, { useState } from 'react';
+import '../styles/App.css';
+
+const USER_ID = '15';
+
+// Downloads are streamed by the backend, the browser saves them as they arrive
+function DocumentExport() {
+  const [format, setFormat] = useState('markdown');
+  const [since, setSince] = useState('');
+  const [until, setUntil] = useState('');
+
+  const exportUrl = () => {
+    const params = new URLSearchParams({ user_id: USER_ID, format });
+    if (since) params.append('since', new Date(since).toISOString());
+    if (until) params.append('until', new Date(until).toISOString());
+    return `http://localhost:8000/export?${params.toString()}`;
+  };
+
+  return (
+    <div className='document-export'>
+      <h2>Export conversations</h2>
+      <label>
+        Format
+        <select value={format} onChange={e => setFormat(e.target.value)}>
+          <option value='markdown'>Markdown</option>
+          <option value='csv'>CSV</option>
+          <option value='ndjson'>NDJSON</option>
+        </select>
+      </label>
+      <label>
+        From
+        <input type='date' value={since} onChange={e => setSince(e.target.value)} />
+      </label>
+      <label>
+        To
+        <input type='date' value={until} onChange={e => setUntil(e.target.value)} />
+      </label>
+      <a href={exportUrl()} download>Download</a>
+    </div>
+  );
+}
+
+export default DocumentExport;
@@ -0,0 +1,61 @@
+import React, { useState } from 'react';
+import '../styles/App.css';
+
+const USER_ID = '15';
+
+// Uploads a filing, then follows its ingestion job until the document can be queried
+function DocumentUpload() {
+  const [file, setFile] = useState<File | null>(null);
+  const [title, setTitle] = useState('');
+  const [proceedingId, setProceedingId] = useState('');
+  const [status, setStatus] = useState('');
+
+  const handleUpload = async () => {
+    if (!file) return;
+
+    const form = new FormData();
+    form.append('file', file);
+    form.append('title', title || file.name);
+    form.append('proceeding_id', proceedingId);
+    form.append('user_id', USER_ID);
+
+    try {
+      setStatus('Uploading...');
+      const resp = await fetch('http://localhost:8000/documents', { method: 'POST', body: form });
+      const job = await resp.json();
+      if (!resp.ok) throw new Error(job.detail);
+
+      const events = new EventSource(`http://localhost:8000/jobs/${job.id}/events`);
+      events.addEventListener('progress', (e: MessageEvent) => {
+        const state = JSON.parse(e.data);
+        setStatus(state.progress_total
+          ? `${state.stage}: ${state.progress_done}/${state.progress_total} chunks`
+          : state.stage || state.status);
+      });
+      events.addEventListener('done', () => {
+        setStatus('Ready, the document can now be queried.');
+        events.close();
+      });
+      events.addEventListener('error', (e: MessageEvent) => {
+        setStatus(e.data ? `Ingestion failed: ${JSON.parse(e.data).error}` : 'Lost connection to the server.');
+        events.close();
+      });
+    } catch (err) {
+      console.error('Error uploading document:', err);
+      setStatus(`Upload failed: ${err.message}`);
+    }
+  };
+
+  return (
+    <div className='document-upload'>
+      <h2>Upload a filing</h2>
+      <input type='file' accept='application/pdf' onChange={e => setFile(e.target.files?.[0] ?? null)} />
+      <input placeholder='Title' value={title} onChange={e => setTitle(e.target.value)} />
+      <input placeholder='Proceeding ID' value={proceedingId} onChange={e => setProceedingId(e.target.value)} />
+      <button onClick={handleUpload} disabled={!file}>Upload</button>
+      {status && <p>{status}</p>}
+    </div>
+  );
+}
+
+export default DocumentUpload;
@@ -7,6 +7,52 @@ import { marked } from 'marked';
 
 const USER_ID = '15';
 
+// A message that fails to send is retried with the same Idempotency-Key, the server answers a
+// retry of a request it already ran with the stored answer instead of running it again
+const MAX_SEND_ATTEMPTS = 3;
+const RETRY_DELAY_MS = 2000;
+// 409: the first request with the key is still running, 429: overloaded, try again later
+const RETRYABLE_STATUSES = new Set([409, 429]);
+
+const sleep = (ms: number) => new Promise(resolve => setTimeout(resolve, ms));
+
+const retryDelay = (resp: Response | null, attempt: number) => {
+  const retryAfter = Number(resp?.headers.get('Retry-After'));
+  return retryAfter > 0 ? retryAfter * 1000 : RETRY_DELAY_MS * attempt;
+};
+
+const formatAnswer = (text: string) => marked(text, { breaks: true, gfm: true });
+
+// Longform answers are written by a background job. Follows its events, calling onProgress with
+// each progress state, and resolves with the answer once it is done
+const waitForJob = (jobId: string, onProgress: (state) => void) => new Promise<string>((resolve, reject) => {
+  const events = new EventSource(`http://localhost:8000/jobs/${jobId}/events`);
+  events.addEventListener('progress', (e: MessageEvent) => onProgress(JSON.parse(e.data)));
+  events.addEventListener('done', async () => {
+    events.close();
+    try {
+      const resp = await fetch(`http://localhost:8000/jobs/${jobId}/result`);
+      if (!resp.ok) throw new Error(`Fetching the answer failed with status ${resp.status}`);
+      resolve((await resp.json())['message']);
+    } catch (err) {
+      reject(err);
+    }
+  });
+  events.addEventListener('error', (e) => {
+    // A failed job sends an error event with its state, a dropped connection is reopened by EventSource
+    if (e instanceof MessageEvent) {
+      events.close();
+      reject(new Error(JSON.parse(e.data).error || 'Job failed'));
+    }
+  });
+});
+
+const jobProgressText = (state) => {
+  if (!state.stage) return 'Writing a detailed answer...';
+  const count = state.progress_total ? ` (${state.progress_done}/${state.progress_total})` : '';
+  return `Writing a detailed answer: ${state.stage}${count}...`;
+};
+
 
 function Home() {
   const [isSidebarOpen, setIsSidebarOpen] = useState(false);
@@ -14,19 +60,26 @@ function Home() {
   const [messages, setMessages] = useState([]); 
   const [conversationId, setConversationId] = useState<string | null>(null);
   const [conversationHistory, setConversationHistory] = useState([]);
+  // X-Next-Cursor of the oldest page loaded, null once the start of the conversation is shown
+  const [olderCursor, setOlderCursor] = useState<string | null>(null);
+  const loadingOlderRef = useRef(false);
   const bottomRef = useRef(null);
+  // Set while a message is being sent, so a double Enter doesn't send it twice
+  const sendingRef = useRef(false);
 
   useEffect(() => {
     fetchConversations();
   }, []);
 
+  // Only a new message scrolls down, loading older ones keeps the position
   useEffect(() => {
     bottomRef.current?.scrollIntoView({ behavior: "smooth" });
-  }, [messages]);
+  }, [messages[0]]);
 
   const fetchConversations = async () => {
     try {
-      const res = await fetch(`http://localhost:8000/conversations?user_id=${USER_ID}`);
+      // Previews carry each conversation's latest message, no need to load their messages
+      const res = await fetch(`http://localhost:8000/conversations/previews?user_id=${USER_ID}`);
       if (!res.ok) throw new Error("Failed to fetch conversations");
 
       const data = await res.json();
@@ -37,33 +90,63 @@ function Home() {
   };
 
 
+  // One page of a conversation's messages, newest first, and the cursor of the page before it
+  const fetchMessagePage = async (convoId: string, cursor: string | null = null) => {
+    const params = cursor ? `?cursor=${encodeURIComponent(cursor)}` : '';
+    const res = await fetch(`http://localhost:8000/conversations/${convoId}/messages${params}`);
+    if (!res.ok) throw new Error("Failed to fetch messages");
+
+    const data = await res.json();
+    console.log(data);
+
+    const formattedMessages = data.map(msg => ({
+      text: msg.sender === 'user'
+        ? msg.message
+        : marked(msg.message, {
+        breaks: true,
+        gfm: true
+      }),
+      isUser: msg.sender === 'user',
+      files: msg.files || []
+    }))
+      .reverse();
+
+    return { messages: formattedMessages, nextCursor: res.headers.get('X-Next-Cursor') };
+  };
+
   const loadMessages = async (convoId: string) => {
     try {
-      const res = await fetch(`http://localhost:8000/conversations/${convoId}/messages`);
-      if (!res.ok) throw new Error("Failed to fetch messages");
-  
-      const data = await res.json();
-      console.log(data);
-  
-      const formattedMessages = data.map(msg => ({
-        text: msg.sender === 'user'
-          ? msg.message
-          : marked(msg.message, {
-          breaks: true,
-          gfm: true
-        }),
-        isUser: msg.sender === 'user',
-        files: msg.files || []
-      }))
-        .reverse();
-  
+      const page = await fetchMessagePage(convoId);
       setConversationId(convoId);
-      setMessages(formattedMessages);
+      setMessages(page.messages);
+      setOlderCursor(page.nextCursor);
     } catch (err) {
       console.error("Error loading messages:", err);
     }
   };
 
+  const loadOlderMessages = async () => {
+    if (!conversationId || !olderCursor || loadingOlderRef.current) return;
+    loadingOlderRef.current = true;
+    try {
+      const page = await fetchMessagePage(conversationId, olderCursor);
+      setMessages(prevMessages => [...prevMessages, ...page.messages]);
+      setOlderCursor(page.nextCursor);
+    } catch (err) {
+      console.error("Error loading earlier messages:", err);
+    } finally {
+      loadingOlderRef.current = false;
+    }
+  };
+
+  // The chat column is reversed, scrollTop goes negative towards the oldest messages
+  const handleChatScroll = (e) => {
+    const chat = e.currentTarget;
+    if (Math.abs(chat.scrollTop) + chat.clientHeight >= chat.scrollHeight - 50) {
+      loadOlderMessages();
+    }
+  };
+
   const toggleSidebar = () => {
     setIsSidebarOpen(!isSidebarOpen);
     console.log(isSidebarOpen ? "OPEN" : "CLOSE");
@@ -92,6 +175,7 @@ function Home() {
       const data = await res.json();
       setConversationId(data.id);
       setMessages([]);
+      setOlderCursor(null);
       fetchConversations();
       return data.id;
     } catch (err) {
@@ -113,48 +197,121 @@ function Home() {
   textarea.style.height = `${newHeight}px`;
   }
 
-  const handleSendMessage = async () => {
-    if (!query.trim()) return;
+  // POST a pending message, retrying network errors, 409, 429 and 5xx with its Idempotency-Key
+  const postMessage = async (pending) => {
+    let lastError = null;
+    for (let attempt = 1; attempt <= MAX_SEND_ATTEMPTS; attempt++) {
+      let resp: Response | null = null;
+      try {
+        resp = await fetch(`http://localhost:8000/conversations/${pending.conversationId}/messages`, {
+          method: 'POST',
+          headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': pending.idempotencyKey
+          },
+          body: JSON.stringify({
+            sender: "user",
+            message: pending.text,
+            timestamp: pending.timestamp
+          })
+        });
+      } catch (err) {
+        // The request may or may not have reached the server, the key makes resending safe
+        lastError = err;
+      }
 
-    setMessages([{ text: query, isUser: true }, ...messages]);
-    let id = conversationId;
-    if (!id) {
-      id = await createNewChat();
-      if (!id) return;
-      setConversationId(id);
+      if (resp?.ok) return resp.json();
+      if (resp) {
+        lastError = new Error(`Sending failed with status ${resp.status}`);
+        if (!RETRYABLE_STATUSES.has(resp.status) && resp.status < 500) throw lastError;
+      }
+      if (attempt < MAX_SEND_ATTEMPTS) await sleep(retryDelay(resp, attempt));
     }
+    throw lastError;
+  };
+
+  const setMessageStatus = (idempotencyKey: string, status: string) => {
+    setMessages(prevMessages => prevMessages.map(msg =>
+      msg.idempotencyKey === idempotencyKey ? { ...msg, status } : msg
+    ));
+  };
 
+  const sendPendingMessage = async (pending) => {
+    sendingRef.current = true;
+    setMessageStatus(pending.idempotencyKey, 'sending');
     try {
-      setQuery('');
-      const resp = await fetch(`http://localhost:8000/conversations/${conversationId}/messages`, {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-          sender: "user",
-          message: query,
-          timestamp: new Date().toISOString()
-        })
-      });
-      
       // Get AI Message Response
-      const data = await resp.json();
+      const data = await postMessage(pending);
       console.log(data);
+      setMessageStatus(pending.idempotencyKey, 'sent');
 
-      const formattedMessage = marked(data['data']['message'], {
-        breaks: true,
-        gfm: true
-      });
+      const jobId = data['data']['job_id'];
+      if (jobId) {
+        followJob(jobId);
+        return;
+      }
 
-      const aiMessage = { text: formattedMessage, files: ['/me.pdf'], isUser: false };
+      const aiMessage = { text: formatAnswer(data['data']['message']), files: ['/me.pdf'], isUser: false };
       console.log(aiMessage);
       setMessages(prevMessages => [aiMessage, ...prevMessages]);
-      
-
     } catch (err) {
       console.error("Error saving user message:", err);
+      setMessageStatus(pending.idempotencyKey, 'failed');
+    } finally {
+      sendingRef.current = false;
+    }
+  };
+
+  const setJobMessage = (jobId: string, text: string) => {
+    setMessages(prevMessages => prevMessages.map(msg => msg.jobId === jobId ? { ...msg, text } : msg));
+  };
+
+  // Shows a placeholder for a longform answer and fills it in when the job finishes. The send
+  // is already over, other questions can be asked while the essay is written
+  const followJob = async (jobId: string) => {
+    setMessages(prevMessages => [{ text: jobProgressText({}), files: ['/me.pdf'], isUser: false, jobId }, ...prevMessages]);
+    try {
+      const answer = await waitForJob(jobId, state => setJobMessage(jobId, jobProgressText(state)));
+      setJobMessage(jobId, formatAnswer(answer));
+    } catch (err) {
+      console.error("Error writing longform answer:", err);
+      setJobMessage(jobId, 'I apologize, but I encountered an error writing this answer. Please try again.');
     }
   };
 
+  const handleSendMessage = async () => {
+    if (!query.trim() || sendingRef.current) return;
+    sendingRef.current = true;
+
+    let id = conversationId;
+    if (!id) {
+      id = await createNewChat();
+      if (!id) {
+        sendingRef.current = false;
+        return;
+      }
+      setConversationId(id);
+    }
+
+    // The key is made once per message and kept with it, every retry of this message reuses it
+    const pending = {
+      text: query,
+      isUser: true,
+      conversationId: id,
+      idempotencyKey: crypto.randomUUID(),
+      timestamp: new Date().toISOString(),
+      status: 'sending'
+    };
+    setMessages(prevMessages => [pending, ...prevMessages]);
+    setQuery('');
+    await sendPendingMessage(pending);
+  };
+
+  const retryMessage = (pending) => {
+    if (sendingRef.current) return;
+    sendPendingMessage(pending);
+  };
+
   const handleRenameConversation = async (id: string, newTitle: string) => {
     try {
       await fetch(`http://localhost:8000/conversations/${id}`, {
@@ -179,6 +336,7 @@ function Home() {
       if (id === conversationId) {
         setConversationId(null);
         setMessages([]);
+        setOlderCursor(null);
       }
     } catch (err) {
       console.error("Error deleting conversation:", err);
@@ -196,16 +354,31 @@ function Home() {
         loadMessages={loadMessages}
         conversationHistory={conversationHistory}
         activeConversationId={conversationId}
+        userId={USER_ID}
         onRenameConversation={handleRenameConversation}
         onDeleteConversation={handleDeleteConversation}
       />
       <div className="Home-content">
-        <div className="chat-content">
+        <div className="chat-content" onScroll={handleChatScroll}>
           {messages.map((message, index) => (
-            <MessageBox key={index} isUserMessage={message.isUser} files={message.files}>
-              {message.text}
-            </MessageBox>
+            <React.Fragment key={message.idempotencyKey || message.jobId || index}>
+              {/* Listed before the message, the column is reversed so it shows under it */}
+              {message.status === 'failed' && (
+                <button className="retry-button" onClick={() => retryMessage(message)}>
+                  Not sent, retry
+                </button>
+              )}
+              <MessageBox isUserMessage={message.isUser} files={message.files}>
+                {message.text}
+              </MessageBox>
+            </React.Fragment>
           ))}
+          {/* Last in the reversed column, so it sits above the oldest message */}
+          {olderCursor && (
+            <button className="load-earlier-button" onClick={loadOlderMessages}>
+              Load earlier messages
+            </button>
+          )}
         </div>
         <div ref={bottomRef}></div>
         <textarea
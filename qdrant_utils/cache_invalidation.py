@@ -0,0 +1,25 @@
+import json
+import os
+import urllib.request
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path="../.env")
+GRC_API_URL = os.getenv('GRC_API_URL') # e.g. http://localhost:8000
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN')
+
+# Tells the GRCResponder API that a collection changed so cached answers built on the old documents are dropped
+def notify_collection_changed(collection_name: str):
+    if not GRC_API_URL:
+        print("GRC_API_URL not set, skipping answer cache invalidation.")
+        return
+    if not ADMIN_TOKEN:
+        print("ADMIN_TOKEN not set, the API refuses admin requests, skipping answer cache invalidation.")
+        return
+
+    url = f"{GRC_API_URL.rstrip('/')}/admin/cache/invalidate?collection={collection_name}"
+    request = urllib.request.Request(url, method='POST', headers={'X-Admin-Token': ADMIN_TOKEN or ''})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            print(f"Answer cache invalidated: {json.loads(response.read())}")
+    except Exception as e:
+        print(f"Failed to invalidate answer cache for {collection_name}: {e}")
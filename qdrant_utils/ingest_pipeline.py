@@ -0,0 +1,102 @@
+# The extract -> chunk -> point steps of document ingestion, shared by the offline
+# script (multithreaded_insert.py) and the API's upload ingestion
+# (server/backend/ingestion.py). Nothing here loads a model or opens a client, so
+# importing it is cheap and the callers bring their own embedding model and Qdrant client.
+
+import uuid
+from io import BytesIO
+
+import fitz
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from qdrant_client.http.models import PointStruct
+
+# Arguments for embedding
+CHUNK_SIZE = 1024
+CHUNK_OVERLAP = 50
+
+PAYLOAD_FIELDS = ['chunk_index', 'document_id', 'proceeding_id', 'source_url', 'published_date', 'year', 'title', 'doc_type', 'text']
+
+
+def extract_pdf_text(pdf_bytes: bytes = None, path: str = None) -> str:
+    # Pass the bytes, or a path so the file is read by fitz without loading it whole first
+    pdf = fitz.open(path) if path else fitz.open(stream=BytesIO(pdf_bytes), filetype='pdf')
+    pdf_text = ''
+
+    for page in pdf:
+        pdf_text += page.get_text('text')
+        pdf_text += '\n\n'
+
+    pdf.close()
+    return pdf_text
+
+
+def split_chunks(pdf_text: str, doc_args: dict) -> list:
+    # use overlap to create chunks
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP
+    )
+
+    chunks = []
+    for i, chunk in enumerate(text_splitter.split_text(pdf_text)):
+        # if empty skip, the index still counts it so point ids stay stable
+        if not chunk.strip():
+            continue
+        chunks.append({
+            **doc_args,
+            'chunk_index': i,
+            'text': chunk
+        })
+    return chunks
+
+
+def chunk_id(chunk: dict) -> str:
+    # Same id for the same chunk, re-ingesting a document overwrites its points
+    return str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{chunk['document_id']}_{chunk['chunk_index']}"))
+
+
+def chunk_payload(chunk: dict) -> dict:
+    return {field: chunk.get(field) for field in PAYLOAD_FIELDS}
+
+
+def create_qdrant_points(ids: list, embeddings: list, payloads: list):
+    points = []
+    for i, embedding in enumerate(embeddings):
+        point = PointStruct(
+            id=ids[i],
+            vector=embeddings[i].tolist(),
+            payload=payloads[i]
+        )
+        points.append(point)
+    return points
+
+
+def getDocArgs(doc):
+
+    doc_type = doc.get('doc_type', None)
+
+    # we need to clean the doc_type to remove things like "E-filed"
+    if doc_type and doc_type.startswith('E-Filed: '):
+        doc_type = doc_type[9::]
+
+    # Also we want to store the year to help with range searching rather than a string
+    year = 0
+    if 'filing_date' in doc and doc['filing_date'] and len(str(doc['filing_date'])) >= 4:
+        try:
+            year_str = str(doc['filing_date'])[-4:]
+            year = int(year_str)
+        except ValueError:
+            print(f"Could not parse year from filing_date: {doc['filing_date']}")
+            year = 0
+
+    doc_args = {
+        'document_id': doc['document_id'],
+        'proceeding_id': doc['proceeding_id'],
+        'source_url': doc['source_url'],
+        'published_date': doc['published_date'],
+        'year': year,
+        'title': doc['title'],
+        'doc_type': doc_type
+    }
+
+    return doc_args
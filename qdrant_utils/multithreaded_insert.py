@@ -1,20 +1,18 @@
 import json
 import os
-import uuid
 import threading
 from queue import Queue, Empty
 from sentence_transformers import SentenceTransformer
 import torch
 import threading
-import fitz
-from io import BytesIO
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from qdrant_client import QdrantClient
 from dotenv import load_dotenv
 import os
-from qdrant_client.http.models import PointStruct, VectorParams, Distance
+from qdrant_client.http.models import VectorParams, Distance
 import threading
 import time #for monitoring
+from cache_invalidation import notify_collection_changed
+from ingest_pipeline import extract_pdf_text, split_chunks, chunk_id, chunk_payload, create_qdrant_points, getDocArgs
 
 load_dotenv(dotenv_path="../.env")
 QDRANT_CONNECT = os.getenv('QDRANT_CONNECT')
@@ -24,9 +22,7 @@ LOCAL_PATH = 'D:/workspace/CPUCDocuments/' # Replace to directory with all proce
 BATCH_SIZE = 256
 QUEUE_MAXSIZE = 100
 
-# Arguments for embedding
-CHUNK_SIZE = 1024
-CHUNK_OVERLAP = 50
+# Chunking arguments (CHUNK_SIZE, CHUNK_OVERLAP) live in ingest_pipeline.py
 
 # When tested, one producer thread seemed to be sufficient, it was more bottlednecked w/ embedding creation and upload
 finished_producers_lock = threading.Lock()
@@ -104,21 +100,9 @@ def embedding_thread():
             
             print(f"Queue get time: {get_time:.2f}s, Embedding time: {embed_time:.2f}s for embedding of size {len(curr_batch)}", flush=True)
 
-            ids = [str(uuid.uuid5(uuid.NAMESPACE_DNS, f"{chunk['document_id']}_{chunk['chunk_index']}")) for chunk in current_chunks]
-
-            payloads = [
-                {
-                    'chunk_index': chunk['chunk_index'],
-                    'document_id': chunk['document_id'],
-                    'proceeding_id': chunk['proceeding_id'],
-                    'source_url': chunk['source_url'],
-                    'published_date': chunk['published_date'],
-                    'year': chunk['year'],
-                    'title': chunk['title'],
-                    'doc_type': chunk['doc_type'],
-                    'text': chunk['text']
-                } for chunk in current_chunks
-            ]
+            ids = [chunk_id(chunk) for chunk in current_chunks]
+
+            payloads = [chunk_payload(chunk) for chunk in current_chunks]
 
             # create points for qdrant
             points = create_qdrant_points(ids, embeddings, payloads)
@@ -146,18 +130,6 @@ def embedding_thread():
     embedding_queue.put(None)
     print("Finished processing all chunk embeddings", flush=True)
 
-
-def create_qdrant_points(ids:list, embeddings:list, payloads:list):
-    points = []
-    for i, embedding in enumerate(embeddings):
-        point = PointStruct(
-            id=ids[i],
-            vector=embeddings[i].tolist(),
-            payload=payloads[i]
-        )
-        points.append(point)
-    return points
-
 # ====================================================================
 
 # ================ Points uploader thread code =======================
@@ -285,36 +257,12 @@ def parseAllDocuments(proceeding_directory: str, current_chunks: list):
 
 # Takes in the bytes for pdf and adds chunks to queue in batches of BATCH_SIZE
 def addChunksToQueue(pdf_bytes: bytes, doc_args: dict, current_chunks: list):
+    global DOCUMENT_COUNT
     try:
-        pdf_file = BytesIO(pdf_bytes)
-        pdf = fitz.open(stream=pdf_file, filetype='pdf')
-        pdf_text = ''
-
-        for page in pdf:
-            pdf_text += page.get_text('text')
-            pdf_text += '\n\n'
-        
-        pdf.close()
-        
-        # use overlap to create chunks
-        text_splitter = RecursiveCharacterTextSplitter(
-                chunk_size=CHUNK_SIZE,
-                chunk_overlap=CHUNK_OVERLAP
-            )
-
-        chunks = text_splitter.split_text(pdf_text)
-
+        pdf_text = extract_pdf_text(pdf_bytes)
 
         # iterate through chunks and add them to the queue in batches of BATCH_SIZE
-        for i,chunk in enumerate(chunks):
-            # if empty skip
-            if not chunk.strip():
-                continue
-            chunk_args = {
-                **doc_args,
-                'chunk_index': i,
-                'text': chunk
-            }
+        for chunk_args in split_chunks(pdf_text, doc_args):
             current_chunks.append(chunk_args)
 
             if len(current_chunks) >= BATCH_SIZE:
@@ -327,38 +275,7 @@ def addChunksToQueue(pdf_bytes: bytes, doc_args: dict, current_chunks: list):
         print(f"Error creating chunks from PDF: {e}", flush=True)
         return
 
-    
-
-
-def getDocArgs(doc):
 
-    doc_type = doc.get('doc_type', None)
-
-    # we need to clean the doc_type to remove things like "E-filed"
-    if doc_type and doc_type.startswith('E-Filed: '):
-        doc_type = doc_type[9::]
-    
-    # Also we want to store the year to help with range searching rather than a string
-    year = 0
-    if 'filing_date' in doc and doc['filing_date'] and len(str(doc['filing_date'])) >= 4:
-        try:
-            year_str = str(doc['filing_date'])[-4:]
-            year = int(year_str)
-        except ValueError:
-            print(f"Could not parse year from filing_date: {doc['filing_date']}")
-            year = 0
-
-    doc_args = {
-        'document_id': doc['document_id'],
-        'proceeding_id': doc['proceeding_id'],
-        'source_url': doc['source_url'],
-        'published_date': doc['published_date'],
-        'year': year,
-        'title': doc['title'],
-        'doc_type': doc_type
-    }
-
-    return doc_args
 
 # ================================================================
 
@@ -406,4 +323,7 @@ if __name__ == "__main__":
     embedding_thread.join()
     upload_thread.join()    
 
+    # Cached answers were built on the old collection contents
+    notify_collection_changed(COLLECTION_NAME)
+
 
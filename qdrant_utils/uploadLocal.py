@@ -1,6 +1,7 @@
 import json
 import os
-from qdrant_utils import create_embeddings_from_pdf, create_qdrant_points, upload_to_qdrant
+from qdrant_utils import create_embeddings_from_pdf, create_qdrant_points, upload_to_qdrant, COLLECTION_NAME
+from cache_invalidation import notify_collection_changed
 import uuid
 
 # Location of local directory
@@ -70,4 +71,5 @@ if __name__ == "__main__":
     proceedings = ['A2106021', 'A2204016']
     for proceeding in proceedings:
         upload_documents(proceeding)
-        print(f"Uploaded documents for {proceeding}.")
\ No newline at end of file
+        print(f"Uploaded documents for {proceeding}.")
+    notify_collection_changed(COLLECTION_NAME)
\ No newline at end of file
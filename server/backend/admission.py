@@ -0,0 +1,249 @@
+# Server wide admission control for requests that call the llm.
+#
+# A request first has to get a token from its user's bucket and from the global bucket
+# (requests per second with some burst), then it needs one of MAX_CONCURRENT slots.
+# When no slot is free it waits in a bounded priority queue, plain answers ahead of
+# streamed ones. When the queue is full, or a bucket is empty, the request is rejected
+# straight away with the number of seconds to wait, which the API turns into a 429 with
+# a Retry-After header. A request turned away by the queue gets its tokens back.
+#
+# Background work (jobs, document ingestion) doesn't take a slot, it only pays tokens
+# with charge(). While requests are waiting for a slot it is rejected instead, so a busy
+# server spends its llm capacity on the users waiting for an answer.
+
+import asyncio
+import heapq
+import itertools
+import math
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from dotenv import load_dotenv
+
+from metrics import ADMISSION_QUEUED, ADMISSION_QUEUE_TIME, ADMISSION_REJECTED, ADMISSION_RUNNING
+
+load_dotenv(dotenv_path="../../.env")
+
+# The global limits are for the whole server. serve.py sets SERVE_WORKERS to the number of
+# worker processes and each one admits its share. The user buckets are kept per worker, a
+# user whose requests land on several workers can go up to that many times USER_RATE.
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", 1))
+GLOBAL_RATE = float(os.getenv("ADMISSION_GLOBAL_RATE", 10)) / SERVE_WORKERS # requests per second across all users
+GLOBAL_BURST = max(1, int(os.getenv("ADMISSION_GLOBAL_BURST", 30)) // SERVE_WORKERS)
+USER_RATE = float(os.getenv("ADMISSION_USER_RATE", 0.25)) # 15 requests per minute
+USER_BURST = int(os.getenv("ADMISSION_USER_BURST", 5))
+MAX_CONCURRENT = max(1, int(os.getenv("ADMISSION_MAX_CONCURRENT", 16)) // SERVE_WORKERS) # requests running the graph at once
+MAX_QUEUE = max(1, int(os.getenv("ADMISSION_MAX_QUEUE", 64)) // SERVE_WORKERS) # requests waiting for a slot
+MAX_QUEUE_WAIT = float(os.getenv("ADMISSION_MAX_QUEUE_WAIT", 30)) # seconds before a queued request gives up
+
+# Number of user buckets kept, idle users are dropped first (a dropped bucket starts full again)
+MAX_TRACKED_USERS = 10000
+
+# Priorities, lower runs first
+PRIORITY_INTERACTIVE = 0 # POST /messages, the client waits for the whole answer
+PRIORITY_STREAM = 5 # POST /messages/stream
+PRIORITY_BACKGROUND = 10 # jobs and ingestion
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Refills continuously at rate tokens per second up to capacity, O(1) per call."""
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def refund(self):
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+    def wait_time(self) -> float:
+        """Seconds until the next token is available."""
+        self._refill()
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        global_rate: float = GLOBAL_RATE,
+        global_burst: int = GLOBAL_BURST,
+        user_rate: float = USER_RATE,
+        user_burst: int = USER_BURST,
+        max_concurrent: int = MAX_CONCURRENT,
+        max_queue: int = MAX_QUEUE,
+        max_queue_wait: float = MAX_QUEUE_WAIT,
+    ):
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.user_buckets = OrderedDict()
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait
+
+        self.running = 0
+        self.queue = [] # heap of (priority, order, future)
+        self.order = itertools.count()
+
+        # Stats, queue times are in seconds
+        self.admitted = 0
+        self.rejected = {}
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+
+    def _user_bucket(self, user_id: str) -> TokenBucket:
+        bucket = self.user_buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.user_rate, self.user_burst)
+            self.user_buckets[user_id] = bucket
+            while len(self.user_buckets) > MAX_TRACKED_USERS:
+                self.user_buckets.popitem(last=False)
+        self.user_buckets.move_to_end(user_id)
+        return bucket
+
+    def _reject(self, reason: str, retry_after: float):
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        ADMISSION_REJECTED.labels(reason).inc()
+        raise AdmissionRejected(reason, max(1, math.ceil(retry_after)))
+
+    def _estimated_wait(self) -> float:
+        """Rough time until a queue slot frees up, from the average time spent queued."""
+        if not self.admitted:
+            return 1.0
+        return max(1.0, self.queue_time_total / self.admitted * (len(self.queue) / max(1, self.max_concurrent)))
+
+    def _take_tokens(self, user_id: str):
+        user_bucket = self._user_bucket(user_id)
+        if not user_bucket.try_acquire():
+            self._reject("user_rate", user_bucket.wait_time())
+        if not self.global_bucket.try_acquire():
+            user_bucket.refund()
+            self._reject("global_rate", self.global_bucket.wait_time())
+
+    def _refund_tokens(self, user_id: str):
+        """Give back the tokens of a request that never got to run."""
+        user_bucket = self.user_buckets.get(user_id)
+        if user_bucket is not None:
+            user_bucket.refund()
+        self.global_bucket.refund()
+
+    def charge(self, user_id: str, priority: int = PRIORITY_BACKGROUND):
+        """Rate limit work that doesn't run in a slot (e.g. submitting a background job)."""
+        if priority >= PRIORITY_BACKGROUND and self.queue:
+            self._reject("background_shed", self._estimated_wait())
+        self._take_tokens(user_id)
+
+    async def _acquire_slot(self, user_id: str, priority: int) -> float:
+        """Wait for a slot and return the time spent queued. The user's tokens are refunded if it gives up."""
+        start = time.monotonic()
+        if self.running < self.max_concurrent and not self.queue:
+            self.running += 1
+            return 0.0
+
+        if len(self.queue) >= self.max_queue:
+            self._refund_tokens(user_id)
+            self._reject("queue_full", self._estimated_wait())
+
+        future = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self.order), future)
+        heapq.heappush(self.queue, entry)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout=self.max_queue_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as we gave up, pass it on
+                self._release_slot()
+            else:
+                future.cancel()
+                self.queue.remove(entry)
+                heapq.heapify(self.queue)
+                self._refund_tokens(user_id)
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject("queue_timeout", self._estimated_wait())
+            raise
+        return time.monotonic() - start
+
+    def _release_slot(self):
+        # Hand the slot straight to the next waiter so running never drops below the limit
+        while self.queue:
+            _, _, future = heapq.heappop(self.queue)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    async def acquire(self, user_id: str, priority: int = PRIORITY_INTERACTIVE) -> "Admission":
+        """Take a slot, raises AdmissionRejected when overloaded. Call release() on the result when done."""
+        self._take_tokens(user_id)
+        queue_time = await self._acquire_slot(user_id, priority)
+        self.admitted += 1
+        self.queue_time_total += queue_time
+        self.queue_time_max = max(self.queue_time_max, queue_time)
+        ADMISSION_QUEUE_TIME.observe(queue_time)
+        return Admission(self, queue_time)
+
+    @asynccontextmanager
+    async def admit(self, user_id: str, priority: int = PRIORITY_INTERACTIVE):
+        """Hold a slot for the duration of the block."""
+        ticket = await self.acquire(user_id, priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def update_gauges(self):
+        ADMISSION_RUNNING.set(self.running)
+        ADMISSION_QUEUED.set(len(self.queue))
+
+    def snapshot(self):
+        return {
+            "running": self.running,
+            "queued": len(self.queue),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected),
+            "avg_queue_time": self.queue_time_total / self.admitted if self.admitted else 0.0,
+            "max_queue_time": self.queue_time_max,
+        }
+
+
+class Admission:
+    """A held slot, release() is safe to call more than once."""
+
+    def __init__(self, controller: AdmissionController, queue_time: float):
+        self.controller = controller
+        self.queue_time = queue_time
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.controller._release_slot()
+
+
+admission = AdmissionController()
@@ -1,27 +1,27 @@
-from sentence_transformers import CrossEncoder, SentenceTransformer
+from typing import List
+
 from qdrant_client import QdrantClient
-from qdrant_client.http.models import Filter
+from qdrant_client.http.models import Filter, QueryRequest, ScoredPoint
 from langchain_google_genai import ChatGoogleGenerativeAI
-import torch
-
-# Initialize the sentenceTransformer and cross-encoder models used for embedding and scoring
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+from registry import registry
+from metrics import observe_stage
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-model = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2', device=device)
+# The sentenceTransformer and cross-encoder models used for embedding and scoring are
+# loaded once by the registry (registry.embedding_model, registry.cross_encoder)
 
 
 def query_db(query: str, qdrant_client: QdrantClient, collection_name: str, k: int=5, search_filter: Filter=None):
-    query_embedding = embedding_model.encode(query).tolist()
+    with observe_stage("embed"):
+        query_embedding = registry.embedding_model.encode(query).tolist()
   
-    response = qdrant_client.query_points(
-        collection_name=collection_name,
-        query=query_embedding,
-        limit=k,
-        with_payload=True,
-        query_filter=search_filter
-    )
+    with observe_stage("qdrant_search"):
+        response = qdrant_client.query_points(
+            collection_name=collection_name,
+            query=query_embedding,
+            limit=k,
+            with_payload=True,
+            query_filter=search_filter
+        )
     return response.points
 
 
@@ -37,10 +37,11 @@ def crossEncoderQuery(query: str, qdrant_client: QdrantClient, collection_name:
         k=CROSS_ENCODER_SAMPLE
     )
 
-    scores = model.predict(
-        [(query, point.payload['text']) for point in points],
-        show_progress_bar=True
-    )
+    with observe_stage("rerank"):
+        scores = registry.cross_encoder.predict(
+            [(query, point.payload['text']) for point in points],
+            show_progress_bar=True
+        )
 
     # we will sort the points by their cross-encoder score and return the top k
     points = sorted(zip(points, scores), key=lambda x: x[1], reverse=True)
@@ -52,6 +53,66 @@ def crossEncoderQuery(query: str, qdrant_client: QdrantClient, collection_name:
     return points
 
 
+def batch_query_db(queries: List[str], qdrant_client: QdrantClient, collection_name: str, k: int=5, search_filter: Filter=None) -> List[List[ScoredPoint]]:
+    """query_db for several queries, one embedding batch and one Qdrant request for all of them."""
+    with observe_stage("embed"):
+        query_embeddings = registry.embedding_model.encode(queries)
+
+    with observe_stage("qdrant_search"):
+        responses = qdrant_client.query_batch_points(
+            collection_name=collection_name,
+            requests=[
+                QueryRequest(query=embedding.tolist(), limit=k, with_payload=True, filter=search_filter)
+                for embedding in query_embeddings
+            ]
+        )
+    return [response.points for response in responses]
+
+
+# Rank offset of reciprocal rank fusion, the usual 60 keeps a single list's top hit from outweighing
+# a point that ranks well in several lists
+RRF_K = 60
+def reciprocal_rank_fusion(rankings: List[List[ScoredPoint]], rrf_k: int=RRF_K) -> List[ScoredPoint]:
+    """Merge ranked lists of points, a point scores the sum of 1 / (rrf_k + rank) over the lists it is in."""
+    scores = {}
+    points = {}
+    for ranking in rankings:
+        for rank, point in enumerate(ranking, start=1):
+            scores[point.id] = scores.get(point.id, 0.0) + 1 / (rrf_k + rank)
+            points.setdefault(point.id, point)
+    return [points[point_id] for point_id in sorted(scores, key=scores.get, reverse=True)]
+
+
+def multiStringCrossEncoderQuery(queries: List[str], qdrant_client: QdrantClient, collection_name: str, k: int=8, search_filter: Filter=None):
+    """
+    crossEncoderQuery for several search strings of one question. Every string is searched,
+    each result list is reranked against its own string (one cross-encoder batch for all of
+    them) and the reranked lists are fused with reciprocal rank fusion.
+    """
+    rankings = batch_query_db(
+        queries=queries,
+        qdrant_client=qdrant_client,
+        collection_name=collection_name,
+        k=CROSS_ENCODER_SAMPLE,
+        search_filter=search_filter
+    )
+
+    pairs = [(query, point.payload['text']) for query, points in zip(queries, rankings) for point in points]
+    if not pairs:
+        return []
+    with observe_stage("rerank"):
+        scores = registry.cross_encoder.predict(pairs)
+
+    reranked = []
+    start = 0
+    for points in rankings:
+        point_scores = scores[start:start + len(points)]
+        start += len(points)
+        reranked.append([point for point, _ in sorted(zip(points, point_scores), key=lambda x: x[1], reverse=True)])
+
+    return reciprocal_rank_fusion(reranked)[:k]
+
+
 # Function that creates a hypotetical passage to query the LLM
 def hydeRetrieval(query: str, qdrant_client: QdrantClient, collection_name: str, llm: ChatGoogleGenerativeAI, k: int=5):
     new_query = generateHydePassage(query, llm)
@@ -100,7 +161,9 @@ def prettyPrintPoints(points):
 if __name__ == "__main__":
 
 
+    registry.load()
+
     # Example query
     query = "Explain PG&E's goal for their 2023 GRC"
     # Example cross-encoder query
-    crossEncoderQuery(query)
\ No newline at end of file
+    prettyPrintPoints(crossEncoderQuery(query, registry.qdrant_client, "GRC_Documents_Large"))
\ No newline at end of file
@@ -0,0 +1,204 @@
+# Exact match answer cache that sits in front of the graph.
+# Entries are keyed on the normalized query, the branch the classifier picked and the
+# version of the document collection. Ingestion bumps the collection version through
+# invalidate(), after which old entries are never hit again and age out of the cache.
+#
+# Because the branch is part of the key, the classification of each normalized query is
+# cached too, so a repeated question skips classification, retrieval and generation.
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+
+from metrics import ANSWER_CACHE
+
+load_dotenv(dotenv_path="../../.env")
+
+ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "memory") # memory, disk or off
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "./answer_cache.sqlite3")
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", 24 * 60 * 60)) # seconds
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 5000))
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, unify unicode forms, collapse whitespace and drop trailing punctuation."""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.rstrip("?!. ")
+
+
+def hash_query(query: str) -> str:
+    return hashlib.sha256(normalize_query(query).encode()).hexdigest()
+
+
+# ============= BACKENDS ==============================
+# A backend stores string values with a ttl and evicts the least recently used entry
+# once it holds max_entries. It also keeps the version number of each collection.
+
+class MemoryCacheBackend:
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (expires_at, value)
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def get_version(self, collection: str) -> int:
+        with self.lock:
+            return self.versions.get(collection, 0)
+
+    def bump_version(self, collection: str) -> int:
+        with self.lock:
+            self.versions[collection] = self.versions.get(collection, 0) + 1
+            return self.versions[collection]
+
+
+class DiskCacheBackend:
+    """SQLite file backend, entries and collection versions survive restarts."""
+
+    def __init__(self, path: str = ANSWER_CACHE_PATH, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_last_access ON entries (last_access)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS versions (collection TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute("SELECT value, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if row[1] < now:
+                self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self.conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now + ttl, now)
+            )
+            count = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            if count > self.max_entries:
+                self.conn.execute(
+                    "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_access LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+
+    def get_version(self, collection: str) -> int:
+        with self.lock:
+            row = self.conn.execute("SELECT version FROM versions WHERE collection = ?", (collection,)).fetchone()
+            return row[0] if row else 0
+
+    def bump_version(self, collection: str) -> int:
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO versions (collection, version) VALUES (?, 1) "
+                "ON CONFLICT (collection) DO UPDATE SET version = version + 1",
+                (collection,)
+            )
+            return self.conn.execute("SELECT version FROM versions WHERE collection = ?", (collection,)).fetchone()[0]
+
+
+# ============= CACHE ==============================
+
+class AnswerCache:
+    def __init__(self, backend, ttl: int = ANSWER_CACHE_TTL):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def answer_key(self, query: str, branch: str, collection: str) -> str:
+        version = self.backend.get_version(collection)
+        return f"answer:{collection}:{version}:{branch}:{hash_query(query)}"
+
+    def get(self, query: str, collection: str) -> Optional[Dict[str, Any]]:
+        """Return the cached response for query, or None on a miss."""
+        branch = self.backend.get(f"branch:{hash_query(query)}")
+        value = self.backend.get(self.answer_key(query, branch, collection)) if branch else None
+        if value is None:
+            self.misses += 1
+            ANSWER_CACHE.labels("miss").inc()
+            return None
+        self.hits += 1
+        ANSWER_CACHE.labels("hit").inc()
+        return json.loads(value)
+
+    def contains(self, query: str, collection: str) -> bool:
+        """Whether query has a cached response, without counting a hit or miss."""
+        branch = self.backend.get(f"branch:{hash_query(query)}")
+        return branch is not None and self.backend.get(self.answer_key(query, branch, collection)) is not None
+
+    def set(self, query: str, branch: str, collection: str, response: Dict[str, Any]) -> None:
+        self.backend.set(f"branch:{hash_query(query)}", branch, self.ttl)
+        self.backend.set(self.answer_key(query, branch, collection), json.dumps(response), self.ttl)
+
+    def invalidate(self, collection: str) -> int:
+        """Drop every cached answer for collection, called when its documents change."""
+        return self.backend.bump_version(collection)
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class DisabledAnswerCache:
+    def get(self, query: str, collection: str):
+        return None
+
+    def contains(self, query: str, collection: str) -> bool:
+        return False
+
+    def set(self, query: str, branch: str, collection: str, response: Dict[str, Any]) -> None:
+        pass
+
+    def invalidate(self, collection: str) -> int:
+        return 0
+
+
+def create_answer_cache():
+    if ANSWER_CACHE_BACKEND == "off":
+        return DisabledAnswerCache()
+    if ANSWER_CACHE_BACKEND == "disk":
+        return AnswerCache(DiskCacheBackend())
+    return AnswerCache(MemoryCacheBackend())
+
+
+answer_cache = create_answer_cache()
@@ -0,0 +1,447 @@
+# Time partitioned message storage. messages is range partitioned by month on timestamp
+# (messages_y2026m01, ...) plus a default partition for anything outside them. Every
+# ARCHIVE_INTERVAL one worker (holding an advisory lock) creates the partitions for the
+# coming months and archives the months older than ARCHIVE_AFTER_MONTHS: the partition
+# is written to a zstd compressed Parquet file in MESSAGE_ARCHIVE_DIR, recorded in
+# message_archives and dropped, all in the transaction that holds the partition's lock.
+# The hot table and its indexes then only hold recent months.
+#
+# Reads fall back to the archive: when a conversation's message page or memory context
+# comes up short in the hot table and the conversation is older than the newest archived
+# month, the remaining messages are read from the archive files. Files are sorted by
+# conversation, so reading one conversation only decodes the row groups that hold it.
+# Full-text search and the sidebar previews only cover the hot table, as do old messages
+# that landed in the default partition (client timestamps outside the monthly ones). Their
+# responses carry an X-Archived-Before header with the end of the newest archived month.
+#
+# Deleting a conversation records it in deleted_conversations when archive files may hold
+# its messages (it started before the archive cutoff). Reads can't reach them any more (they go through the conversation row),
+# and the next maintenance pass rewrites the files that hold them and clears the record.
+
+import asyncio
+import heapq
+import logging
+import os
+import re
+import uuid
+from datetime import datetime
+from pathlib import Path
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Optional, Tuple
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from dotenv import load_dotenv
+from sqlalchemy import delete, func, select, text
+from starlette.concurrency import run_in_threadpool
+
+from models import Conversation, DeletedConversation, Message, MessageArchive, SessionLocal, engine, utc_now
+
+load_dotenv(dotenv_path="../../.env")
+
+MESSAGE_ARCHIVE_DIR = Path(os.getenv("MESSAGE_ARCHIVE_DIR", "./message_archive"))
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", 6)) # months kept in the hot table, the current one included
+ARCHIVE_INTERVAL = int(os.getenv("ARCHIVE_INTERVAL", 3600)) # seconds between maintenance passes
+PARTITIONS_AHEAD = 3 # months of partitions created in advance
+ARCHIVE_BATCH_SIZE = 5000 # rows read from the partition and written as one Parquet row group
+DETACH_LOCK_TIMEOUT = 5 # seconds
+ARCHIVE_LOCK_ID = 7318520 # pg advisory lock, one worker runs the maintenance at a time
+
+# Response header of the endpoints that only read the hot table
+ARCHIVED_BEFORE_HEADER = "X-Archived-Before"
+
+PARTITION_NAME = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+ARCHIVE_COLUMNS = ["id", "conversation_id", "sender", "message", "timestamp"]
+ARCHIVE_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("conversation_id", pa.string()),
+    ("sender", pa.string()),
+    ("message", pa.string()),
+    ("timestamp", pa.timestamp("us")),
+])
+
+
+def month_start(value: datetime) -> datetime:
+    return datetime(value.year, value.month, 1)
+
+
+def add_months(value: datetime, months: int) -> datetime:
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(start: datetime) -> str:
+    return f"messages_y{start.year:04d}m{start.month:02d}"
+
+
+def archive_cutoff(now: datetime = None) -> datetime:
+    """Messages from this time on stay in the hot table."""
+    return add_months(month_start(now or utc_now()), -(ARCHIVE_AFTER_MONTHS - 1))
+
+
+def to_message(row: Dict) -> Message:
+    # Detached Message, the API serialises it like one loaded from the hot table
+    return Message(**{column: row[column] for column in ARCHIVE_COLUMNS})
+
+
+def read_archive_file(path: str, conversation_id: str, before: Optional[Tuple[datetime, str]] = None) -> List[Dict]:
+    """Rows of one conversation in an archive file, oldest first. Blocking."""
+    filters = [("conversation_id", "=", conversation_id)]
+    if before is not None:
+        filters.append(("timestamp", "<=", before[0]))
+    table = pq.read_table(path, columns=ARCHIVE_COLUMNS, filters=filters)
+    rows = table.sort_by([("timestamp", "ascending"), ("id", "ascending")]).to_pylist()
+    if before is not None:
+        rows = [row for row in rows if (row["timestamp"], row["id"]) < before]
+    return rows
+
+
+def conversation_row_groups(parquet_file: pq.ParquetFile, conversation_ids: List[str]) -> List[int]:
+    """
+    Row groups of an archive file that can hold the conversations. The file is sorted by
+    conversation, row groups whose conversation range misses all of them are skipped.
+    """
+    first, last = min(conversation_ids), max(conversation_ids)
+    conversation_column = parquet_file.schema_arrow.get_field_index("conversation_id")
+    row_groups = []
+    for index in range(parquet_file.num_row_groups):
+        statistics = parquet_file.metadata.row_group(index).column(conversation_column).statistics
+        if statistics is not None and statistics.has_min_max and (statistics.max < first or statistics.min > last):
+            continue
+        row_groups.append(index)
+    return row_groups
+
+
+def rewrite_archive_file(path: str, conversation_ids: List[str]) -> Optional[int]:
+    """
+    Rewrite an archive file without the messages of the conversations, returns the rows
+    left, or None when the file holds none of them and is left alone. Blocking.
+    """
+    parquet_file = pq.ParquetFile(path)
+    removed = pa.array(conversation_ids, type=pa.string())
+    row_groups = conversation_row_groups(parquet_file, conversation_ids)
+    if not row_groups:
+        return None
+    # Only the conversation column is read to find out whether the file needs rewriting
+    batches = parquet_file.iter_batches(batch_size=ARCHIVE_BATCH_SIZE, row_groups=row_groups, columns=["conversation_id"])
+    if not any(pc.any(pc.is_in(batch.column("conversation_id"), value_set=removed)).as_py() for batch in batches):
+        return None
+
+    # Written under a temporary name and renamed over the old file, readers see one or the other
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.stem}.{uuid.uuid4().hex}.tmp")
+    rows = 0
+    writer = pq.ParquetWriter(tmp_path, ARCHIVE_SCHEMA, compression="zstd")
+    try:
+        for batch in parquet_file.iter_batches(batch_size=ARCHIVE_BATCH_SIZE, columns=ARCHIVE_COLUMNS):
+            kept = batch.filter(pc.invert(pc.is_in(batch.column("conversation_id"), value_set=removed)))
+            if kept.num_rows:
+                writer.write_table(pa.Table.from_batches([kept], schema=ARCHIVE_SCHEMA))
+                rows += kept.num_rows
+        writer.close()
+        os.replace(tmp_path, path)
+    except BaseException:
+        writer.close()
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return rows
+
+
+def iter_archive_export(path: str, conversation_ids: List[str],
+                        since: Optional[datetime] = None, until: Optional[datetime] = None) -> Iterator[List[Dict]]:
+    """
+    Rows of the given conversations in an archive file within since/until, in file order
+    (conversation, timestamp, id), one batch of at most ARCHIVE_BATCH_SIZE rows at a time.
+    Blocking, each next() reads from the file.
+    """
+    parquet_file = pq.ParquetFile(path)
+    row_groups = conversation_row_groups(parquet_file, conversation_ids)
+    if not row_groups:
+        return
+
+    wanted = pa.array(conversation_ids, type=pa.string())
+    for batch in parquet_file.iter_batches(batch_size=ARCHIVE_BATCH_SIZE, row_groups=row_groups, columns=ARCHIVE_COLUMNS):
+        mask = pc.is_in(batch.column("conversation_id"), value_set=wanted)
+        if since is not None:
+            mask = pc.and_(mask, pc.greater_equal(batch.column("timestamp"), pa.scalar(since, type=pa.timestamp("us"))))
+        if until is not None:
+            mask = pc.and_(mask, pc.less(batch.column("timestamp"), pa.scalar(until, type=pa.timestamp("us"))))
+        rows = batch.filter(mask).to_pylist()
+        if rows:
+            yield rows
+
+
+async def archive_file_rows(path: str, conversation_ids: List[str],
+                            since: Optional[datetime] = None, until: Optional[datetime] = None) -> AsyncIterator[Dict]:
+    """iter_archive_export one row at a time, the batches are read on a worker thread."""
+    batches = iter_archive_export(path, conversation_ids, since, until)
+    while True:
+        rows = await run_in_threadpool(next, batches, None)
+        if rows is None:
+            return
+        for row in rows:
+            yield row
+
+
+async def next_item(iterator: AsyncIterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+async def merge_sorted(iterators: List[AsyncIterator], key: Callable) -> AsyncIterator:
+    """heapq.merge for async iterators that are each sorted by key, holds one item of each."""
+    heap = []
+    for index, iterator in enumerate(iterators):
+        item = await next_item(iterator)
+        if item is not None:
+            heap.append((key(item), index, item))
+    heapq.heapify(heap)
+    while heap:
+        _, index, item = heap[0]
+        yield item
+        following = await next_item(iterators[index])
+        if following is None:
+            heapq.heappop(heap)
+        else:
+            heapq.heapreplace(heap, (key(following), index, following))
+
+
+class MessageArchiver:
+    def __init__(self, archive_dir: Path = MESSAGE_ARCHIVE_DIR):
+        self.archive_dir = archive_dir
+        self.task: asyncio.Task = None
+        self.archived = 0
+        self.purged = 0
+        self.archive_reads = 0
+        self.last_run: Optional[datetime] = None
+
+    async def ensure_partitions(self, conn, now: datetime = None):
+        """Create the default partition and the monthly ones from this month to PARTITIONS_AHEAD ahead."""
+        start = month_start(now or utc_now())
+        await conn.execute(text("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT"))
+        for offset in range(PARTITIONS_AHEAD + 1):
+            month = add_months(start, offset)
+            try:
+                # Fails if the default partition already holds rows for the month, the others still get created
+                async with conn.begin_nested():
+                    await conn.execute(text(
+                        f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF messages "
+                        f"FOR VALUES FROM ('{month.isoformat(sep=' ')}') TO ('{add_months(month, 1).isoformat(sep=' ')}')"
+                    ))
+            except Exception as e:
+                logging.error(f"Error creating the partition {partition_name(month)}: {str(e)}")
+
+    async def partitions(self, conn) -> List[Tuple[str, datetime]]:
+        """The monthly partitions of messages and the month each one holds, oldest first."""
+        result = await conn.execute(text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = 'messages'::regclass"
+        ))
+        months = []
+        for (name,) in result:
+            match = PARTITION_NAME.match(name)
+            if match:
+                months.append((name, datetime(int(match.group(1)), int(match.group(2)), 1)))
+        return sorted(months, key=lambda item: item[1])
+
+    async def archive_partition(self, name: str, start: datetime) -> int:
+        """Write one partition to Parquet and drop it, returns the number of rows archived."""
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        path = self.archive_dir / f"{name}.parquet"
+        tmp_path = self.archive_dir / f".{name}.{uuid.uuid4().hex}.tmp"
+        rows = 0
+
+        async with engine.begin() as conn:
+            # Keep the month's rows from changing while they are copied
+            await conn.execute(text(f"LOCK TABLE {name} IN SHARE MODE"))
+            result = await conn.stream(
+                text(f"SELECT {', '.join(ARCHIVE_COLUMNS)} FROM {name} ORDER BY conversation_id, timestamp, id")
+                .execution_options(yield_per=ARCHIVE_BATCH_SIZE)
+            )
+            writer = pq.ParquetWriter(tmp_path, ARCHIVE_SCHEMA, compression="zstd")
+            try:
+                async for batch in result.partitions():
+                    table = pa.Table.from_pylist([row._asdict() for row in batch], schema=ARCHIVE_SCHEMA)
+                    await run_in_threadpool(writer.write_table, table)
+                    rows += len(batch)
+                writer.close()
+                os.replace(tmp_path, path)
+            except BaseException:
+                writer.close()
+                tmp_path.unlink(missing_ok=True)
+                raise
+
+            await conn.execute(delete(MessageArchive).where(MessageArchive.name == name))
+            await conn.execute(MessageArchive.__table__.insert().values(
+                name=name,
+                range_start=start,
+                range_end=add_months(start, 1),
+                path=str(path),
+                row_count=rows,
+                archived_at=utc_now(),
+            ))
+            # Detaching needs an exclusive lock on messages, rather than queue every query behind it give up and retry next pass
+            await conn.execute(text(f"SET LOCAL lock_timeout = '{DETACH_LOCK_TIMEOUT}s'"))
+            await conn.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+            await conn.execute(text(f"DROP TABLE {name}"))
+        return rows
+
+    async def purge_deleted(self) -> int:
+        """Rewrite the archive files holding messages of deleted conversations, returns the files rewritten."""
+        async with SessionLocal() as db:
+            deleted = (await db.execute(select(DeletedConversation.conversation_id))).scalars().all()
+            if not deleted:
+                return 0
+            archives = (await db.execute(select(MessageArchive))).scalars().all()
+            rewritten = 0
+            for archive in archives:
+                rows = await run_in_threadpool(rewrite_archive_file, archive.path, deleted)
+                if rows is not None:
+                    archive.row_count = rows
+                    rewritten += 1
+            # Conversations deleted during the pass keep their record for the next one
+            await db.execute(delete(DeletedConversation).where(DeletedConversation.conversation_id.in_(deleted)))
+            await db.commit()
+        self.purged += len(deleted)
+        logging.info(f"Removed {len(deleted)} deleted conversations from the archive, {rewritten} files rewritten")
+        return rewritten
+
+    async def run_maintenance(self) -> bool:
+        """Create upcoming partitions and archive old ones, False if another worker is already at it."""
+        async with engine.connect() as lock_conn:
+            locked = (await lock_conn.execute(text(f"SELECT pg_try_advisory_lock({ARCHIVE_LOCK_ID})"))).scalar()
+            if not locked:
+                return False
+            try:
+                async with engine.begin() as conn:
+                    await self.ensure_partitions(conn)
+                    partitions = await self.partitions(conn)
+
+                cutoff = archive_cutoff()
+                for name, start in partitions:
+                    if add_months(start, 1) > cutoff:
+                        break
+                    rows = await self.archive_partition(name, start)
+                    self.archived += rows
+                    logging.info(f"Archived {rows} messages of {name} to {self.archive_dir}")
+                await self.purge_deleted()
+                self.last_run = utc_now()
+            finally:
+                await lock_conn.execute(text(f"SELECT pg_advisory_unlock({ARCHIVE_LOCK_ID})"))
+        return True
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_maintenance()
+            except Exception as e:
+                logging.error(f"Error archiving messages: {str(e)}")
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+
+    async def start(self):
+        # Messages can only be written once their month's partition exists, create them before serving
+        async with engine.begin() as conn:
+            await self.ensure_partitions(conn)
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def archived_before(self, db) -> Optional[datetime]:
+        """End of the newest archived month, messages before it may only be in the archive. None without archives."""
+        return (await db.execute(select(func.max(MessageArchive.range_end)))).scalar()
+
+    async def forget_conversation(self, db, conversation: Conversation):
+        """
+        Record a conversation being deleted so the next maintenance pass removes its archived
+        messages. Call it in the transaction that deletes the conversation.
+        """
+        # Only conversations started before the cutoff can have archived messages. Not checked
+        # against message_archives, a month being archived right now isn't recorded there yet
+        if conversation.timestamp is not None and conversation.timestamp >= archive_cutoff():
+            return
+        await db.merge(DeletedConversation(conversation_id=conversation.id, deleted_at=utc_now()))
+
+    async def archives_for(self, db, conversation_id: str) -> List[MessageArchive]:
+        """Archives that can hold messages of the conversation, newest first. Usually none."""
+        created = select(Conversation.timestamp).where(Conversation.id == conversation_id).scalar_subquery()
+        result = await db.execute(
+            select(MessageArchive)
+            .where(MessageArchive.range_end > created)
+            .order_by(MessageArchive.range_start.desc())
+        )
+        return result.scalars().all()
+
+    async def read_messages(self, db, conversation_id: str, limit: int,
+                            before: Optional[Tuple[datetime, str]] = None) -> List[Message]:
+        """Up to limit archived messages of a conversation older than before, newest first."""
+        messages = []
+        for archive in await self.archives_for(db, conversation_id):
+            if before is not None and archive.range_start > before[0]:
+                continue
+            self.archive_reads += 1
+            rows = await run_in_threadpool(read_archive_file, archive.path, conversation_id, before)
+            messages.extend(to_message(row) for row in reversed(rows))
+            if len(messages) >= limit:
+                break
+        return messages[:limit]
+
+    async def fill(self, db, conversation_id: str, hot: List[Message], limit: int,
+                   before: Optional[Tuple[datetime, str]] = None, created: Optional[datetime] = None) -> List[Message]:
+        """
+        Complete a newest first page of hot messages from the archive when it came up
+        short of limit. before is the page's cursor, the archive continues after the
+        last hot message. Pass the conversation's creation time as created when it is
+        at hand, recent conversations then skip the archive lookup.
+        """
+        if len(hot) >= limit or (created is not None and created >= archive_cutoff()):
+            return hot
+        if hot:
+            before = (hot[-1].timestamp, hot[-1].id)
+        return hot + await self.read_messages(db, conversation_id, limit - len(hot), before)
+
+    async def archive_paths(self, since: Optional[datetime] = None, until: Optional[datetime] = None) -> List[str]:
+        """Archive files with months between since and until, oldest first."""
+        async with SessionLocal() as db:
+            stmt = select(MessageArchive.path).order_by(MessageArchive.range_start)
+            if since is not None:
+                stmt = stmt.where(MessageArchive.range_end > since)
+            if until is not None:
+                stmt = stmt.where(MessageArchive.range_start < until)
+            return (await db.execute(stmt)).scalars().all()
+
+    async def export_rows(self, conversation_ids: List[str], since: Optional[datetime] = None,
+                          until: Optional[datetime] = None) -> AsyncIterator[Dict]:
+        """
+        Archived messages of the conversations for export.py, sorted by conversation, timestamp
+        and id. Each archive file is read a batch at a time and the files are merged as they go.
+        """
+        if not conversation_ids:
+            return
+        paths = await self.archive_paths(since, until)
+        self.archive_reads += len(paths)
+        files = [archive_file_rows(path, conversation_ids, since, until) for path in paths]
+        async for row in merge_sorted(files, key=lambda row: (row["conversation_id"], row["timestamp"], row["id"])):
+            yield row
+
+    def snapshot(self):
+        return {
+            "archive_dir": str(self.archive_dir),
+            "archive_after_months": ARCHIVE_AFTER_MONTHS,
+            "archived_this_process": self.archived,
+            "purged_conversations": self.purged,
+            "archive_reads": self.archive_reads,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+        }
+
+
+archiver = MessageArchiver()
@@ -0,0 +1,129 @@
+# Checks that a running API worker serves chat requests concurrently (tests/test_concurrency.py
+# checks the graph itself with stubbed services). The graph nodes are async
+# (Gemini through ainvoke, the models and Qdrant on worker threads), so while one request
+# waits on Gemini or a search the event loop moves the others along. A node that blocks
+# the loop shows up here as requests running one after another and a slow /healthz.
+#
+# Start a single worker and point the check at it:
+#
+#   uvicorn main:app --workers 1
+#   python concurrency_check.py --requests 16
+#
+# Every request is a different question from a different user, so the answer cache,
+# single flight and the per user admission limit don't serialize them. Exits with 1 when
+# fewer than --min-overlap requests were streaming at the same moment, or /healthz took
+# longer than --max-healthz-ms while they ran.
+
+import argparse
+import asyncio
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import httpx
+
+QUESTIONS = [
+    "What revenue requirement did PG&E request in its 2023 GRC?",
+    "How much did SCE ask for wildfire mitigation in its last rate case?",
+    "What did Cal Advocates recommend for SDG&E's vegetation management costs?",
+    "What return on equity was authorized in the latest cost of capital decision?",
+    "What did TURN argue about PG&E's depreciation rates?",
+    "How much undergrounding did the proposed decision adopt for PG&E?",
+    "What attrition year increases were adopted for SCE?",
+    "What are SoCalGas's forecast pipeline safety costs?",
+]
+
+
+async def ask(client: httpx.AsyncClient, index: int, timeline: dict):
+    now = datetime.now(timezone.utc).isoformat()
+    response = await client.post("/conversations", json={
+        "user_id": f"concurrency-check-{uuid.uuid4().hex[:8]}",
+        "title": "Concurrency check",
+        "timestamp": now,
+    })
+    response.raise_for_status()
+    conversation_id = response.json()["id"]
+
+    # A suffix keeps each question distinct from the others and from earlier runs
+    question = f"{QUESTIONS[index % len(QUESTIONS)]} ({uuid.uuid4().hex[:6]})"
+    events = timeline[index] = {"start": time.perf_counter(), "first": None, "end": None}
+    async with client.stream("POST", f"/conversations/{conversation_id}/messages/stream", json={
+        "sender": "user",
+        "message": question,
+        "timestamp": now,
+    }) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if line and events["first"] is None:
+                events["first"] = time.perf_counter()
+    events["end"] = time.perf_counter()
+
+
+async def probe_health(client: httpx.AsyncClient, latencies: list, done: asyncio.Event, interval: float):
+    while not done.is_set():
+        start = time.perf_counter()
+        response = await client.get("/healthz")
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(interval)
+
+
+def peak_overlap(intervals):
+    """Most intervals (start, end) open at the same moment."""
+    points = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    peak = current = 0
+    for _, step in points:
+        current += step
+        peak = max(peak, current)
+    return peak
+
+
+async def main(args) -> int:
+    timeline = {}
+    latencies = []
+    done = asyncio.Event()
+    timeout = httpx.Timeout(args.timeout, connect=10)
+    async with httpx.AsyncClient(base_url=args.url, timeout=timeout) as client, \
+            httpx.AsyncClient(base_url=args.url, timeout=10) as health_client:
+        prober = asyncio.create_task(probe_health(health_client, latencies, done, args.probe_interval))
+        start = time.perf_counter()
+        results = await asyncio.gather(*(ask(client, i, timeline) for i in range(args.requests)), return_exceptions=True)
+        elapsed = time.perf_counter() - start
+        done.set()
+        await prober
+
+    failed = [result for result in results if isinstance(result, Exception)]
+    for error in failed:
+        print(f"request failed: {error!r}")
+    finished = [events for events in timeline.values() if events["first"] is not None and events["end"] is not None]
+    if not finished:
+        print("no request finished")
+        return 1
+
+    # Between its first streamed line and its end a request is being worked on
+    streaming = peak_overlap([(events["first"], events["end"]) for events in finished])
+    serial = sum(events["end"] - events["start"] for events in finished)
+    latencies.sort()
+    healthz_p50 = 1000 * latencies[len(latencies) // 2] if latencies else 0.0
+    healthz_max = 1000 * latencies[-1] if latencies else 0.0
+
+    print(f"requests: {len(finished)} finished, {len(failed)} failed in {elapsed:.1f}s")
+    print(f"sum of request times: {serial:.1f}s, {serial / elapsed:.1f}x the wall time")
+    print(f"peak requests streaming at once: {streaming}")
+    print(f"/healthz while loaded: p50 {healthz_p50:.0f} ms, max {healthz_max:.0f} ms over {len(latencies)} probes")
+
+    ok = not failed and streaming >= args.min_overlap and healthz_max <= args.max_healthz_ms
+    print("OK" if ok else "FAILED")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that one API worker serves chat requests concurrently.")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--min-overlap", type=int, default=4, help="requests that must be streaming at the same moment")
+    parser.add_argument("--max-healthz-ms", type=float, default=500, help="slowest /healthz allowed while the requests run")
+    parser.add_argument("--probe-interval", type=float, default=0.1)
+    parser.add_argument("--timeout", type=float, default=300)
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -0,0 +1,163 @@
+# Bulk export of conversations as NDJSON, Markdown or CSV for the DocumentExport page.
+# Messages are read through a server-side cursor in batches of EXPORT_BATCH_SIZE and
+# formatted batch by batch, so an export uses the same memory however much history it
+# covers. Rows come out grouped by conversation, oldest message first. Messages moved
+# to the archive (see archive.py) are read from the Parquet files a batch at a time and
+# merged into the stream in order, only conversations older than the archive cutoff can
+# have any.
+
+import csv
+import io
+import json
+from collections import namedtuple
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional
+
+from sqlalchemy import select
+
+from archive import archive_cutoff, archiver, merge_sorted
+from models import Conversation, Message, SessionLocal
+
+EXPORT_BATCH_SIZE = 500
+
+# format -> (media type, file extension)
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "markdown": ("text/markdown; charset=utf-8", "md"),
+    "csv": ("text/csv; charset=utf-8", "csv"),
+}
+
+CSV_COLUMNS = ["conversation_id", "conversation_title", "message_id", "sender", "timestamp", "message"]
+
+# Archived messages in the shape of an export_query row
+ExportRow = namedtuple("ExportRow", CSV_COLUMNS)
+
+
+def sort_key(row):
+    return row.conversation_id, row.timestamp, row.message_id
+
+
+def export_query(user_id: str, conversation_ids: Optional[List[str]] = None,
+                 since: Optional[datetime] = None, until: Optional[datetime] = None):
+    stmt = (
+        select(
+            Message.conversation_id,
+            Conversation.title.label("conversation_title"),
+            Message.id.label("message_id"),
+            Message.sender,
+            Message.timestamp,
+            Message.message,
+        )
+        .join(Conversation, Conversation.id == Message.conversation_id)
+        .where(Conversation.user_id == user_id)
+    )
+    if conversation_ids:
+        stmt = stmt.where(Message.conversation_id.in_(conversation_ids))
+    if since:
+        stmt = stmt.where(Message.timestamp >= since)
+    if until:
+        stmt = stmt.where(Message.timestamp < until)
+    # Walks the (conversation_id, timestamp, id) index, no sort of the whole export
+    return stmt.order_by(Message.conversation_id, Message.timestamp, Message.id)
+
+
+def timestamp_text(value: Optional[datetime]) -> Optional[str]:
+    # Stored as naive UTC, written out the way the client sends them
+    return value.isoformat(timespec="milliseconds") + "Z" if value else None
+
+
+def format_ndjson(rows, state: dict) -> str:
+    return "".join(
+        json.dumps({
+            "conversation_id": row.conversation_id,
+            "conversation_title": row.conversation_title,
+            "message_id": row.message_id,
+            "sender": row.sender,
+            "timestamp": timestamp_text(row.timestamp),
+            "message": row.message,
+        }) + "\n"
+        for row in rows
+    )
+
+
+def format_csv(rows, state: dict) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if not state.get("header_written"):
+        writer.writerow(CSV_COLUMNS)
+        state["header_written"] = True
+    for row in rows:
+        writer.writerow([
+            row.conversation_id, row.conversation_title, row.message_id,
+            row.sender, timestamp_text(row.timestamp), row.message,
+        ])
+    return buffer.getvalue()
+
+
+def format_markdown(rows, state: dict) -> str:
+    parts = []
+    for row in rows:
+        # A heading each time the export moves on to the next conversation
+        if row.conversation_id != state.get("conversation_id"):
+            state["conversation_id"] = row.conversation_id
+            parts.append(f"# {row.conversation_title or 'Conversation'}\n\n_Conversation {row.conversation_id}_\n\n")
+        speaker = "User" if row.sender == "user" else "Assistant"
+        parts.append(f"**{speaker}** ({timestamp_text(row.timestamp)}):\n\n{row.message or ''}\n\n")
+    return "".join(parts)
+
+
+FORMATTERS = {
+    "ndjson": format_ndjson,
+    "markdown": format_markdown,
+    "csv": format_csv,
+}
+
+
+async def archived_titles(db, user_id: str, conversation_ids: Optional[List[str]] = None) -> Dict[str, str]:
+    """conversation id -> title of the export's conversations that can have archived messages."""
+    stmt = select(Conversation.id, Conversation.title).where(
+        Conversation.user_id == user_id, Conversation.timestamp < archive_cutoff()
+    )
+    if conversation_ids:
+        stmt = stmt.where(Conversation.id.in_(conversation_ids))
+    return dict((await db.execute(stmt)).all())
+
+
+async def archived_rows(titles: Dict[str, str], since: Optional[datetime] = None,
+                        until: Optional[datetime] = None) -> AsyncIterator[ExportRow]:
+    """The export's archived messages, in export_query order."""
+    async for row in archiver.export_rows(list(titles), since, until):
+        yield ExportRow(row["conversation_id"], titles[row["conversation_id"]], row["id"], row["sender"], row["timestamp"], row["message"])
+
+
+async def hot_rows(result) -> AsyncIterator:
+    async for rows in result.partitions():
+        for row in rows:
+            yield row
+
+
+async def stream_export(export_format: str, user_id: str, conversation_ids: Optional[List[str]] = None,
+                        since: Optional[datetime] = None, until: Optional[datetime] = None) -> AsyncIterator[str]:
+    """Yield the export one formatted batch at a time."""
+    formatter = FORMATTERS[export_format]
+    state = {}
+    stmt = export_query(user_id, conversation_ids, since, until).execution_options(yield_per=EXPORT_BATCH_SIZE)
+
+    # The request session is closed once the response starts streaming, so use a fresh one
+    async with SessionLocal() as db:
+        # Read before the cursor is opened, the session runs one statement at a time
+        titles = await archived_titles(db, user_id, conversation_ids)
+        result = await db.stream(stmt)
+        archived = archived_rows(titles, since, until)
+        rows = []
+        async for row in merge_sorted([archived, hot_rows(result)], key=sort_key):
+            rows.append(row)
+            if len(rows) == EXPORT_BATCH_SIZE:
+                yield formatter(rows, state)
+                rows = []
+        if rows:
+            yield formatter(rows, state)
+
+    if export_format == "csv" and not state.get("header_written"):
+        # An empty export is still a valid csv file
+        yield formatter([], state)
@@ -0,0 +1,212 @@
+# Idempotency-Key support for the message POST. The first request with a key claims it
+# with a pending row in idempotency_keys, runs the graph and stores the response it
+# returned. A retry with the same key (e.g. the client timed out on a slow answer) does
+# not insert another user message or run the graph again, it gets the stored response,
+# waiting for it first if the original request is still running.
+#
+# Retries handled by the same worker wait on an in-process future, ones that land on
+# another worker poll the row. A pending row whose owner died is reclaimed once its
+# PENDING_TTL has passed, completed rows are kept for IDEMPOTENCY_TTL.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from datetime import timedelta
+from typing import Any, Dict, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, update
+from sqlalchemy.dialects.postgresql import insert
+
+from models import IdempotencyKey, SessionLocal, utc_now
+
+load_dotenv(dotenv_path="../../.env")
+
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", 86400)) # seconds a completed response is replayed
+PENDING_TTL = int(os.getenv("IDEMPOTENCY_PENDING_TTL", 300)) # seconds before an abandoned claim can be taken over
+MAX_WAIT = float(os.getenv("IDEMPOTENCY_MAX_WAIT", 120)) # seconds a retry waits for the original request
+POLL_INTERVAL = 0.5 # seconds between checks of a key owned by another worker
+PURGE_INTERVAL = 3600 # seconds between deletes of expired keys
+MAX_KEY_LENGTH = 255
+
+PENDING = "pending"
+COMPLETED = "completed"
+
+
+class IdempotencyConflict(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+def request_fingerprint(conversation_id: str, sender: str, message: str) -> str:
+    """Identifies the request a key was used with, reusing a key for a different request is an error."""
+    payload = json.dumps([conversation_id, sender, message])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self):
+        # Keys this worker is running, retries landing here wait on the future instead of polling
+        self.local: Dict[str, asyncio.Future] = {}
+        # Retries in this worker currently waiting on each key
+        self.waiters: Dict[str, int] = {}
+        self.purge_task: asyncio.Task = None
+        self.replayed = 0
+        self.conflicts = 0
+
+    async def _try_claim(self, key: str, fingerprint: str) -> bool:
+        now = utc_now()
+        stmt = insert(IdempotencyKey).values(
+            key=key,
+            fingerprint=fingerprint,
+            status=PENDING,
+            response=None,
+            created_at=now,
+            expires_at=now + timedelta(seconds=PENDING_TTL),
+        )
+        # An expired key is free to reuse, whatever state it was left in
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IdempotencyKey.key],
+            set_={
+                "fingerprint": stmt.excluded.fingerprint,
+                "status": stmt.excluded.status,
+                "response": None,
+                "created_at": stmt.excluded.created_at,
+                "expires_at": stmt.excluded.expires_at,
+            },
+            where=IdempotencyKey.expires_at < now,
+        ).returning(IdempotencyKey.key)
+
+        async with SessionLocal() as db:
+            result = await db.execute(stmt)
+            claimed = result.first() is not None
+            await db.commit()
+        return claimed
+
+    async def _get(self, key: str) -> Optional[IdempotencyKey]:
+        async with SessionLocal() as db:
+            return await db.get(IdempotencyKey, key)
+
+    async def begin(self, key: str, fingerprint: str) -> Optional[Dict[str, Any]]:
+        """
+        Claim key for this request. Returns None when the caller owns the key and should
+        run the request, then call complete or release. Otherwise returns the response
+        stored for the key, waiting up to MAX_WAIT while the original request finishes.
+        """
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise IdempotencyConflict(400, f"Idempotency-Key must be 1 to {MAX_KEY_LENGTH} characters")
+
+        deadline = time.monotonic() + MAX_WAIT
+        while True:
+            if await self._try_claim(key, fingerprint):
+                self.local[key] = asyncio.get_running_loop().create_future()
+                return None
+
+            row = await self._get(key)
+            if row is None:
+                # Released between the claim and the read, try again
+                continue
+            if row.fingerprint != fingerprint:
+                self.conflicts += 1
+                raise IdempotencyConflict(422, "Idempotency-Key was already used for a different request")
+            if row.status == COMPLETED:
+                self.replayed += 1
+                logging.info(f"Replaying stored response for Idempotency-Key {key}")
+                return json.loads(row.response)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise IdempotencyConflict(409, "A request with this Idempotency-Key is still being processed")
+
+            local = self.local.get(key)
+            if local is not None:
+                # shield so a retry that gives up doesn't cancel the owner's future
+                self.waiters[key] = self.waiters.get(key, 0) + 1
+                try:
+                    await asyncio.wait_for(asyncio.shield(local), remaining)
+                except asyncio.TimeoutError:
+                    pass
+                finally:
+                    self.waiters[key] -= 1
+                    if not self.waiters[key]:
+                        del self.waiters[key]
+            else:
+                await asyncio.sleep(min(POLL_INTERVAL, remaining))
+
+    def has_waiters(self, key: str) -> bool:
+        """Whether a retry in this worker is waiting for key's response."""
+        return key in self.waiters
+
+    def _finish(self, key: str):
+        future = self.local.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(None)
+
+    async def complete(self, key: str, response: Dict[str, Any]):
+        """Store the response for key, later retries get it back as is."""
+        try:
+            async with SessionLocal() as db:
+                await db.execute(
+                    update(IdempotencyKey)
+                    .where(IdempotencyKey.key == key)
+                    .values(
+                        status=COMPLETED,
+                        response=json.dumps(response),
+                        expires_at=utc_now() + timedelta(seconds=IDEMPOTENCY_TTL),
+                    )
+                )
+                await db.commit()
+        finally:
+            self._finish(key)
+
+    async def release(self, key: str):
+        """Give up a claim without a response (the request failed) so a retry runs it again."""
+        try:
+            async with SessionLocal() as db:
+                await db.execute(
+                    delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.status == PENDING)
+                )
+                await db.commit()
+        except Exception as e:
+            logging.error(f"Error releasing Idempotency-Key {key}: {str(e)}")
+        finally:
+            self._finish(key)
+
+    async def purge_expired(self) -> int:
+        async with SessionLocal() as db:
+            result = await db.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at < utc_now()))
+            await db.commit()
+        return result.rowcount
+
+    async def _purge_loop(self):
+        while True:
+            try:
+                purged = await self.purge_expired()
+                if purged:
+                    logging.info(f"Purged {purged} expired idempotency keys")
+            except Exception as e:
+                logging.error(f"Error purging idempotency keys: {str(e)}")
+            await asyncio.sleep(PURGE_INTERVAL)
+
+    def start(self):
+        self.purge_task = asyncio.create_task(self._purge_loop())
+
+    async def stop(self):
+        if self.purge_task is not None:
+            self.purge_task.cancel()
+            try:
+                await self.purge_task
+            except asyncio.CancelledError:
+                pass
+            self.purge_task = None
+
+    def snapshot(self):
+        return {"running": len(self.local), "replayed": self.replayed, "conflicts": self.conflicts}
+
+
+idempotency = IdempotencyStore()
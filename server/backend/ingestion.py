@@ -0,0 +1,169 @@
+# Document uploads. receive_upload streams a multipart PDF upload straight to a file in
+# UPLOAD_DIR as the request body arrives, so memory use doesn't depend on the file size.
+# The upload is then ingested by a background job (see jobs.py) that runs the same
+# extract -> chunk -> embed -> upsert steps as the offline scripts in qdrant_utils/,
+# with the embedding model and Qdrant client already loaded in the registry. Qdrant
+# upserts wait for the points to be indexed, so the document can be queried as soon as
+# the job completes.
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import sys
+import uuid
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+from dotenv import load_dotenv
+from python_multipart.exceptions import FormParserError
+from python_multipart.multipart import FormParser, parse_options_header
+from starlette.concurrency import run_in_threadpool
+
+from answer_cache import answer_cache
+from registry import registry
+from retrieval import DOCUMENT_COLLECTION
+
+# The extract and chunk steps are shared with the offline ingestion scripts
+QDRANT_UTILS_DIR = Path(__file__).resolve().parents[2] / "qdrant_utils"
+if str(QDRANT_UTILS_DIR) not in sys.path:
+    sys.path.append(str(QDRANT_UTILS_DIR))
+
+from ingest_pipeline import chunk_id, chunk_payload, create_qdrant_points, extract_pdf_text, split_chunks
+
+load_dotenv(dotenv_path="../../.env")
+
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "./uploads"))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", 100)) * 2**20
+EMBED_BATCH_SIZE = 64 # chunks embedded and upserted at a time, progress is reported per batch
+
+FILE_FIELD = "file"
+# Form fields copied into each chunk's payload, like the metadata.json of the offline scripts
+METADATA_FIELDS = ["proceeding_id", "title", "doc_type", "published_date", "source_url"]
+
+
+class UploadRejected(Exception):
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+async def receive_upload(request) -> Dict[str, Any]:
+    """
+    Stream a multipart/form-data upload with a PDF in the file field to UPLOAD_DIR.
+    Returns {"document_id", "path", "fields"}, raises UploadRejected for a bad upload.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise UploadRejected(415, "Expected a multipart/form-data upload")
+
+    # Each upload writes its parts to its own directory, removed at the end however the upload
+    # ends. A part is only handed to on_file once it is complete, so the one being written
+    # when the client disconnects or the parser fails isn't known any other way.
+    tmp_dir = UPLOAD_DIR / "tmp" / uuid.uuid4().hex
+    tmp_dir.mkdir(parents=True)
+    try:
+        return await _receive_parts(request, boundary, tmp_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+async def _receive_parts(request, boundary: bytes, tmp_dir: Path) -> Dict[str, Any]:
+    fields = {}
+    files = []
+
+    def on_field(field):
+        fields[field.field_name.decode()] = (field.value or b"").decode("utf-8", errors="replace")
+
+    def on_file(file):
+        file.close()
+        files.append(file)
+
+    parser = FormParser(
+        "multipart/form-data",
+        on_field,
+        on_file,
+        boundary=boundary,
+        # Every file part goes straight to a temporary file on disk, none of it is kept in memory
+        config={"UPLOAD_DIR": str(tmp_dir), "MAX_MEMORY_FILE_SIZE": 0, "UPLOAD_DELETE_TMP": False},
+    )
+
+    received = 0
+    try:
+        async for chunk in request.stream():
+            received += len(chunk)
+            if received > MAX_UPLOAD_BYTES:
+                raise UploadRejected(413, f"Upload is larger than {MAX_UPLOAD_BYTES // 2**20} MB")
+            parser.write(chunk)
+        parser.finalize()
+    except FormParserError as e:
+        raise UploadRejected(400, f"Malformed multipart upload: {e}")
+    finally:
+        parser.close()
+
+    upload = next((f for f in files if f.field_name.decode() == FILE_FIELD), None)
+    if upload is None or upload.actual_file_name is None:
+        # A file that never reached the disk is empty
+        raise UploadRejected(400, f"No file in the {FILE_FIELD} field")
+
+    tmp_path = upload.actual_file_name.decode() if isinstance(upload.actual_file_name, bytes) else upload.actual_file_name
+    with open(tmp_path, "rb") as f:
+        if f.read(5) != b"%PDF-":
+            raise UploadRejected(415, "Only PDF files can be uploaded")
+
+    document_id = f"upload-{uuid.uuid4()}"
+    path = UPLOAD_DIR / f"{document_id}.pdf"
+    os.replace(tmp_path, path)
+
+    if not fields.get("title"):
+        file_name = upload.file_name.decode() if isinstance(upload.file_name, bytes) else upload.file_name
+        fields["title"] = file_name or document_id
+    return {"document_id": document_id, "path": str(path), "fields": fields}
+
+
+def upload_doc_args(document_id: str, fields: Dict[str, str]) -> Dict[str, Any]:
+    """Chunk metadata for an upload, the same keys getDocArgs builds for the offline scripts."""
+    doc_args = {name: fields.get(name) or None for name in METADATA_FIELDS}
+    published_date = doc_args["published_date"] or ""
+    year = int(published_date[-4:]) if published_date[-4:].isdigit() else 0
+    return {**doc_args, "document_id": document_id, "year": year}
+
+
+def ingest_pdf(path: str, doc_args: Dict[str, Any], progress: Callable[[str, int, int], None]) -> int:
+    """Extract, chunk, embed and upsert one PDF. Blocking, returns the number of chunks."""
+    progress("extracting", 0, 0)
+    chunks = split_chunks(extract_pdf_text(path=path), doc_args)
+
+    total = len(chunks)
+    progress("embedding", 0, total)
+    for start in range(0, total, EMBED_BATCH_SIZE):
+        batch = chunks[start:start + EMBED_BATCH_SIZE]
+        embeddings = registry.embedding_model.encode([chunk["text"] for chunk in batch])
+        points = create_qdrant_points(
+            [chunk_id(chunk) for chunk in batch],
+            embeddings,
+            [chunk_payload(chunk) for chunk in batch],
+        )
+        registry.qdrant_client.upsert(collection_name=DOCUMENT_COLLECTION, points=points, wait=True)
+        progress("embedding", start + len(batch), total)
+    return total
+
+
+async def run_ingest_job(job, on_progress) -> str:
+    """jobs.py handler for uploads, job.query holds the upload's path and doc_args as JSON."""
+    upload = json.loads(job.query)
+    loop = asyncio.get_running_loop()
+
+    # ingest_pdf runs in a worker thread, progress has to be handed back to the event loop
+    def progress(stage: str, done: int, total: int):
+        loop.call_soon_threadsafe(on_progress, stage, done, total)
+
+    count = await run_in_threadpool(ingest_pdf, upload["path"], upload["doc_args"], progress)
+
+    # Cached answers were built without the new document
+    answer_cache.invalidate(DOCUMENT_COLLECTION)
+    logging.info(f"Ingested {count} chunks of {upload['doc_args']['document_id']} into {DOCUMENT_COLLECTION}")
+    return f"Ingested {count} chunks from {upload['doc_args']['title']}"
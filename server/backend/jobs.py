@@ -0,0 +1,343 @@
+# Background jobs for work that takes too long to hold a request open: GRC_LONGFORM
+# essays (POST /messages hands every longform query to a job) and the ingestion of
+# uploaded documents (see ingestion.py). Submitting a job stores it in the jobs table and returns
+# its id straight away. JOB_WORKERS tasks in this process run the queued jobs, separately
+# from the admission slots, so long essays never hold up short interactive questions.
+#
+# Job state lives in Postgres: clients can poll or stream it from any worker, and jobs
+# survive restarts. A job is claimed with a conditional update so only one process runs
+# it, and the running process refreshes its heartbeat. Every RECOVER_INTERVAL each
+# process requeues jobs whose heartbeat went stale (the process running them died) and
+# picks up queued jobs nobody has claimed. A finished answer is also saved to the
+# conversation as an ai message, for jobs that belong to a conversation.
+
+import asyncio
+import logging
+import os
+import uuid
+from datetime import timedelta
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional, Set
+
+from dotenv import load_dotenv
+from sqlalchemy import select, update
+
+from admission import AdmissionRejected
+from ingestion import run_ingest_job
+from llm import run_longform
+from memory import load_context, schedule_summary_update
+from message_writer import message_writer
+from metrics import JOB_DURATION, JOB_QUEUE_TIME, JOBS_FINISHED, JOBS_QUEUED
+from models import Conversation, Job, Message, SessionLocal, utc_now
+
+load_dotenv(dotenv_path="../../.env")
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2)) # jobs running at once in this process
+JOB_MAX_QUEUE = int(os.getenv("JOB_MAX_QUEUE", 100)) # jobs waiting for a worker before submits are rejected
+EVENT_POLL_INTERVAL = 1.0 # seconds between checks of a job running in another process
+HEARTBEAT_INTERVAL = 15 # seconds between heartbeats of a running job
+STALE_AFTER = 60 # seconds without a heartbeat before a running job is taken over
+RECOVER_INTERVAL = 60 # seconds between sweeps for stale and unclaimed jobs
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+FINISHED = (COMPLETED, FAILED)
+
+LONGFORM = "longform"
+INGEST = "ingest"
+
+
+async def run_longform_job(job: Job, on_progress) -> str:
+    # Same context as an answer given inline. The question was saved with the job's id,
+    # so it isn't repeated as the latest turn
+    history, summary = None, None
+    if job.conversation_id:
+        async with SessionLocal() as db:
+            conversation = await db.get(Conversation, job.conversation_id)
+            if conversation:
+                context = await load_context(db, conversation, exclude_message_id=job.id)
+                history, summary = context["history"], context["summary"]
+    answer = await run_longform(job.query, on_progress, history=history, summary=summary)
+    return answer.content
+
+# Job kind -> coroutine producing the answer text, called as handler(job, on_progress)
+JOB_HANDLERS: Dict[str, Callable[[Job, Any], Awaitable[str]]] = {
+    LONGFORM: run_longform_job,
+    INGEST: run_ingest_job,
+}
+
+
+def job_state(job: Job) -> Dict[str, Any]:
+    return {
+        "status": job.status,
+        "stage": job.stage,
+        "progress_done": job.progress_done or 0,
+        "progress_total": job.progress_total or 0,
+        "error": job.error,
+        "message_id": job.message_id,
+    }
+
+
+class JobScheduler:
+    def __init__(self, workers: int = JOB_WORKERS, max_queue: int = JOB_MAX_QUEUE):
+        self.worker_count = workers
+        self.max_queue = max_queue
+        self.queue: asyncio.Queue = None
+        self.workers = []
+        self.recover_task: asyncio.Task = None
+        # Jobs sitting in this process's queue, so a sweep doesn't add them twice
+        self.enqueued: Set[str] = set()
+        # Progress of the jobs running in this process, saved to the jobs table as it changes
+        self.running: Dict[str, Dict[str, Any]] = {}
+        self.saving: Dict[str, asyncio.Task] = {}
+        # Event streams following each job
+        self.subscribers: Dict[str, Set[asyncio.Event]] = {}
+
+    def _enqueue(self, job_id: str):
+        if job_id in self.enqueued:
+            return
+        self.enqueued.add(job_id)
+        self.queue.put_nowait(job_id)
+        JOBS_QUEUED.set(self.queue.qsize())
+
+    async def recover(self):
+        """Requeue jobs whose process died and queue unclaimed jobs here, oldest first."""
+        async with SessionLocal() as db:
+            stale = await db.execute(
+                update(Job)
+                .where(Job.status == RUNNING, Job.heartbeat_at < utc_now() - timedelta(seconds=STALE_AFTER))
+                .values(status=QUEUED)
+                .returning(Job.id)
+            )
+            requeued = stale.scalars().all()
+            await db.commit()
+            result = await db.execute(select(Job.id).where(Job.status == QUEUED).order_by(Job.created_at))
+            queued = result.scalars().all()
+        if requeued:
+            logging.info(f"Requeued {len(requeued)} jobs left running by a stopped process")
+        for job_id in queued:
+            self._enqueue(job_id)
+
+    async def _recover_loop(self):
+        while True:
+            await asyncio.sleep(RECOVER_INTERVAL)
+            try:
+                await self.recover()
+            except Exception as e:
+                logging.error(f"Error recovering jobs: {str(e)}")
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        await self.recover()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+        self.recover_task = asyncio.create_task(self._recover_loop())
+
+    async def stop(self):
+        """Stop the workers and hand the jobs they were running back to the queue."""
+        interrupted = list(self.running)
+        for task in self.workers + [self.recover_task]:
+            task.cancel()
+        await asyncio.gather(*self.workers, self.recover_task, return_exceptions=True)
+        self.workers = []
+        self.recover_task = None
+        if interrupted:
+            async with SessionLocal() as db:
+                await db.execute(
+                    update(Job).where(Job.id.in_(interrupted), Job.status == RUNNING).values(status=QUEUED)
+                )
+                await db.commit()
+            logging.info(f"Returned {len(interrupted)} interrupted jobs to the queue")
+
+    async def submit(self, kind: str, conversation_id: Optional[str], user_id: str, query: str, job_id: str = None) -> Job:
+        """Queue a job. A longform job takes the id of the user message it answers, see run_longform_job."""
+        if self.queue.qsize() >= self.max_queue:
+            raise AdmissionRejected("job_queue_full", 30)
+
+        job = Job(
+            id=job_id or str(uuid.uuid4()),
+            kind=kind,
+            conversation_id=conversation_id,
+            user_id=user_id,
+            query=query,
+            status=QUEUED,
+            progress_done=0,
+            progress_total=0,
+            created_at=utc_now(),
+        )
+        async with SessionLocal() as db:
+            db.add(job)
+            await db.commit()
+
+        self._enqueue(job.id)
+        return job
+
+    async def get(self, job_id: str) -> Optional[Job]:
+        async with SessionLocal() as db:
+            return await db.get(Job, job_id)
+
+    async def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """Current state of a job, progress of jobs running here is ahead of the table."""
+        if job_id in self.running:
+            return dict(self.running[job_id])
+        job = await self.get(job_id)
+        return job_state(job) if job else None
+
+    async def events(self, job_id: str) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the job's state every time it changes, ending once the job is finished."""
+        changed = asyncio.Event()
+        self.subscribers.setdefault(job_id, set()).add(changed)
+        try:
+            last = None
+            while True:
+                changed.clear()
+                state = await self.status(job_id)
+                if state is None:
+                    return
+                if state != last:
+                    yield state
+                    last = state
+                if state["status"] in FINISHED:
+                    return
+                # Jobs running in another process don't notify us, poll the table for those
+                try:
+                    await asyncio.wait_for(changed.wait(), EVENT_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            subscribers = self.subscribers.get(job_id)
+            subscribers.discard(changed)
+            if not subscribers:
+                del self.subscribers[job_id]
+
+    def _notify(self, job_id: str):
+        for changed in self.subscribers.get(job_id, ()):
+            changed.set()
+
+    async def _save_progress(self, job_id: str):
+        state = self.running.get(job_id)
+        if state is None:
+            return
+        async with SessionLocal() as db:
+            await db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == RUNNING)
+                .values(stage=state["stage"], progress_done=state["progress_done"], progress_total=state["progress_total"])
+            )
+            await db.commit()
+
+    def _progress_callback(self, job_id: str):
+        def on_progress(stage: str, done: int = 0, total: int = 0):
+            state = self.running.get(job_id)
+            if state is None:
+                return
+            state.update(stage=stage, progress_done=done, progress_total=total)
+            self._notify(job_id)
+            # One save at a time per job, it writes whatever the latest progress is
+            if job_id not in self.saving:
+                task = asyncio.create_task(self._save_progress(job_id))
+                self.saving[job_id] = task
+                task.add_done_callback(lambda task: self._progress_saved(job_id, task))
+        return on_progress
+
+    def _progress_saved(self, job_id: str, task: asyncio.Task):
+        self.saving.pop(job_id, None)
+        if not task.cancelled() and task.exception():
+            logging.warning(f"Error saving progress of job {job_id}: {task.exception()}")
+
+    async def _finish(self, job_id: str, **values):
+        saving = self.saving.get(job_id)
+        if saving is not None:
+            await asyncio.gather(saving, return_exceptions=True)
+        async with SessionLocal() as db:
+            await db.execute(update(Job).where(Job.id == job_id).values(finished_at=utc_now(), **values))
+            await db.commit()
+
+    async def _worker(self):
+        while True:
+            job_id = await self.queue.get()
+            self.enqueued.discard(job_id)
+            JOBS_QUEUED.set(self.queue.qsize())
+            try:
+                await self._run(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Error running job {job_id}: {str(e)}")
+
+    async def _claim(self, job_id: str) -> Optional[Job]:
+        """Mark a queued job as running here, None if another process got it first."""
+        now = utc_now()
+        async with SessionLocal() as db:
+            result = await db.execute(
+                update(Job)
+                .where(Job.id == job_id, Job.status == QUEUED)
+                .values(
+                    status=RUNNING, started_at=now, heartbeat_at=now,
+                    stage=None, progress_done=0, progress_total=0, error=None,
+                )
+                .returning(Job)
+            )
+            job = result.scalars().first()
+            await db.commit()
+        return job
+
+    async def _heartbeat(self, job_id: str):
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                async with SessionLocal() as db:
+                    await db.execute(
+                        update(Job).where(Job.id == job_id, Job.status == RUNNING).values(heartbeat_at=utc_now())
+                    )
+                    await db.commit()
+            except Exception as e:
+                logging.warning(f"Error saving heartbeat of job {job_id}: {str(e)}")
+
+    async def _run(self, job_id: str):
+        job = await self._claim(job_id)
+        if job is None:
+            return
+        JOB_QUEUE_TIME.labels(job.kind).observe((job.started_at - job.created_at).total_seconds())
+
+        self.running[job_id] = job_state(job)
+        self._notify(job_id)
+        heartbeat = asyncio.create_task(self._heartbeat(job_id))
+        try:
+            content = await JOB_HANDLERS[job.kind](job, self._progress_callback(job_id))
+
+            message_id = None
+            if job.conversation_id:
+                ai_msg = Message(
+                    id=str(uuid.uuid4()),
+                    conversation_id=job.conversation_id,
+                    sender="ai",
+                    message=content,
+                    timestamp=utc_now(),
+                )
+                schedule_summary_update(job.conversation_id, after=message_writer.submit(ai_msg))
+                message_id = ai_msg.id
+            await self._finish(job_id, status=COMPLETED, stage=None, result=content, message_id=message_id)
+            JOBS_FINISHED.labels(job.kind, COMPLETED).inc()
+        except asyncio.CancelledError:
+            # Shutting down, stop() puts the job back in the queue
+            raise
+        except Exception as e:
+            logging.error(f"Job {job_id} ({job.kind}) failed: {str(e)}")
+            await self._finish(job_id, status=FAILED, error=str(e))
+            JOBS_FINISHED.labels(job.kind, FAILED).inc()
+        finally:
+            heartbeat.cancel()
+            self.running.pop(job_id, None)
+            JOB_DURATION.labels(job.kind).observe((utc_now() - job.started_at).total_seconds())
+            self._notify(job_id)
+
+    def snapshot(self):
+        return {
+            "workers": self.worker_count,
+            "queued": self.queue.qsize() if self.queue else 0,
+            "running": {job_id: dict(state) for job_id, state in self.running.items()},
+        }
+
+
+jobs = JobScheduler()
@@ -6,6 +6,7 @@ from langgraph.graph import MessagesState, StateGraph
 from langchain_core.tools import tool
 from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage
 from langgraph.prebuilt import ToolNode
+from langgraph.config import get_stream_writer
 from langgraph.graph import END
 from langchain_core.documents import Document
 import time
@@ -14,38 +15,38 @@ from contextlib import redirect_stdout
 from datetime import datetime
 from pathlib import Path
 import json
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Optional
 import uuid
-from qdrant_client import QdrantClient, models
+from qdrant_client import models
 import os
 from dotenv import load_dotenv
-from retrieval import retrieve, set_collection
+from retrieval import retrieve
+from registry import registry
 from langchain_google_genai import ChatGoogleGenerativeAI
 import asyncio
 import time
 from tenacity import AsyncRetrying, stop_after_attempt, RetryError, wait_exponential, retry
 from qdrant_client.http.models import Filter, FieldCondition, MatchAny
 import re
-from advanced_retrieval import crossEncoderQuery
+from advanced_retrieval import multiStringCrossEncoderQuery
+from answer_cache import answer_cache, hash_query, normalize_query
+from singleflight import SingleFlight
+from query_classifier import query_classifier, CLASSIFIER_SHADOW_RATE
+from starlette.concurrency import run_in_threadpool
+import random
+from metrics import observe_stage, timed_node, GeminiMetricsHandler, count_retry, QUERY_BRANCH, WORK_CANCELLED, SPECULATIVE_RETRIEVAL, SPECULATION_WASTED_SECONDS
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # load in environment variables
 env_path = "../../.env"
 load_dotenv(dotenv_path=env_path)
-QDRANT_CONNECT = os.getenv("QDRANT_CONNECT")
 COLLECTION_NAME ='GRC_Documents_Large'
 GOOGLE_API = os.getenv("GOOGLE_API_KEY")
 
-try:
-    qdrant_client = QdrantClient(url=QDRANT_CONNECT)
-    collections = qdrant_client.get_collections()
-
-    print("Collections:r")
-    for collection in collections.collections:
-        print(f"- {collection.name}")
-except Exception as e:
-    print(f"Error connecting to Qdrant: {e}")
-
-set_collection(qdrant_client)
+# The qdrant client, embedding and cross-encoder models live in the registry (registry.py),
+# the API loads them at startup
 
 # Provided retrieve tool for querying DB, Search Engine Team will write code replacing
 # this to allow for query expansion
@@ -54,16 +55,64 @@ def set_api_key(api_key_variable: Path):
 
 def initialize_llm(gemini_model = 'gemini-2.0-flash'):
     set_api_key(GOOGLE_API)
-    llm = ChatGoogleGenerativeAI(model=gemini_model, max_tokens=None)
+    llm = ChatGoogleGenerativeAI(model=gemini_model, max_tokens=None, callbacks=[GeminiMetricsHandler()])
     return llm
 
 llm = initialize_llm()
 
+# ============= CONVERSATION MEMORY ==============================
+# Each turn sends a fixed size context: a rolling summary of older turns plus the
+# last RECENT_TURNS user/ai pairs verbatim (each capped at MAX_CONTEXT_MESSAGE_CHARS)
+RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", 3))
+MAX_CONTEXT_MESSAGE_CHARS = int(os.getenv("MEMORY_MESSAGE_CHARS", 2000))
+SUMMARY_MAX_WORDS = int(os.getenv("MEMORY_SUMMARY_WORDS", 250))
+
+SUMMARY_PROMPT = """
+You maintain a running summary of a conversation between a user and a California GRC regulatory assistant.
+Update the existing summary with the new messages below. Keep the facts, figures, proceedings, utilities and
+document references that later questions might refer back to, and drop pleasantries and formatting.
+Write at most {max_words} words of plain prose. Return only the updated summary.
+
+EXISTING SUMMARY:
+{summary}
+
+NEW MESSAGES:
+{messages}
+"""
+
+def truncate_message(content: str, max_chars: int = MAX_CONTEXT_MESSAGE_CHARS) -> str:
+    if len(content) <= max_chars:
+        return content
+    return content[:max_chars] + " ...[truncated]"
+
+def format_summary_prompt(summary: str, messages: List) -> List:
+    """messages are (role, content) pairs, role is "user" or "assistant"."""
+    transcript = "\n\n".join(f"{role.upper()}: {truncate_message(content)}" for role, content in messages)
+    prompt = SUMMARY_PROMPT.format(max_words=SUMMARY_MAX_WORDS, summary=summary or "(none)", messages=transcript)
+    return [HumanMessage(content=prompt)]
+
+async def summarize_conversation(summary: str, messages: List) -> str:
+    """Fold messages into summary and return the new summary."""
+    with observe_stage("summary_llm"):
+        response = await llm.ainvoke(format_summary_prompt(summary, messages))
+    return response.content.strip()
+
 # Graphs nodes =====================================
 class ChatHistoryManager:
+    """
+    In memory history of the console sessions. Messages that fall out of the window are
+    folded into the session summary with summarize_conversation, like memory.update_summary
+    does for API conversations, on a background thread so a turn never waits on it.
+    """
     def __init__(self, max_history_length=10):
         self.sessions = {}
+        self.summaries = {}
+        # Messages that left the window and aren't in the summary yet, per session
+        self.unsummarized = {}
         self.max_history_length = max_history_length
+        self.lock = threading.Lock()
+        # One thread, so a session's summary updates run in order
+        self.summary_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-summary")
 
     def get_or_create_session(self, session_id: str) -> List:
         """Get or create a new chat session"""
@@ -77,15 +126,45 @@ class ChatHistoryManager:
         history.append(message)
 
         if len(history) > self.max_history_length * 2:  # Keep pairs of messages
+            evicted = history[:-self.max_history_length*2]
             self.sessions[session_id] = history[-self.max_history_length*2:]
+            with self.lock:
+                self.unsummarized.setdefault(session_id, []).extend(evicted)
+            self.summary_executor.submit(self.update_summary, session_id)
+
+    def update_summary(self, session_id: str) -> None:
+        """Fold the messages that left the window into the session summary."""
+        with self.lock:
+            pending = self.unsummarized.pop(session_id, [])
+        if not pending:
+            return
+        try:
+            summary = asyncio.run(summarize_conversation(
+                self.summaries.get(session_id),
+                [(msg["role"], msg["content"]) for msg in pending]
+            ))
+        except Exception as e:
+            # Kept for the next update, the turn that evicted them has long been answered
+            print(f"Error summarizing chat history: {e}")
+            with self.lock:
+                self.unsummarized[session_id] = pending + self.unsummarized.get(session_id, [])
+            return
+        self.summaries[session_id] = summary
 
     def get_history(self, session_id: str) -> List:
         """Get the chat history for a session"""
         return self.get_or_create_session(session_id)
 
+    def get_summary(self, session_id: str):
+        """Get the summary of messages that no longer fit in the history"""
+        return self.summaries.get(session_id)
+
     def clear_history(self, session_id: str) -> None:
         """Clear the chat history for a session"""
         self.sessions[session_id] = []
+        self.summaries.pop(session_id, None)
+        with self.lock:
+            self.unsummarized.pop(session_id, None)
 
     def save_history(self): # TODO: STORE HISTORY TO FILE
         pass
@@ -93,14 +172,16 @@ class ChatHistoryManager:
     def load_history(self): # TODO: LOAD HISTORY FROM FILE
         pass
 
-chat_manager = ChatHistoryManager(max_history_length=15)
+# Same window as the API (memory.load_context): RECENT_TURNS pairs verbatim, older turns only
+# through the summary, so the console sends prompts of the same size as the API does
+chat_manager = ChatHistoryManager(max_history_length=RECENT_TURNS)
 
 
 
 ### CODE TO CLASSIFY THE MESSAGES ###############################
-def pre_filter_query(query: str):
+async def llm_classify_query(query: str):
     """
-    Pre-filter queries to determine processing branch.
+    Classify a query with Gemini, used when the local classifier isn't confident.
     You can easily modify this to add new classifications.
     """
     classification_prompt = f"""Classify this query into ONE category:
@@ -139,7 +220,8 @@ Respond with ONLY the category name (GRC_SPECIFIC, GRC_GENERAL, NON_GRC, or GRC_
             HumanMessage(content=classification_prompt)
         ]
 
-        response = llm.invoke(classification_messages)
+        with observe_stage("classify_llm"):
+            response = await llm.ainvoke(classification_messages)
         category = response.content.strip().upper()
 
         # Ensure the category exists in our configuration
@@ -150,14 +232,126 @@ Respond with ONLY the category name (GRC_SPECIFIC, GRC_GENERAL, NON_GRC, or GRC_
         return category
 
     except Exception as e:
-        # If classification fails, default to GRC_SPECIFIC
+        # If classification fails, the caller defaults to GRC_SPECIFIC
         print(f"Pre-filter error: {e}")
+        return None
+
+
+# Gemini classifications of confident queries run as background tasks, only to measure
+# agreement. The loop only keeps weak references to tasks, these hold them until they finish
+background_tasks = set()
+
+def run_in_background(coroutine):
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def shadow_classify(query: str, local_category: str):
+    llm_category = await llm_classify_query(query)
+    if llm_category is not None:
+        query_classifier.record_comparison("shadow", local_category, llm_category)
+
+
+async def pre_filter_query(query: str, on_llm_fallback: Callable[[], Any] = None):
+    """
+    Pre-filter queries to determine processing branch. The local classifier decides
+    when it is confident enough, otherwise Gemini does (see query_classifier.py).
+    on_llm_fallback is called just before Gemini is asked.
+    """
+    local_category, confidence = None, 0.0
+    try:
+        with observe_stage("classify_local"):
+            local_category, confidence = await run_in_threadpool(query_classifier.classify, query)
+    except Exception as e:
+        print(f"Local classifier error: {e}")
+
+    if local_category is not None and confidence >= query_classifier.threshold:
+        query_classifier.record_decision("local")
+        if random.random() < CLASSIFIER_SHADOW_RATE:
+            run_in_background(shadow_classify(query, local_category))
+        print(f"Pre-filter classification: {local_category} (local, {confidence:.2f})")
+        return local_category
+
+    if on_llm_fallback is not None:
+        on_llm_fallback()
+    category = await llm_classify_query(query)
+    if category is None:
+        query_classifier.record_decision("fallback")
         return "GRC_SPECIFIC"
+    query_classifier.record_decision("llm")
+    if local_category is not None:
+        query_classifier.record_comparison("low_confidence", local_category, category)
+    return category
+
+
+
+
+# ============= SPECULATIVE RETRIEVAL ==============================
+# The retrieval of the default branch (GRC_SPECIFIC) is started alongside classification
+# so it doesn't wait for the Gemini call. The branch's retrieval node reuses the result
+# instead of going through the retrieve tool again, any other branch throws it away.
+# SPECULATIVE_RETRIEVAL is off, uncertain (only when the local classifier isn't sure and
+# Gemini is asked, the local classifier alone is too quick to overlap with) or always.
+SPECULATIVE_MODE = os.getenv("SPECULATIVE_RETRIEVAL", "uncertain")
+SPECULATIVE_BRANCH = "GRC_SPECIFIC"
+
+async def run_speculative_retrieval(query: str, k: int) -> Dict[str, Any]:
+    start = time.perf_counter()
+    content, artifact = await retrieve.coroutine(query=query, k=k)
+    return {"query": query, "k": k, "content": content, "artifact": artifact, "seconds": time.perf_counter() - start}
+
+def count_wasted_speculation(task):
+    if task.cancelled():
+        SPECULATIVE_RETRIEVAL.labels("cancelled").inc()
+        return
+    if task.exception() is not None:
+        SPECULATIVE_RETRIEVAL.labels("failed").inc()
+        return
+    SPECULATIVE_RETRIEVAL.labels("wasted").inc()
+    SPECULATION_WASTED_SECONDS.inc(task.result()["seconds"])
+
+class SpeculativeRetrieval:
+    def __init__(self, query: str):
+        self.query = query
+        self.k = QUERY_BRANCHES[SPECULATIVE_BRANCH]["retrieval_k"]
+        self.task = None
+
+    def start(self):
+        if self.task is None:
+            self.task = run_in_background(run_speculative_retrieval(self.query, self.k))
+
+    def keep_for(self, category: str) -> bool:
+        """Whether the branch picked can use the retrieval, otherwise it is dropped."""
+        if self.task is None:
+            return False
+        if category == SPECULATIVE_BRANCH:
+            return True
+        # The search runs on a worker thread, which can't be interrupted, so it is left to
+        # finish and its time is counted as wasted
+        self.task.add_done_callback(count_wasted_speculation)
+        return False
+
+    async def result(self, query: str, k: int) -> Optional[Dict[str, Any]]:
+        """The retrieval for query and k, None if it was for something else or failed."""
+        if query != self.query or k != self.k:
+            self.keep_for(None)
+            return None
+        try:
+            result = await self.task
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Speculative retrieval error: {e}")
+            SPECULATIVE_RETRIEVAL.labels("failed").inc()
+            return None
+        SPECULATIVE_RETRIEVAL.labels("used").inc()
+        return result
 
 
 def create_branch_retrieval_node(branch_name: str):
     """Create a retrieval node for a specific branch."""
-    def branch_retrieval(state: QueryMessagesState):
+    async def branch_retrieval(state: QueryMessagesState):
         branch_config = QUERY_BRANCHES[branch_name]
         if not branch_config["has_retrieval"]:
             # Skip retrieval for this branch
@@ -184,6 +378,18 @@ def create_branch_retrieval_node(branch_name: str):
             }]
         )
 
+        # Retrieval started during classification, answer the tool call with it and skip the tools node
+        speculation = state.get("speculative_retrieval")
+        result = await speculation.result(latest_human_message.content, branch_config["retrieval_k"]) if speculation else None
+        if result is not None:
+            tool_message = ToolMessage(
+                content=result["content"],
+                artifact=result["artifact"],
+                tool_call_id=tool_call_id,
+                name="retrieve",
+            )
+            return {"messages": state["messages"] + [retrieval_message, tool_message]}
+
         return {
             "messages": state["messages"] + [retrieval_message]
         }
@@ -193,7 +399,7 @@ def create_branch_retrieval_node(branch_name: str):
 
 def create_branch_generate_node(branch_name: str):
     """Create a generate node for a specific branch."""
-    def branch_generate(state: QueryMessagesState):
+    async def branch_generate(state: QueryMessagesState):
         branch_config = QUERY_BRANCHES[branch_name]
 
         # Get filter message
@@ -231,13 +437,18 @@ def create_branch_generate_node(branch_name: str):
             elif message.type == "ai" and not getattr(message, "tool_calls", None):
                 conversation_messages.append(message)
 
+        # Older turns only reach the llm through the rolling summary
+        if state.get("conversation_summary"):
+            system_prompt += f"\n\nSummary of the earlier conversation: {state['conversation_summary']}"
+
         prompt = [SystemMessage(content=system_prompt)] + conversation_messages
 
         print(f"Generating response for branch: {branch_name}")
         print(f"Prompt for {branch_name} branch: {prompt}")
 
         # Run llm
-        response = llm.invoke(prompt)
+        with observe_stage("generate_llm"):
+            response = await llm.ainvoke(prompt)
         return {"messages": [response]}
 
     return branch_generate
@@ -342,6 +553,8 @@ Always end responses with: "Would you like me to explore any aspect of this resp
 # Class that allows for query_classification to be stored in state
 class QueryMessagesState(MessagesState):
     query_classification: str = "GRC_SPECIFIC"
+    conversation_summary: str = None
+    speculative_retrieval: Optional[SpeculativeRetrieval] = None
 
 
 # =============  LONGFORM RETRIEVAL AND EXECUTION ==============================
@@ -401,24 +614,25 @@ Only return a list of such JSON objects, without any extra commentary, explanati
 """
 
 
-def retrieve_context(query: str, k: int = 8, search_filter: Filter = None) -> str:
-    """Retrieve information related to a query."""
+def retrieve_context(queries: List[str], k: int = 8, search_filter: Filter = None) -> str:
+    """Retrieve information related to the search strings of a query, their results are fused."""
     # Query qdrant directly
+    qdrant_client = registry.qdrant_client
     if not qdrant_client:
         raise ValueError("Qdrant client is not initialized. Please set the QDRANT_CONNECT environment variable.")
     results = None
 
-    results = crossEncoderQuery(
+    results = multiStringCrossEncoderQuery(
         qdrant_client=qdrant_client,
-        query=query,
+        queries=queries,
         collection_name=COLLECTION_NAME,
         k=k,
         search_filter = search_filter 
     )
-    if not results:
-        results = crossEncoderQuery(
+    if not results and search_filter is not None:
+        results = multiStringCrossEncoderQuery(
             qdrant_client=qdrant_client,
-            query=query,
+            queries=queries,
             collection_name=COLLECTION_NAME,
             k=k,
             search_filter=None  # Fallback without filter
@@ -439,8 +653,9 @@ def retrieve_context(query: str, k: int = 8, search_filter: Filter = None) -> st
     )
     return serialized, retrieved_docs
 
-def getFormattedQuery(subquery: Dict[str, Any]):
-    search_strings = subquery.get("search_strings", [])
+async def getFormattedQuery(subquery: Dict[str, Any]):
+    # Every search string is searched, a subquery without any is searched as written
+    search_strings = subquery.get("search_strings") or [subquery.get("subquery", "")]
     proceeding_ids = subquery.get("proceeding_id", []) # list of potential IDs to search through
     subquery_text = subquery.get("subquery", "")
 
@@ -464,8 +679,10 @@ def getFormattedQuery(subquery: Dict[str, Any]):
             ]
         )
 
-    search_result = retrieve_context(
-        query=search_strings[0], # use first string for retrieval, will modify later to use all and combine
+    # Embedding, search and reranking block, run them on a worker thread
+    search_result = await run_in_threadpool(
+        retrieve_context,
+        queries=search_strings,
         k=8,
         search_filter = query_filter
     )
@@ -532,7 +749,21 @@ def getFormattedQuery(subquery: Dict[str, Any]):
 
     return formatted_query
 
-async def process_subqueries(original_query:str, subqueries: str):
+# Longform progress hook, called as on_progress(stage, done, total) e.g. ("subqueries", 2, 5)
+ProgressCallback = Callable[[str, int, int], None]
+# Longform section hook, called as on_section(index, subquery, answer) as each subquery is answered
+SectionCallback = Callable[[int, str, str], None]
+
+# progressive streams each subquery's answer as a section event as soon as it is ready and
+# then the synthesis token by token, final sends only the synthesized essay once it is done
+LONGFORM_STREAMING = os.getenv("LONGFORM_STREAMING", "progressive")
+
+def report_progress(on_progress: Optional[ProgressCallback], stage: str, done: int = 0, total: int = 0):
+    if on_progress is not None:
+        on_progress(stage, done, total)
+
+async def process_subqueries(original_query:str, subqueries: str, on_progress: ProgressCallback = None,
+                             on_section: SectionCallback = None):
     """
     Process the subqueries to ensure they are in the correct format.
     """
@@ -553,17 +784,20 @@ async def process_subqueries(original_query:str, subqueries: str):
     combined_responses = ''
     queries = []
 
-    for i,item in enumerate(response_json):
+    # The retrievals of all subqueries run at once, longform waits for the slowest rather than their sum
+    prompts = await asyncio.gather(*(getFormattedQuery(item) for item in response_json))
+    for i,(item, prompt) in enumerate(zip(response_json, prompts)):
         queries.append(
             {
             'query': item['subquery'],
             'index': i,
-            'prompt': getFormattedQuery(item)
+            'prompt': prompt
             }
         )
     print(queries)
-    combined_queries =  await multiThreadedQueries(queries)
+    combined_queries =  await multiThreadedQueries(queries, on_progress, on_section)
     formatted_return = '\n\n'.join(combined_queries)
+    report_progress(on_progress, "synthesizing")
     answer = await combineSubqueries(original_query, formatted_return)
 
     return answer
@@ -589,16 +823,21 @@ async def combineSubqueries(original_query:str, formatted_answers: str):
 
     final_prompt = combine_queries_prompt + formatted_answers
     messages = [HumanMessage(content=final_prompt)]
-    result = llm.invoke(messages)
+    # ainvoke so the synthesis call is cancelled with the request instead of blocking the loop,
+    # the metadata lets streamAIResponse tell its tokens from the other longform calls
+    with observe_stage("longform_synthesis"):
+        result = await llm.ainvoke(messages, config={"metadata": {"longform_stage": "synthesis"}})
     return result if isinstance(result, AIMessage) else AIMessage(content="Failed to synthesize subqueries.")
     
 
 
 @retry(
     wait=wait_exponential(multiplier=1, min=4, max=10),
-    stop=stop_after_attempt(3)
+    stop=stop_after_attempt(3),
+    before_sleep=count_retry("longform_subquery")
 )
 async def asyncQueryLLM(query: Dict[str, Any]) -> str:
+    """Answer of one subquery."""
     prompt = query.get('prompt', "")
 
     if not prompt:
@@ -606,38 +845,57 @@ async def asyncQueryLLM(query: Dict[str, Any]) -> str:
 
     try:
         messages = [HumanMessage(content=prompt)]
-        response = await llm.ainvoke(messages)
-        llm_response = response.content if isinstance(response, AIMessage) else "Failed to retrieve response for Subquery\n"
-        
-        formatted_response = f"""
-        Subquery {query['index'] + 1}:\n{query["query"]}\nGenerated Response:\n{llm_response}\n
-        """
-        return formatted_response
+        with observe_stage("longform_subquery_llm"):
+            response = await llm.ainvoke(messages)
+        return response.content if isinstance(response, AIMessage) else "Failed to retrieve response for Subquery\n"
 
     except Exception as e:
         print(f"Error querying LLM: {e}")
         raise e
 
-async def multiThreadedQueries(queries: List[str]):
-    tasks = []
+def format_subquery_answer(query: Dict[str, Any], answer: str) -> str:
+    return f"""
+        Subquery {query['index'] + 1}:\n{query["query"]}\nGenerated Response:\n{answer}\n
+        """
+
+async def multiThreadedQueries(queries: List[Dict[str, Any]], on_progress: ProgressCallback = None,
+                               on_section: SectionCallback = None):
+    """Answers of the subqueries in subquery order, each is passed to on_section as soon as it is ready."""
+    tasks = {}
     for query in queries:
-        tasks.append(asyncQueryLLM(query))
-    
-    results = []
+        tasks[asyncio.create_task(asyncQueryLLM(query))] = query
 
-    for future in asyncio.as_completed(tasks):
-        try:
-            result = await future
-            results.append(result)
-        except RetryError as e:
-            print(f"RetryError in async task: {e}")
-            results.append("Error processing subquery after retries.")
-        except Exception as e:
-            print(f"Error in async task: {e}")
-            results.append("Error processing subquery.")
+    results = [None] * len(queries)
+    done = 0
+    report_progress(on_progress, "subqueries", 0, len(tasks))
+
+    try:
+        pending = set(tasks)
+        while pending:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                query = tasks[task]
+                try:
+                    answer = task.result()
+                except RetryError as e:
+                    print(f"RetryError in async task: {e}")
+                    answer = "Error processing subquery after retries."
+                except Exception as e:
+                    print(f"Error in async task: {e}")
+                    answer = "Error processing subquery."
+                results[query['index']] = format_subquery_answer(query, answer)
+                done += 1
+                if on_section is not None:
+                    on_section(query['index'], query['query'], answer)
+                report_progress(on_progress, "subqueries", done, len(tasks))
+    finally:
+        # asyncio.wait doesn't cancel the subqueries when the request is cancelled, stop the rest here
+        pending = [task for task in tasks if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            WORK_CANCELLED.labels("longform_subquery").inc(len(pending))
 
-    # sort by query index
-    results.sort(key=lambda x: int(re.search(r'Subquery (\d+):', x).group(1)) - 1)
     return results
 
 
@@ -662,30 +920,84 @@ async def execute_longform(state: QueryMessagesState) -> Dict[str, Any]:
     query = latest_human_message.content
     retrieval_k = branch_config["retrieval_k"]
 
+    on_section = None
+    if LONGFORM_STREAMING == "progressive":
+        # Sections go out on the graph's custom stream, a no-op unless it is streamed with "custom"
+        write = get_stream_writer()
+        on_section = lambda index, subquery, answer: write(
+            {"type": "section", "index": index, "subquery": subquery, "content": answer}
+        )
+
+    history = [m for m in state["messages"] if m is not latest_human_message and isinstance(m, (HumanMessage, AIMessage))]
+    answer = await run_longform(
+        query, on_section=on_section, history=history, summary=state.get("conversation_summary")
+    )
+    return {"messages": [answer]}
+
+def format_longform_context(history: List = None, summary: str = None) -> str:
+    """The earlier conversation as text for the decomposition prompt, empty for a new conversation."""
+    lines = []
+    if summary:
+        lines.append(f"Summary: {summary}")
+    for message in history or []:
+        speaker = "User" if isinstance(message, HumanMessage) else "Assistant"
+        lines.append(f"{speaker}: {truncate_message(message.content)}")
+    return "\n".join(lines)
+
+async def run_longform(query: str, on_progress: ProgressCallback = None, on_section: SectionCallback = None,
+                       history: List = None, summary: str = None) -> AIMessage:
+    """
+    Answer query with the longform pipeline: decompose it into subqueries, answer those
+    concurrently and synthesize one essay. Used by the graph and by background jobs (jobs.py).
+    history and summary are the conversation context from memory.load_context, they let the
+    subqueries resolve what a follow up question refers to.
+    """
     # EXECUTE LONGFORM
-    combined_prompt = SUBQUERY_PROMPT + f"\nUser Query: {query}\n"
+    combined_prompt = SUBQUERY_PROMPT
+    context = format_longform_context(history, summary)
+    if context:
+        combined_prompt += f"\nEarlier conversation, only use it to understand what the user query refers to:\n{context}\n"
+    combined_prompt += f"\nUser Query: {query}\n"
     # Get subquery generated by LLM
-    response = await llm.ainvoke([HumanMessage(content=combined_prompt)])
+    report_progress(on_progress, "decomposing")
+    with observe_stage("longform_decompose"):
+        response = await llm.ainvoke([HumanMessage(content=combined_prompt)])
 
-    answer = await process_subqueries(query, response.content)
+    answer = await process_subqueries(query, response.content, on_progress, on_section)
     if not answer:
         answer = AIMessage(content="I'm sorry, I couldn't generate a response for your query.")
-    return {"messages": [answer]}
+    return answer
 #####################################################################
 # Build the graph
 def build_graph():
     graph_builder = StateGraph(QueryMessagesState)
 
     # Node to classify the user's query
-    def classifier_node(state: QueryMessagesState):
+    async def classifier_node(state: QueryMessagesState):
         """Classify the query and add classification to state metadata."""
         latest_human_message = next((m for m in reversed(state["messages"]) if isinstance(m, HumanMessage)), None)
 
         if not latest_human_message:
             return {"messages": state["messages"], "query_classification": "GRC_SPECIFIC"}
 
-        category = pre_filter_query(latest_human_message.content)
-        return {"messages": state["messages"], "query_classification": category}
+        # Classified before the graph ran (see classify_message), keep that branch
+        if state.get("query_classification"):
+            return {"messages": state["messages"], "query_classification": state["query_classification"]}
+
+        speculation = None
+        if SPECULATIVE_MODE in ("uncertain", "always"):
+            speculation = SpeculativeRetrieval(latest_human_message.content)
+            if SPECULATIVE_MODE == "always":
+                speculation.start()
+
+        category = await pre_filter_query(
+            latest_human_message.content,
+            on_llm_fallback=speculation.start if speculation else None,
+        )
+        QUERY_BRANCH.labels(category).inc()
+        if speculation is not None and not speculation.keep_for(category):
+            speculation = None
+        return {"messages": state["messages"], "query_classification": category, "speculative_retrieval": speculation}
 
     def route_to_branch(state: QueryMessagesState):
         print(f"State passed to route_to_branch: {state}")
@@ -698,9 +1010,9 @@ def build_graph():
             return f"retrieve_{classification.lower()}"
 
     # Set up the graph connections
-    graph_builder.add_node("classifier", classifier_node)
+    graph_builder.add_node("classifier", timed_node("classifier", classifier_node))
     graph_builder.add_node("tools", ToolNode([retrieve]))
-    graph_builder.add_node("execute_longform", execute_longform)
+    graph_builder.add_node("execute_longform", timed_node("execute_longform", execute_longform))
 
     # Dynamically create and connect nodes for all standard branches
     for branch_name, config in QUERY_BRANCHES.items():
@@ -708,15 +1020,19 @@ def build_graph():
             continue
 
         retrieval_node_name = f"retrieve_{branch_name.lower()}"
-        graph_builder.add_node(retrieval_node_name, create_branch_retrieval_node(branch_name))
+        graph_builder.add_node(retrieval_node_name, timed_node(retrieval_node_name, create_branch_retrieval_node(branch_name)))
 
         generate_node_name = f"generate_{branch_name.lower()}"
-        graph_builder.add_node(generate_node_name, create_branch_generate_node(branch_name))
+        graph_builder.add_node(generate_node_name, timed_node(generate_node_name, create_branch_generate_node(branch_name)))
 
         # Connect edges for standard branches
         if config["has_retrieval"]:
-            # Path for branches that use the ToolNode
-            graph_builder.add_edge(retrieval_node_name, "tools")
+            # Path for branches that use the ToolNode, unless a speculative retrieval already answered the tool call
+            graph_builder.add_conditional_edges(
+                retrieval_node_name,
+                lambda state, generate_node_name=generate_node_name: generate_node_name if state["messages"][-1].type == "tool" else "tools",
+                ["tools", generate_node_name],
+            )
             graph_builder.add_edge("tools", generate_node_name)
         else:
             # Path for branches that do not use tools
@@ -734,8 +1050,16 @@ def build_graph():
 
     return graph_builder.compile()
 
-# Initialize the graph
-graph = build_graph()
+def get_graph():
+    """The compiled graph, loads the registry first when running outside the API (console, scripts)."""
+    if registry.graph is None:
+        registry.load(build_graph)
+    return registry.graph
+
+
+async def collect_graph_steps(graph_input: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Every state the graph goes through for graph_input, the nodes are async so it runs on an event loop."""
+    return [step async for step in get_graph().astream(graph_input, stream_mode="values")]
 
 
 def process_query(query: str, session_id: str, retrieval_k: int = 8, enable_prefilter: bool = True) -> Dict[str, Any]:
@@ -753,20 +1077,13 @@ def process_query(query: str, session_id: str, retrieval_k: int = 8, enable_pref
     # Get chat history
     history = chat_manager.get_history(session_id)
 
-    # Format messages
+    # Format messages, tool outputs are not replayed so the context stays a fixed size
     messages = []
     for msg in history:
         if msg["role"] == "user":
-            messages.append(HumanMessage(content=msg["content"]))
+            messages.append(HumanMessage(content=truncate_message(msg["content"])))
         elif msg["role"] == "assistant":
-            messages.append(AIMessage(content=msg["content"]))
-        elif msg["role"] == "tool":
-            # Create a tool message with appropriate attributes and a tool_call_id
-            messages.append(ToolMessage(
-                content=msg["content"],
-                name=msg.get("tool_name", "retrieve"),
-                tool_call_id=msg.get("tool_call_id", str(uuid.uuid4()))
-            ))
+            messages.append(AIMessage(content=truncate_message(msg["content"])))
 
     # Add the current query
     messages.append(HumanMessage(content=query))
@@ -778,10 +1095,10 @@ def process_query(query: str, session_id: str, retrieval_k: int = 8, enable_pref
 
     # Process the query through the graph
     with io.StringIO() as buf, redirect_stdout(buf):
-        for step in graph.stream(
-            {"messages": messages},
-            stream_mode="values",
-        ):
+        steps = asyncio.run(collect_graph_steps(
+            {"messages": messages, "conversation_summary": chat_manager.get_summary(session_id)}
+        ))
+        for step in steps:
             # Get classification if available
             if "query_classification" in step:
                 query_classification = step["query_classification"]
@@ -800,17 +1117,9 @@ def process_query(query: str, session_id: str, retrieval_k: int = 8, enable_pref
     end_time = time.time()
     elapsed_time = end_time - start_time
 
-    # Add messages to chat history (excluding classification messages)
+    # Add messages to chat history (excluding classification and tool messages)
     chat_manager.add_message(session_id, {"role": "user", "content": query})
 
-    # Add tool messages to history
-    for tool_output in tool_outputs:
-        chat_manager.add_message(session_id, {
-            "role": "tool",
-            "content": tool_output["content"],
-            "tool_name": tool_output.get("tool_name", "retrieve")
-        })
-
     if result:
         chat_manager.add_message(session_id, {"role": "assistant", "content": result})
 
@@ -884,15 +1193,76 @@ class LLMChatSession():
         clear_chat_history(self.session_id)
         return out
 
-async def getAIResponse(message: str):
+def build_graph_input(message: str, history: List = None, summary: str = None, classification: str = None) -> Dict[str, Any]:
+    """history holds the recent turns as Human/AI messages, oldest first. classification skips the classifier."""
+    graph_input = {
+        "messages": (history or []) + [HumanMessage(content=message)],
+        "conversation_summary": summary,
+    }
+    if classification:
+        graph_input["query_classification"] = classification
+    return graph_input
+
+# Answers only depend on the query itself when there is no earlier conversation,
+# so only those are served from / stored in the answer cache
+def is_cacheable(history: List = None, summary: str = None) -> bool:
+    return not history and not summary
+
+def cache_answer(message: str, state: Dict[str, Any], content: str) -> None:
+    branch = state.get("query_classification") or "GRC_SPECIFIC"
+    answer_cache.set(message, branch, COLLECTION_NAME, {
+        "role": "ai",
+        "content": content,
+        "query_classification": branch,
+    })
+
+# Identical queries that arrive while one is already running share its graph run
+response_flight = SingleFlight("getAIResponse")
+
+def coalesce_key(message: str, history: List = None, summary: str = None) -> str:
+    """Requests only share a run if the query, collection and conversation context all match."""
+    context = hashlib.sha256()
+    context.update((summary or "").encode())
+    for msg in history or []:
+        context.update(f"{msg.type}:{msg.content}".encode())
+    return f"{COLLECTION_NAME}:{hash_query(message)}:{context.hexdigest()}"
+
+async def classify_message(message: str, history: List = None, summary: str = None) -> Optional[str]:
+    """
+    Branch a message will take, classified before the graph runs so the API can hand
+    GRC_LONGFORM answers to a background job. Pass it on to getAIResponse so the graph
+    doesn't classify again. None when the answer is cached, getAIResponse serves those.
+    """
+    if is_cacheable(history, summary) and answer_cache.contains(message, COLLECTION_NAME):
+        return None
+    category = await pre_filter_query(message)
+    QUERY_BRANCH.labels(category).inc()
+    return category
+
+async def getAIResponse(message: str, history: List = None, summary: str = None, classification: str = None):
 
     start_time = time.time()
 
-    # Go through the graph
-    result = await graph.ainvoke(
-        {"messages": [{"role": "user", "content": message}]}
+    use_cache = is_cacheable(history, summary)
+    if use_cache:
+        cached = answer_cache.get(message, COLLECTION_NAME)
+        if cached:
+            return {**cached, "elapsed_time": f"{time.time() - start_time:.2f} seconds", "cached": True}
+
+    return await response_flight.do(
+        coalesce_key(message, history, summary),
+        lambda: runGraph(message, history, summary, use_cache, classification),
+        label=normalize_query(message)[:80]
     )
 
+async def runGraph(message: str, history: List = None, summary: str = None, use_cache: bool = False,
+                   classification: str = None):
+
+    start_time = time.time()
+
+    # Go through the graph
+    result = await get_graph().ainvoke(build_graph_input(message, history, summary, classification))
+
     # Extract response
     ai_messages = [msg for msg in result["messages"] if msg.type == "ai" and not msg.tool_calls]
 
@@ -905,6 +1275,8 @@ async def getAIResponse(message: str):
             "content": ai_messages[-1].content,
             "elapsed_time": f"{elapsed_time:.2f} seconds"
         }
+        if use_cache:
+            cache_answer(message, result, response["content"])
     else:
         response = {
             "role": "ai",
@@ -914,7 +1286,96 @@ async def getAIResponse(message: str):
     
     return response
 
+
+# Only tokens produced by the generate nodes (and the longform synthesis, when streaming
+# progressively) are part of the answer, the classifier, retrieval and the other longform
+# calls also use the llm but their output is internal
+def is_answer_node(metadata: Dict[str, Any]) -> bool:
+    if LONGFORM_STREAMING == "progressive" and metadata.get("longform_stage") == "synthesis":
+        return True
+    return metadata.get("langgraph_node", "").startswith("generate_")
+
+async def streamAIResponse(message: str, history: List = None, summary: str = None):
+    """
+    Stream the graph run for a message, with optional conversation context.
+
+    Yields {"type": "token", "content": ...} events as the generate node produces
+    tokens, followed by one {"type": "done", ...} event holding the full answer,
+    the branch used, time to first token and total latency (seconds). Longform
+    answers streamed progressively first yield a {"type": "section", "index": ...,
+    "subquery": ..., "content": ...} event per subquery as it is answered (in the
+    order they finish), then the synthesized essay's tokens.
+    """
+    start_time = time.perf_counter()
+    first_token_time = None
+    streamed_tokens = False
+    final_state = None
+
+    use_cache = is_cacheable(history, summary)
+    cached = answer_cache.get(message, COLLECTION_NAME) if use_cache else None
+    if cached:
+        elapsed_time = round(time.perf_counter() - start_time, 3)
+        yield {"type": "token", "content": cached["content"]}
+        yield {
+            "type": "done",
+            "content": cached["content"],
+            "query_classification": cached.get("query_classification"),
+            "time_to_first_token": elapsed_time,
+            "elapsed_time": elapsed_time,
+            "cached": True,
+        }
+        return
+
+    async for mode, chunk in get_graph().astream(
+        build_graph_input(message, history, summary),
+        stream_mode=["messages", "values", "custom"],
+    ):
+        if mode == "values":
+            final_state = chunk
+            continue
+
+        if mode == "custom":
+            if chunk.get("type") == "section":
+                # A finished section is the first useful content of a longform answer
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start_time
+                yield chunk
+            continue
+
+        token, metadata = chunk
+        if not is_answer_node(metadata) or getattr(token, "tool_calls", None):
+            continue
+        if not isinstance(token.content, str) or not token.content:
+            continue
+
+        if first_token_time is None:
+            first_token_time = time.perf_counter() - start_time
+        streamed_tokens = True
+        yield {"type": "token", "content": token.content}
+
+    ai_messages = []
+    if final_state:
+        ai_messages = [msg for msg in final_state["messages"] if msg.type == "ai" and not msg.tool_calls]
+    content = ai_messages[-1].content if ai_messages else "Could not generate response."
+    if ai_messages and use_cache:
+        cache_answer(message, final_state, content)
+
+    # Branches that don't stream from a generate node (longform) send the answer in one piece
+    if not streamed_tokens:
+        if first_token_time is None:
+            first_token_time = time.perf_counter() - start_time
+        yield {"type": "token", "content": content}
+
+    yield {
+        "type": "done",
+        "content": content,
+        "query_classification": final_state.get("query_classification") if final_state else None,
+        "time_to_first_token": round(first_token_time, 3),
+        "elapsed_time": round(time.perf_counter() - start_time, 3),
+        "cached": False,
+    }
+
 if __name__ == "__main__":
     # use this to test the api call and ensure everything is initialized
     test_message = 'What is the revenue requirement for PG&E in the 2023 GRC?'
-    print(getAIResponse("Tell me about the 2023 GRC for PG&E"))
+    print(asyncio.run(getAIResponse("Tell me about the 2023 GRC for PG&E")))
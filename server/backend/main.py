@@ -1,18 +1,81 @@
-from fastapi import FastAPI, Depends, HTTPException, Path
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Depends, HTTPException, Path, Query, Request, Response, Header
+from sqlalchemy import delete, func, select, text
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List
+from datetime import datetime
 import uuid
-from datetime import datetime, timezone
+from contextlib import asynccontextmanager
 from fastapi.middleware.cors import CORSMiddleware
-from models import Conversation, Message, SessionLocal
-from schemas import ConversationCreate, MessageCreate, ConversationResponse, MessageResponse, TitleUpdate
-from fastapi.responses import JSONResponse
+from models import Conversation, Message, SessionLocal, engine, init_models, to_db_timestamp, utc_now
+from schemas import ConversationCreate, MessageCreate, ConversationResponse, ConversationPreviewResponse, MessageResponse, MessageSearchResult, TitleUpdate, JobResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
-from llm import getAIResponse
-import logging
+from llm import getAIResponse, streamAIResponse, build_graph, classify_message, COLLECTION_NAME, response_flight
+from registry import registry
 from starlette.concurrency import run_in_threadpool
+from answer_cache import answer_cache
+from admission import admission, AdmissionRejected, PRIORITY_BACKGROUND, PRIORITY_STREAM
+from metrics import render_metrics, update_process_gauges, CHAT_LATENCY, CHAT_TIME_TO_FIRST_TOKEN, REQUESTS_CANCELLED
+from memory import load_context, schedule_summary_update
+from message_writer import message_writer
+from idempotency import idempotency, request_fingerprint, IdempotencyConflict
+from export import stream_export, EXPORT_FORMATS
+from search import search_query, DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT, MAX_SEARCH_OFFSET
+from jobs import jobs, LONGFORM, INGEST, COMPLETED as JOB_COMPLETED, FINISHED as JOB_FINISHED
+from ingestion import receive_upload, upload_doc_args, UploadRejected
+from pdf_cache import pdf_cache, PdfUnavailable
+from migrate import run_migrations
+from archive import archiver, ARCHIVED_BEFORE_HEADER
+from query_classifier import query_classifier
+from pagination import decode_cursor, keyset_page, split_page, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, NEXT_CURSOR_HEADER
+import asyncio
+import hmac
+import logging
+import json
+import os
+import time
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+
+# Set on responses replayed from a stored Idempotency-Key result
+IDEMPOTENT_REPLAY_HEADER = "Idempotent-Replayed"
+
+# How often a running chat request checks that its client is still connected (seconds)
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.5))
+# How long a request with an Idempotency-Key keeps running after its client left, in case the client retries
+DISCONNECT_RETRY_GRACE = float(os.getenv("DISCONNECT_RETRY_GRACE", 2))
+
+# Characters of the latest message returned as a conversation's preview
+PREVIEW_CHARS = 200
+
+# Seconds browsers may reuse a cached PDF without revalidating it
+PDF_MAX_AGE = 86400
+
+# Token required by the /admin endpoints. While it is unset every admin request is refused
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with registry.phase("database"):
+        await init_models()
+        await run_migrations()
+        await archiver.start()
+    # Model loading and warmup are blocking, keep them off the event loop
+    await run_in_threadpool(registry.load, build_graph)
+    await run_in_threadpool(registry.warmup)
+    message_writer.start()
+    idempotency.start()
+    await jobs.start()
+    logging.info(f"Startup complete: {', '.join(f'{k} {v:.2f}s' for k, v in registry.startup_timings.items())}")
+    yield
+    await archiver.stop()
+    await jobs.stop()
+    await idempotency.stop()
+    # Flush queued messages before the pool goes away
+    await message_writer.stop()
+    await engine.dispose()
+
+app = FastAPI(lifespan=lifespan)
 # Allow all origins for development purposes
 app.add_middleware(
     CORSMiddleware,
@@ -20,75 +83,194 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allows all HTTP methods like GET, POST, etc.
     allow_headers=["*"],  # Allows all headers
+    # Lets the client read the pagination cursor, the archive cutoff, 429 backoff and replays, and pdf.js make range requests
+    expose_headers=[NEXT_CURSOR_HEADER, ARCHIVED_BEFORE_HEADER, "Retry-After", IDEMPOTENT_REPLAY_HEADER, "Accept-Ranges", "Content-Range", "Content-Length", "ETag"],
 )
 
-# Dependency to get database session
-def get_db():
-    db = SessionLocal()
-    try:
+# Overloaded requests get a fast 429 telling the client when to retry
+@app.exception_handler(AdmissionRejected)
+async def admission_rejected_handler(request, exc: AdmissionRejected):
+    return JSONResponse(
+        status_code=429,
+        content={"detail": f"Server is busy ({exc.reason}), please retry later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# Idempotency-Key reused for another request (422) or its first request is still running (409)
+@app.exception_handler(IdempotencyConflict)
+async def idempotency_conflict_handler(request, exc: IdempotencyConflict):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+class ClientDisconnected(Exception):
+    pass
+
+# Nobody is left to read the response, 499 is what nginx logs for a client closed request
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request, exc: ClientDisconnected):
+    return Response(status_code=499)
+
+# Bad document upload, e.g. not a PDF (415) or too large (413)
+@app.exception_handler(UploadRejected)
+async def upload_rejected_handler(request, exc: UploadRejected):
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail})
+
+# PDF that isn't available, 202 with a Retry-After while it is still being downloaded
+@app.exception_handler(PdfUnavailable)
+async def pdf_unavailable_handler(request, exc: PdfUnavailable):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after else None
+    return JSONResponse(status_code=exc.status_code, content={"detail": exc.detail}, headers=headers)
+
+# Dependency to get database session, one session per request
+async def get_db():
+    async with SessionLocal() as db:
         yield db
-    finally:
-        db.close()
+
+# Dependency guarding the /admin endpoints
+def require_admin(x_admin_token: str = Header(None)):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled, set ADMIN_TOKEN to enable them")
+    # Constant time, so the token can't be guessed from how long a wrong one takes to reject
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+# Liveness probe, the process is up and serving requests
+@app.get("/healthz", response_model=dict)
+async def healthz():
+    return {"status": "ok"}
+
+# Readiness probe, only route traffic here once models are loaded and warm and both databases respond
+@app.get("/readyz", response_model=dict)
+async def readyz(db: AsyncSession = Depends(get_db)):
+    checks = {
+        "models_loaded": registry.models_loaded(),
+        "warmed_up": registry.warmed_up,
+        "qdrant": await run_in_threadpool(registry.check_qdrant),
+    }
+    try:
+        await db.execute(text("SELECT 1"))
+        checks["postgres"] = True
+    except Exception as e:
+        logging.warning(f"Postgres readiness check failed: {e}")
+        checks["postgres"] = False
+
+    ready = all(checks.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "not ready", "checks": checks, "startup_timings": registry.startup_timings},
+    )
+
+# Prometheus scrape endpoint, per-stage latencies, branch counts, cache and Gemini error counters
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    admission.update_gauges()
+    update_process_gauges()
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
 
 # Post a conversation
 @app.post("/conversations", response_model=ConversationResponse)
-def create_conversation(conversation: ConversationCreate, db: Session = Depends(get_db)):
+async def create_conversation(conversation: ConversationCreate, db: AsyncSession = Depends(get_db)):
     conversation_id = str(uuid.uuid4())  # Generate unique ID for the conversation
     db_conversation = Conversation(
         id=conversation_id,
         user_id=conversation.user_id,
         title=conversation.title,
-        timestamp=conversation.timestamp
+        timestamp=to_db_timestamp(conversation.timestamp)
     )
     
     try:
         db.add(db_conversation)  # Add the conversation to the session
-        db.commit()  # Commit the transaction
-        db.refresh(db_conversation)  # Refresh the object to get the updated data (if any)
+        await db.commit()  # Commit the transaction
         return db_conversation  # Return the created conversation
     except Exception as e:
-        db.rollback()  # Rollback the transaction in case of error
+        await db.rollback()  # Rollback the transaction in case of error
         raise HTTPException(status_code=500, detail=f"Error creating conversation: {str(e)}")
 
-# Post a message to a conversation and llm
+# Post a message to a conversation and llm. A GRC_LONGFORM query is answered by a background job
+# instead, the response is a 202 with data.job_id, follow it like a job from POST /conversations/{id}/jobs
 @app.post("/conversations/{conversation_id}/messages", response_model=MessageResponse)
-async def add_message(conversation_id: str, message: MessageCreate, db: Session = Depends(get_db)):
-    db_conversation = await run_in_threadpool(
-        lambda: db.query(Conversation).filter(Conversation.id == conversation_id).first
-    ) 
+async def add_message(
+    conversation_id: str,
+    message: MessageCreate,
+    request: Request,
+    db: AsyncSession = Depends(get_db),
+    idempotency_key: str = Header(None)
+):
+    db_conversation = await db.get(Conversation, conversation_id)
     if not db_conversation:
         raise HTTPException(status_code=404, detail="Conversation not found")
-    
-    message_id = str(uuid.uuid4())
-    db_message = Message(
-        id=message_id,
-        conversation_id=conversation_id,
-        sender=message.sender,
-        message=message.message,
-        timestamp=message.timestamp
-    )
-    
-    # db.add(db_message)
-    await run_in_threadpool(db.add, db_message)  # Commit the transaction in a thread-safe manner
-    #db.commit()
-    await run_in_threadpool(db.commit)
 
-    ai_msg = await processUserQuery(message.message, conversation_id, db)
+    if idempotency_key is None:
+        content = await cancel_on_disconnect(request, answer_message(db, db_conversation, message), "message")
+        return JSONResponse(content=content, status_code=message_status(content))
+
+    # A retry with the same key gets the first request's response instead of another graph run
+    fingerprint = request_fingerprint(conversation_id, message.sender, message.message)
+    stored = await idempotency.begin(idempotency_key, fingerprint)
+    if stored is not None:
+        return JSONResponse(content=stored, status_code=200, headers={IDEMPOTENT_REPLAY_HEADER: "true"})
+
+    async def retry_attached():
+        # A client that timed out usually retries straight away, keep the run going for it
+        await asyncio.sleep(DISCONNECT_RETRY_GRACE)
+        return idempotency.has_waiters(idempotency_key)
+
+    try:
+        content = await cancel_on_disconnect(
+            request, answer_message(db, db_conversation, message), "message", keep_running=retry_attached
+        )
+    except BaseException:
+        await idempotency.release(idempotency_key)
+        raise
+    await idempotency.complete(idempotency_key, content)
+    return JSONResponse(content=content, status_code=message_status(content))
 
-    # db.add(ai_msg)
-    # db.commit()
-    # db.refresh(db_message) 
 
-    await run_in_threadpool(db.add, ai_msg)
-    await run_in_threadpool(db.commit)
-    await run_in_threadpool(db.refresh, db_message)
+# 202 when the answer is written by a longform job, see answer_message
+def message_status(content: dict) -> int:
+    return 202 if "job_id" in content["data"] else 200
 
-    return JSONResponse(content={
+
+async def answer_message(db: AsyncSession, db_conversation: Conversation, message: MessageCreate) -> dict:
+    conversation_id = db_conversation.id
+    # Admit before saving anything so a rejected request leaves no orphan user message
+    async with admission.admit(db_conversation.user_id):
+        message_id = str(uuid.uuid4())
+        db_message = Message(
+            id=message_id,
+            conversation_id=conversation_id,
+            sender=message.sender,
+            message=message.message,
+            timestamp=to_db_timestamp(message.timestamp)
+        )
+        # Queued for the writer's next group commit, neither message is waited on
+        message_writer.submit(db_message)
+
+        context = await load_context(db, db_conversation, exclude_message_id=message_id)
+        classification = await classify_message(message.message, context.get("history"), context.get("summary"))
+        if classification != "GRC_LONGFORM":
+            ai_msg = await processUserQuery(message.message, conversation_id, context, classification)
+
+    if classification == "GRC_LONGFORM":
+        # Essays take minutes, a job worker writes them instead of this request holding a slot.
+        # The job takes the message's id, it is the question it answers
+        job = await jobs.submit(LONGFORM, conversation_id, db_conversation.user_id, message.message, job_id=message_id)
+        return {
+            "response": "Longform answer queued",
+            "data": {
+                "job_id": job.id,
+                "status": job.status
+            }
+        }
+
+    schedule_summary_update(conversation_id, after=message_writer.submit(ai_msg))
+
+    return {
         "response": "Message saved successfully",
         "data": {
             "message": ai_msg.message
         }
-    }, status_code=200)
+    }
 
 
     # Run graph == This is the only connection to the AI that there should be
@@ -113,12 +295,260 @@ async def add_message(conversation_id: str, message: MessageCreate, db: Session
     # raise HTTPException(status_code=500, detail="No AI response generated.")
 
 
+# Post a message to a conversation and stream the llm reply back as server-sent events: token events,
+# section events for longform answers (see LONGFORM_STREAMING) and a final done event
+@app.post("/conversations/{conversation_id}/messages/stream")
+async def stream_message(conversation_id: str, message: MessageCreate, db: AsyncSession = Depends(get_db)):
+    db_conversation = await db.get(Conversation, conversation_id)
+    if not db_conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    # The slot is held until the stream ends, the response releases it however the stream ends
+    ticket = await admission.acquire(db_conversation.user_id, PRIORITY_STREAM)
+    try:
+        message_id = str(uuid.uuid4())
+        db_message = Message(
+            id=message_id,
+            conversation_id=conversation_id,
+            sender=message.sender,
+            message=message.message,
+            timestamp=to_db_timestamp(message.timestamp)
+        )
+        message_writer.submit(db_message)
+
+        context = await load_context(db, db_conversation, exclude_message_id=message_id)
+    except BaseException:
+        ticket.release()
+        raise
+
+    return AdmittedStreamingResponse(
+        streamUserQuery(message.message, conversation_id, context),
+        ticket,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse holding an admission slot until it is done. Background tasks don't run
+    when the client disconnects or the send fails, and a try/finally in the generator doesn't
+    run if the client leaves before the first chunk, so the slot is released around the whole
+    response instead.
+    """
+    def __init__(self, content, ticket, **kwargs):
+        super().__init__(content, **kwargs)
+        self.ticket = ticket
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.ticket.release()
+
+
+async def cancel_on_disconnect(request: Request, coro, endpoint: str, keep_running=None):
+    """
+    Await coro, cancelling it if the client disconnects first. Cancelling the task
+    cancels the graph run (or the single-flight wait, the shared run stops once nobody
+    is left waiting). keep_running is an optional async check, when it returns True
+    after a disconnect the run is allowed to finish anyway.
+    """
+    task = asyncio.ensure_future(coro)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return task.result()
+            if not await request.is_disconnected():
+                continue
+            if keep_running is not None and await keep_running():
+                return await task
+
+            logging.info(f"Client disconnected, cancelling {endpoint} request")
+            REQUESTS_CANCELLED.labels(endpoint).inc()
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            raise ClientDisconnected()
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+# Submit a message as a background longform job whatever it is classified as (POST /messages does the
+# same for queries classified as GRC_LONGFORM), the answer is written as an essay without
+# holding the request open. The user message takes the job's id. Poll GET /jobs/{id} or stream /jobs/{id}/events, then fetch /jobs/{id}/result
+@app.post("/conversations/{conversation_id}/jobs", response_model=JobResponse, status_code=202)
+async def submit_longform_job(conversation_id: str, message: MessageCreate, db: AsyncSession = Depends(get_db)):
+    db_conversation = await db.get(Conversation, conversation_id)
+    if not db_conversation:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+
+    # Jobs run on their own workers, they only count against the rate limits, not the request slots,
+    # and are turned away while requests are queued for a slot
+    admission.charge(db_conversation.user_id, PRIORITY_BACKGROUND)
+    job = await jobs.submit(LONGFORM, conversation_id, db_conversation.user_id, message.message)
+    message_writer.submit(Message(
+        id=job.id,
+        conversation_id=conversation_id,
+        sender=message.sender,
+        message=message.message,
+        timestamp=to_db_timestamp(message.timestamp)
+    ))
+    return job
+
+# Upload a PDF (multipart form, file plus optional proceeding_id, title, doc_type, published_date,
+# source_url and user_id fields). The file is streamed to disk and ingested by a background job,
+# follow it with GET /jobs/{id} or /jobs/{id}/events like any other job
+@app.post("/documents", response_model=JobResponse, status_code=202)
+async def upload_document(request: Request):
+    upload = await receive_upload(request)
+    fields = upload["fields"]
+    user_id = fields.get("user_id") or "anonymous"
+    try:
+        admission.charge(user_id, PRIORITY_BACKGROUND)
+        job = await jobs.submit(INGEST, None, user_id, json.dumps({
+            "path": upload["path"],
+            "doc_args": upload_doc_args(upload["document_id"], fields),
+        }))
+    except BaseException:
+        os.remove(upload["path"])
+        raise
+    logging.info(f"Queued ingestion of {upload['document_id']} ({fields.get('title')}) as job {job.id}")
+    return job
+
+# A cited document's PDF, from the local cache (downloaded from its source_url on the first request).
+# Supports Range requests so the viewer can load the pages it shows, and If-None-Match against the ETag
+@app.get("/documents/{document_id}/pdf")
+async def get_document_pdf(document_id: str, request: Request):
+    path = await pdf_cache.get(document_id)
+    # With the stat passed in the ETag and Last-Modified headers are set straight away
+    response = FileResponse(
+        path,
+        stat_result=os.stat(path),
+        media_type="application/pdf",
+        content_disposition_type="inline",
+        filename=f"{document_id}.pdf",
+        headers={"Cache-Control": f"public, max-age={PDF_MAX_AGE}"},
+    )
+    if response.headers["etag"] in request.headers.get("if-none-match", "").split(", "):
+        return Response(status_code=304, headers={"ETag": response.headers["etag"], "Cache-Control": response.headers["cache-control"]})
+    return response
+
+# Job status and progress
+@app.get("/jobs/{job_id}", response_model=JobResponse)
+async def get_job(job_id: str):
+    job = await jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    # Progress of a job running in this worker is ahead of what has been saved
+    response = JobResponse.model_validate(job, from_attributes=True)
+    return response.model_copy(update=await jobs.status(job_id))
+
+# Job progress as server-sent events, one progress event per change and a final done or error event
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    if not await jobs.get(job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def events():
+        async for state in jobs.events(job_id):
+            if state["status"] not in JOB_FINISHED:
+                yield format_sse("progress", state)
+            elif state["status"] == JOB_COMPLETED:
+                yield format_sse("done", state)
+            else:
+                yield format_sse("error", state)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Answer of a completed job
+@app.get("/jobs/{job_id}/result", response_model=dict)
+async def get_job_result(job_id: str):
+    job = await jobs.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.status != JOB_COMPLETED:
+        raise HTTPException(status_code=409, detail=f"Job is {job.status}" + (f": {job.error}" if job.error else ""))
+    return {"message_id": job.message_id, "message": job.result}
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# ====== Streaming version of processUserQuery, persists the AI message once the stream ends ======
+async def streamUserQuery(query: str, conversation_id: str, context: dict = None):
+    ai_msg = Message(
+        id=str(uuid.uuid4()),
+        conversation_id=conversation_id,
+        sender="ai",
+    )
+    try:
+        context = context or {}
+        async for event in streamAIResponse(query, context.get("history"), context.get("summary")):
+            if event["type"] == "token":
+                yield format_sse("token", {"content": event["content"]})
+                continue
+            if event["type"] == "section":
+                # A longform subquery's answer, sent while the rest are still being written
+                yield format_sse("section", {"index": event["index"], "subquery": event["subquery"], "content": event["content"]})
+                continue
+
+            ai_msg.message = event["content"]
+            ai_msg.timestamp = utc_now()
+            schedule_summary_update(conversation_id, after=message_writer.submit(ai_msg))
+
+            CHAT_TIME_TO_FIRST_TOKEN.observe(event["time_to_first_token"])
+            CHAT_LATENCY.labels("stream").observe(event["elapsed_time"])
+
+            logging.info(
+                f"Streamed reply for conversation {conversation_id} ({event['query_classification']}): "
+                f"first token {event['time_to_first_token']:.2f}s, total {event['elapsed_time']:.2f}s"
+            )
+            yield format_sse("done", {
+                "message_id": ai_msg.id,
+                "message": ai_msg.message,
+                "query_classification": event["query_classification"],
+                "time_to_first_token": event["time_to_first_token"],
+                "elapsed_time": event["elapsed_time"],
+                "cached": event["cached"],
+            })
+    except asyncio.CancelledError:
+        # The client went away, StreamingResponse cancels us and the graph run with us
+        if ai_msg.message is None:
+            logging.info(f"Client disconnected, cancelled stream for conversation {conversation_id}")
+            REQUESTS_CANCELLED.labels("stream").inc()
+        raise
+    except Exception as e:
+        logging.error(f"Error streaming user query: {str(e)}")
+        if ai_msg.message is not None:
+            # The answer was already saved, only the final event failed
+            return
+        ai_msg.message = "I apologize, but I encountered an error processing your request. Please try again."
+        ai_msg.timestamp = utc_now()
+        message_writer.submit(ai_msg)
+        yield format_sse("error", {"message_id": ai_msg.id, "message": ai_msg.message})
+
+
 # ====== Function that will take the query from the user and return the AI response ======
-async def processUserQuery(query: str, conversation_id: str, db: Session = Depends(get_db)) -> Message:
+async def processUserQuery(query: str, conversation_id: str, context: dict = None, classification: str = None) -> Message:
     # Run graph == This is the only connection to the AI that there should be
     # It just passed the query to the AI and should receive a response
+    # context is the conversation summary and recent turns from memory.load_context,
+    # classification the branch from classify_message if the query was already classified
     try:
-        response = await getAIResponse(query)
+        context = context or {}
+        start_time = time.perf_counter()
+        response = await getAIResponse(query, context.get("history"), context.get("summary"), classification)
+        CHAT_LATENCY.labels("message").observe(time.perf_counter() - start_time)
         # Just using this for now to show that AI gets a response
         # print("AI Response:", response)
         
@@ -128,11 +558,8 @@ async def processUserQuery(query: str, conversation_id: str, db: Session = Depen
             conversation_id=conversation_id,
             sender="ai",
             message=response["content"],
-            # I am not sure what this needs to be set to, but I am just getting
-            # current time, FIX IF NOT CORRECT, IT is defaulting to UTC time
-            # because I am trying to mimic the typescript Date.toISOString() method
-            timestamp= datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
-        )  # Use current time for response
+            timestamp=utc_now()  # Use current time (UTC) for response
+        )
 
         # add the message to the DB
         # add_message(conversation_id, ai_msg, db)
@@ -145,47 +572,244 @@ async def processUserQuery(query: str, conversation_id: str, db: Session = Depen
             conversation_id=conversation_id,
             sender="ai",
             message=f"I apologize, but I encountered an error processing your request. Please try again.",
-            timestamp=datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+            timestamp=utc_now()
         )
         return error_msg
 
 
 
 
-# Get conversations
+# Invalidation hook for the answer cache, ingestion calls this after it changes a collection
+@app.post("/admin/cache/invalidate", response_model=dict, dependencies=[Depends(require_admin)])
+async def invalidate_answer_cache(collection: str = COLLECTION_NAME):
+    version = answer_cache.invalidate(collection)
+    logging.info(f"Answer cache invalidated for {collection}, now at version {version}")
+    return {"detail": f"Answer cache invalidated for {collection}", "version": version}
+
+# Requests currently sharing a graph run, per query key
+@app.get("/admin/singleflight", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_singleflight_stats(top: int = 20):
+    return {"in_flight": response_flight.in_flight(), "keys": response_flight.snapshot(top)}
+
+# Group-commit writer queue depth and batching
+@app.get("/admin/message-writer", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_message_writer_stats():
+    return message_writer.snapshot()
+
+# Background job workers and the progress of the jobs they are running
+@app.get("/admin/jobs", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_job_stats():
+    return jobs.snapshot()
+
+# PDF cache hits and the downloads in flight in this worker
+@app.get("/admin/pdf-cache", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_pdf_cache_stats():
+    return pdf_cache.snapshot()
+
+# Message partitions archived by this worker and reads served from the archive
+@app.get("/admin/archive", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_archive_stats():
+    return archiver.snapshot()
+
+# How queries were classified (local or Gemini), agreement between the two and local latency
+@app.get("/admin/classifier", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_classifier_stats():
+    return query_classifier.snapshot()
+
+# Idempotency keys running in this worker and how often retries were answered from storage
+@app.get("/admin/idempotency", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_idempotency_stats():
+    return idempotency.snapshot()
+
+# Current load on the admission controller
+@app.get("/admin/admission", response_model=dict, dependencies=[Depends(require_admin)])
+async def get_admission_stats():
+    return admission.snapshot()
+
+# Get conversations, newest first. Pass the X-Next-Cursor response header back as cursor for the next page
 @app.get("/conversations", response_model=List[ConversationResponse])
-def get_user_conversations(user_id: str, db: Session = Depends(get_db)):
-    conversations = db.query(Conversation).filter(Conversation.user_id == user_id).all()
+async def get_user_conversations(
+    user_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    db: AsyncSession = Depends(get_db)
+):
+    stmt = select(Conversation).where(Conversation.user_id == user_id)
+    try:
+        stmt = keyset_page(stmt, Conversation.timestamp, Conversation.id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    result = await db.execute(stmt)
+    conversations, next_cursor = split_page(result.scalars().all(), limit)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
     return conversations
 
-# Get messages for a conversation
+def conversation_previews(user_id: str):
+    """
+    A user's conversations with their message count and latest message, in one query.
+    The window functions rank each conversation's messages through the
+    (conversation_id, timestamp, id) index, last_activity falls back to the
+    conversation's own timestamp when it has no messages yet.
+    """
+    ranked = (
+        select(
+            Message.conversation_id,
+            Message.sender,
+            func.left(Message.message, PREVIEW_CHARS).label("message"),
+            Message.timestamp,
+            func.row_number().over(
+                partition_by=Message.conversation_id,
+                order_by=(Message.timestamp.desc(), Message.id.desc())
+            ).label("position"),
+            func.count().over(partition_by=Message.conversation_id).label("message_count"),
+        )
+        .join(Conversation, Conversation.id == Message.conversation_id)
+        .where(Conversation.user_id == user_id)
+        .subquery()
+    )
+    latest = select(ranked).where(ranked.c.position == 1).subquery()
+
+    previews = (
+        select(
+            Conversation.id,
+            Conversation.user_id,
+            Conversation.title,
+            Conversation.timestamp,
+            func.coalesce(latest.c.message_count, 0).label("message_count"),
+            latest.c.message.label("last_message"),
+            latest.c.sender.label("last_sender"),
+            func.coalesce(latest.c.timestamp, Conversation.timestamp).label("last_activity"),
+        )
+        .outerjoin(latest, latest.c.conversation_id == Conversation.id)
+        .where(Conversation.user_id == user_id)
+        .subquery()
+    )
+    return select(previews), previews
+
+# Conversations with a preview of their latest message, most recently active first.
+# Pages the same way as /conversations, through the X-Next-Cursor header
+@app.get("/conversations/previews", response_model=List[ConversationPreviewResponse])
+async def get_conversation_previews(
+    user_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    db: AsyncSession = Depends(get_db)
+):
+    stmt, previews = conversation_previews(user_id)
+    try:
+        stmt = keyset_page(stmt, previews.c.last_activity, previews.c.id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    result = await db.execute(stmt)
+    rows, next_cursor = split_page(result.all(), limit, timestamp_key="last_activity")
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    await set_archived_before(db, response)
+    return [row._asdict() for row in rows]
+
+# Previews and search only read the hot table, the header tells the client from when on they are complete
+async def set_archived_before(db: AsyncSession, response: Response):
+    archived_before = await archiver.archived_before(db)
+    if archived_before is not None:
+        response.headers[ARCHIVED_BEFORE_HEADER] = archived_before.isoformat(timespec="milliseconds") + "Z"
+
+# Search a user's messages, best match first. q takes web search syntax ("exact phrase", or, -exclude),
+# snippets wrap the matched terms in <mark></mark>. Page with offset, results are ranked so there is no cursor
+@app.get("/messages/search", response_model=List[MessageSearchResult])
+async def search_messages(
+    user_id: str,
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=500),
+    conversation_id: str = None,
+    sender: str = None,
+    limit: int = Query(DEFAULT_SEARCH_LIMIT, ge=1, le=MAX_SEARCH_LIMIT),
+    offset: int = Query(0, ge=0, le=MAX_SEARCH_OFFSET),
+    db: AsyncSession = Depends(get_db)
+):
+    result = await db.execute(search_query(user_id, q, conversation_id, sender, limit, offset))
+    await set_archived_before(db, response)
+    return [row._asdict() for row in result.all()]
+
+# Stream a user's conversations as ndjson, markdown or csv. Repeat conversation_id to export
+# only those conversations, since/until limit the messages by timestamp
+@app.get("/export")
+async def export_conversations(
+    user_id: str,
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|markdown|csv)$"),
+    conversation_id: List[str] = Query(None),
+    since: datetime = None,
+    until: datetime = None
+):
+    media_type, extension = EXPORT_FORMATS[export_format]
+    filename = f"grc-conversations-{utc_now():%Y%m%d-%H%M%S}.{extension}"
+    return StreamingResponse(
+        stream_export(
+            export_format,
+            user_id,
+            conversation_id,
+            to_db_timestamp(since) if since else None,
+            to_db_timestamp(until) if until else None,
+        ),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Accel-Buffering": "no"},
+    )
+
+# Get messages for a conversation. Returns the most recent page in chronological order,
+# the X-Next-Cursor response header pages back to older messages
 @app.get("/conversations/{conversation_id}/messages", response_model=List[MessageResponse])
-def get_conversation_messages(conversation_id: str, db: Session = Depends(get_db)):
-    messages = db.query(Message).filter(Message.conversation_id == conversation_id).all()
-    return messages
+async def get_conversation_messages(
+    conversation_id: str,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: str = None,
+    db: AsyncSession = Depends(get_db)
+):
+    stmt = select(Message).where(Message.conversation_id == conversation_id)
+    try:
+        stmt = keyset_page(stmt, Message.timestamp, Message.id, limit, cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    result = await db.execute(stmt)
+    # Older messages may have been moved to the archive, a short page continues there
+    messages = await archiver.fill(
+        db, conversation_id, result.scalars().all(), limit + 1, decode_cursor(cursor) if cursor else None
+    )
+    messages, next_cursor = split_page(messages, limit)
+    if next_cursor:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return messages[::-1]
 
 # Delete conversation
 @app.delete("/conversations/{conversation_id}", response_model=dict)
-def delete_conversation(conversation_id: str, db: Session = Depends(get_db)):
-    convo = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+async def delete_conversation(conversation_id: str, db: AsyncSession = Depends(get_db)):
+    convo = await db.get(Conversation, conversation_id)
     
     if not convo:
         raise HTTPException(status_code=404, detail="Conversation not found")
     
-    db.delete(convo)
-    db.commit()
+    # Its messages go with it, in the hot table now and in the archive on the next maintenance pass
+    await db.execute(delete(Message).where(Message.conversation_id == conversation_id))
+    await archiver.forget_conversation(db, convo)
+    await db.delete(convo)
+    await db.commit()
 
     return {"detail": "Conversation deleted"}
 
 # Update conversation Name
 @app.put("/conversations/{conversation_id}", response_model=dict)
-def update_conversation_name(conversation_id: str, payload: TitleUpdate, db: Session = Depends(get_db)):
-    convo = db.query(Conversation).filter(Conversation.id == conversation_id).first()
+async def update_conversation_name(conversation_id: str, payload: TitleUpdate, db: AsyncSession = Depends(get_db)):
+    convo = await db.get(Conversation, conversation_id)
 
     if not convo:
         raise HTTPException(status_code=404, detail="Conversation not found")
     old_title = convo.title
     convo.title = payload.new_title
-    db.commit()
+    await db.commit()
 
     return {"detail": f"Old title '{old_title}' changed to {payload.new_title}"}
\ No newline at end of file
@@ -0,0 +1,121 @@
+# Conversation memory backed by Postgres. Each turn the llm gets the conversation's
+# rolling summary plus the last RECENT_TURNS user/ai pairs, so the prompt stays the
+# same size no matter how long the conversation gets. After a reply is saved the
+# messages that fell out of the recent window are folded into the summary.
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Dict
+
+from langchain_core.messages import AIMessage, HumanMessage
+from sqlalchemy import select, tuple_
+
+from archive import archiver
+from llm import RECENT_TURNS, summarize_conversation, truncate_message
+from models import Conversation, Message, SessionLocal
+
+# Most messages folded into the summary in one pass, keeps the summary prompt bounded
+# when catching up on a long conversation (the rest are folded on later turns)
+SUMMARY_BATCH_SIZE = 20
+
+# Conversations with a summary update in progress in this process
+_updating = set()
+# Keeps references to scheduled updates so they aren't garbage collected mid run
+_background_tasks = set()
+
+
+def to_langchain_message(message: Message):
+    content = truncate_message(message.message or "")
+    if message.sender == "user":
+        return HumanMessage(content=content)
+    return AIMessage(content=content)
+
+
+async def load_context(db, conversation: Conversation, exclude_message_id: str = None) -> Dict[str, Any]:
+    """
+    Get the context for the next turn of a conversation: its summary and the most
+    recent messages (oldest first), leaving out the message currently being answered.
+    """
+    stmt = select(Message).where(Message.conversation_id == conversation.id)
+    if exclude_message_id:
+        stmt = stmt.where(Message.id != exclude_message_id)
+    stmt = stmt.order_by(Message.timestamp.desc(), Message.id.desc()).limit(RECENT_TURNS * 2)
+
+    result = await db.execute(stmt)
+    # A conversation picked up again after months may have its latest turns in the archive
+    recent = (await archiver.fill(
+        db, conversation.id, result.scalars().all(), RECENT_TURNS * 2, created=conversation.timestamp
+    ))[::-1]
+
+    return {
+        "summary": conversation.summary,
+        "history": [to_langchain_message(message) for message in recent],
+    }
+
+
+async def update_summary(conversation_id: str, after: Awaitable = None):
+    """
+    Fold messages older than the recent window into the conversation summary.
+    after is awaited first, pass the message writer's future so the new turn is in the database.
+    """
+    if after is not None:
+        try:
+            await after
+        except Exception:
+            return
+    if conversation_id in _updating:
+        return
+    _updating.add(conversation_id)
+
+    try:
+        async with SessionLocal() as db:
+            conversation = await db.get(Conversation, conversation_id)
+            if not conversation:
+                return
+
+            # The oldest message still sent verbatim, everything before it belongs in the summary
+            result = await db.execute(
+                select(Message.timestamp, Message.id)
+                .where(Message.conversation_id == conversation_id)
+                .order_by(Message.timestamp.desc(), Message.id.desc())
+                .offset(RECENT_TURNS * 2 - 1)
+                .limit(1)
+            )
+            boundary = result.first()
+            if boundary is None:
+                return
+
+            stmt = select(Message).where(
+                Message.conversation_id == conversation_id,
+                tuple_(Message.timestamp, Message.id) < tuple_(boundary.timestamp, boundary.id)
+            )
+            if conversation.summary_timestamp is not None:
+                stmt = stmt.where(
+                    tuple_(Message.timestamp, Message.id)
+                    > tuple_(conversation.summary_timestamp, conversation.summary_message_id)
+                )
+            stmt = stmt.order_by(Message.timestamp, Message.id).limit(SUMMARY_BATCH_SIZE)
+
+            result = await db.execute(stmt)
+            to_fold = result.scalars().all()
+            if not to_fold:
+                return
+
+            conversation.summary = await summarize_conversation(
+                conversation.summary,
+                [("user" if m.sender == "user" else "assistant", m.message or "") for m in to_fold]
+            )
+            conversation.summary_timestamp = to_fold[-1].timestamp
+            conversation.summary_message_id = to_fold[-1].id
+            await db.commit()
+    except Exception as e:
+        logging.error(f"Error updating summary for conversation {conversation_id}: {str(e)}")
+    finally:
+        _updating.discard(conversation_id)
+
+
+def schedule_summary_update(conversation_id: str, after: Awaitable = None):
+    """Run update_summary in the background without holding up the response."""
+    task = asyncio.create_task(update_summary(conversation_id, after))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -0,0 +1,149 @@
+# Group-commit writer for chat messages. Request handlers hand their Message rows to
+# the writer instead of committing them themselves. A single background task collects
+# everything submitted within FLUSH_INTERVAL and inserts it in one transaction, so
+# under heavy chat traffic Postgres sees one commit per batch instead of two per turn.
+#
+# submit() returns a future that resolves once the row is committed, callers that
+# need the row in the database (e.g. the summary update) wait on it, the rest just
+# return. stop() flushes whatever is still queued before the app shuts down.
+
+import asyncio
+import logging
+import os
+import time
+from typing import List, Tuple
+
+from dotenv import load_dotenv
+
+from metrics import MESSAGE_WRITE_BATCH, MESSAGE_WRITE_LATENCY
+from models import Message, SessionLocal
+
+load_dotenv(dotenv_path="../../.env")
+
+FLUSH_INTERVAL = float(os.getenv("MESSAGE_WRITER_FLUSH_MS", 5)) / 1000 # seconds a batch stays open
+MAX_BATCH = int(os.getenv("MESSAGE_WRITER_MAX_BATCH", 200)) # rows per transaction
+
+
+class MessageWriter:
+    def __init__(self):
+        self.queue: asyncio.Queue = None
+        self.task: asyncio.Task = None
+        self.batches = 0
+        self.written = 0
+        self.failed = 0
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting messages and flush everything already queued."""
+        if self.task is None:
+            return
+        await self.queue.put(None)
+        await self.task
+        self.task = None
+
+    def submit(self, *messages: Message) -> asyncio.Future:
+        """Queue messages for insert, the returned future resolves once they are committed."""
+        loop = asyncio.get_running_loop()
+        if self.task is None:
+            # No writer running (scripts, tests), write straight away
+            saved = asyncio.ensure_future(self._write_direct(list(messages)))
+        else:
+            futures = []
+            for message in messages:
+                future = loop.create_future()
+                self.queue.put_nowait((message, future, time.perf_counter()))
+                futures.append(future)
+            saved = asyncio.gather(*futures)
+        # Failures are logged by the writer, callers that don't wait on the result shouldn't warn
+        saved.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return saved
+
+    async def _write_now(self, messages: List[Message]):
+        async with SessionLocal() as db:
+            db.add_all(messages)
+            await db.commit()
+
+    async def _write_direct(self, messages: List[Message]):
+        try:
+            await self._write_now(messages)
+            self.written += len(messages)
+        except Exception as e:
+            self.failed += len(messages)
+            logging.error(f"Error saving {len(messages)} messages: {str(e)}")
+            raise
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+
+            # Keep the batch open briefly so concurrent requests share the commit
+            deadline = time.perf_counter() + FLUSH_INTERVAL
+            while len(batch) < MAX_BATCH:
+                timeout = deadline - time.perf_counter()
+                try:
+                    item = self.queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self.queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._flush(batch)
+
+        # Anything submitted after stop() was called still gets written
+        remaining = []
+        while not self.queue.empty():
+            item = self.queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        for start in range(0, len(remaining), MAX_BATCH):
+            await self._flush(remaining[start:start + MAX_BATCH])
+
+    async def _flush(self, batch: List[Tuple[Message, asyncio.Future, float]]):
+        MESSAGE_WRITE_BATCH.observe(len(batch))
+        try:
+            await self._write_now([message for message, _, _ in batch])
+            self._resolve(batch)
+        except Exception as e:
+            # One bad row (e.g. its conversation was deleted) must not drop the rest,
+            # retry them one per transaction
+            logging.warning(f"Batched insert of {len(batch)} messages failed, retrying individually: {e}")
+            for item in batch:
+                message, future, _ = item
+                try:
+                    await self._write_now([message])
+                    self._resolve([item])
+                except Exception as e:
+                    self.failed += 1
+                    logging.error(f"Error saving message {message.id}: {str(e)}")
+                    if not future.done():
+                        future.set_exception(e)
+        self.batches += 1
+
+    def _resolve(self, batch: List[Tuple[Message, asyncio.Future, float]]):
+        now = time.perf_counter()
+        for _, future, submitted in batch:
+            MESSAGE_WRITE_LATENCY.observe(now - submitted)
+            if not future.done():
+                future.set_result(None)
+        self.written += len(batch)
+
+    def snapshot(self):
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "batches": self.batches,
+            "written": self.written,
+            "failed": self.failed,
+            "avg_batch_size": round(self.written / self.batches, 2) if self.batches else 0.0,
+        }
+
+
+message_writer = MessageWriter()
@@ -0,0 +1,228 @@
+# Prometheus metrics for the RAG pipeline, served by the API at /metrics.
+# Labels are kept to small fixed sets (stage, node, branch, result...) so the
+# endpoint stays cheap to scrape, never label with user ids, queries or keys.
+#
+# Under serve.py every worker is a separate process. PROMETHEUS_MULTIPROC_DIR is set
+# then and /metrics aggregates the values all workers wrote there.
+
+import asyncio
+import functools
+import os
+import time
+from contextlib import contextmanager
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+
+# Buckets from 5ms up to 2 minutes, covers local inference through longform generation
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 120)
+
+STAGE_LATENCY = Histogram(
+    "grc_stage_duration_seconds",
+    "Time spent in each pipeline stage (classify_llm, embed, qdrant_search, rerank, generate_llm, ...)",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+NODE_LATENCY = Histogram(
+    "grc_graph_node_duration_seconds",
+    "Time spent in each LangGraph node",
+    ["node"],
+    buckets=LATENCY_BUCKETS,
+)
+QUERY_BRANCH = Counter(
+    "grc_query_branch_total",
+    "Queries routed to each branch by query_classification",
+    ["branch"],
+)
+CLASSIFIER_DECISIONS = Counter(
+    "grc_classifier_decisions_total",
+    "Queries classified by the local classifier, by Gemini (local confidence too low) or defaulted after an error",
+    ["source"],
+)
+CLASSIFIER_AGREEMENT = Counter(
+    "grc_classifier_agreement_total",
+    "Queries classified by both the local classifier and Gemini, by sample (low_confidence or shadow) and result",
+    ["sample", "result"],
+)
+SPECULATIVE_RETRIEVAL = Counter(
+    "grc_speculative_retrieval_total",
+    "Retrievals started alongside classification: used by the branch, wasted (finished but the branch "
+    "didn't need them), cancelled before they started, or failed",
+    ["result"],
+)
+SPECULATION_WASTED_SECONDS = Counter(
+    "grc_speculative_retrieval_wasted_seconds_total",
+    "Time spent on speculative retrievals whose results were thrown away",
+)
+ANSWER_CACHE = Counter(
+    "grc_answer_cache_requests_total",
+    "Answer cache lookups, hit ratio is hit / (hit + miss)",
+    ["result"],
+)
+GEMINI_ERRORS = Counter(
+    "grc_gemini_errors_total",
+    "Failed Gemini calls by exception type",
+    ["error"],
+)
+GEMINI_RETRIES = Counter(
+    "grc_gemini_retries_total",
+    "Gemini calls retried by the application",
+    ["call"],
+)
+CHAT_TIME_TO_FIRST_TOKEN = Histogram(
+    "grc_chat_time_to_first_token_seconds",
+    "Time until the first answer token is sent on the streaming endpoint",
+    buckets=LATENCY_BUCKETS,
+)
+CHAT_LATENCY = Histogram(
+    "grc_chat_response_duration_seconds",
+    "Total time to answer a chat message",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+SINGLEFLIGHT = Counter(
+    "grc_singleflight_requests_total",
+    "Requests that started a run (leader) or joined an in-flight one (coalesced)",
+    ["flight", "role"],
+)
+ADMISSION_QUEUE_TIME = Histogram(
+    "grc_admission_queue_seconds",
+    "Time admitted requests waited for a slot",
+    buckets=LATENCY_BUCKETS,
+)
+ADMISSION_REJECTED = Counter(
+    "grc_admission_rejected_total",
+    "Requests rejected with a 429",
+    ["reason"],
+)
+REQUESTS_CANCELLED = Counter(
+    "grc_requests_cancelled_total",
+    "Chat requests abandoned because the client disconnected",
+    ["endpoint"],
+)
+WORK_CANCELLED = Counter(
+    "grc_cancelled_work_total",
+    "Graph nodes, subqueries and Gemini calls cancelled before they finished",
+    ["stage"],
+)
+JOBS_FINISHED = Counter(
+    "grc_jobs_finished_total",
+    "Background jobs that finished, by kind and final status",
+    ["kind", "status"],
+)
+JOB_QUEUE_TIME = Histogram(
+    "grc_job_queue_seconds",
+    "Time background jobs waited for a worker",
+    ["kind"],
+    buckets=LATENCY_BUCKETS + (300, 600, 1800),
+)
+JOB_DURATION = Histogram(
+    "grc_job_duration_seconds",
+    "Time background jobs ran for",
+    ["kind"],
+    buckets=LATENCY_BUCKETS + (300, 600, 1800),
+)
+JOBS_QUEUED = Gauge("grc_jobs_queued", "Background jobs waiting for a worker", multiprocess_mode="livesum")
+MESSAGE_WRITE_BATCH = Histogram(
+    "grc_message_write_batch_size",
+    "Messages inserted per group commit",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 200, 500),
+)
+MESSAGE_WRITE_LATENCY = Histogram(
+    "grc_message_write_duration_seconds",
+    "Time from submitting a message to the writer until it is committed",
+    buckets=LATENCY_BUCKETS,
+)
+ADMISSION_RUNNING = Gauge("grc_admission_running", "Requests currently holding a slot", multiprocess_mode="livesum")
+ADMISSION_QUEUED = Gauge("grc_admission_queued", "Requests waiting for a slot", multiprocess_mode="livesum")
+# Labelled by pid when running multiprocess, Pss splits shared (copy-on-write) pages between the workers
+WORKER_RSS = Gauge("grc_worker_rss_bytes", "Resident memory of this worker", multiprocess_mode="liveall")
+WORKER_PSS = Gauge("grc_worker_pss_bytes", "Proportional memory of this worker", multiprocess_mode="liveall")
+
+
+@contextmanager
+def observe_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(stage).observe(time.perf_counter() - start)
+
+
+def timed_node(name: str, fn):
+    """Wrap a graph node (sync or async) so its run time is recorded under its node name."""
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_node(state):
+            start = time.perf_counter()
+            try:
+                return await fn(state)
+            except asyncio.CancelledError:
+                WORK_CANCELLED.labels(name).inc()
+                raise
+            finally:
+                NODE_LATENCY.labels(name).observe(time.perf_counter() - start)
+        return async_node
+
+    @functools.wraps(fn)
+    def node(state):
+        start = time.perf_counter()
+        try:
+            return fn(state)
+        finally:
+            NODE_LATENCY.labels(name).observe(time.perf_counter() - start)
+    return node
+
+
+class GeminiMetricsHandler(BaseCallbackHandler):
+    """Counts failed and cancelled llm calls, attached to the Gemini chat model as a callback."""
+
+    def on_llm_error(self, error: BaseException, **kwargs):
+        if isinstance(error, asyncio.CancelledError):
+            WORK_CANCELLED.labels("gemini_call").inc()
+            return
+        GEMINI_ERRORS.labels(type(error).__name__).inc()
+
+
+def count_retry(call: str):
+    """tenacity before_sleep hook that counts retries of call."""
+    def before_sleep(retry_state):
+        GEMINI_RETRIES.labels(call).inc()
+    return before_sleep
+
+
+def process_memory(pid: int = None):
+    """(rss, pss) in bytes of a process from /proc, pss is None where smaps_rollup isn't available."""
+    pid = pid or os.getpid()
+    values = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    values[key] = int(rest.split()[0]) * 1024
+    except OSError:
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        values["Rss"] = int(line.split()[1]) * 1024
+        except OSError:
+            pass
+    return values.get("Rss"), values.get("Pss")
+
+
+def update_process_gauges():
+    rss, pss = process_memory()
+    if rss is not None:
+        WORKER_RSS.set(rss)
+    if pss is not None:
+        WORKER_PSS.set(pss)
+
+
+def render_metrics():
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,48 @@
+# Applies the SQL files in migrations/ in order and records them in schema_migrations.
+# create_all only creates missing tables, so changes to existing tables (new indexes,
+# columns) go through a migration file. Files should be idempotent (IF NOT EXISTS)
+# since a fresh database already gets the model's indexes from create_all.
+
+import asyncio
+import logging
+from pathlib import Path
+
+from sqlalchemy import text
+
+from models import engine, init_models
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+
+
+async def run_migrations():
+    async with engine.begin() as conn:
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version VARCHAR PRIMARY KEY, "
+            "applied_at TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc'))"
+        ))
+        result = await conn.execute(text("SELECT version FROM schema_migrations"))
+        applied = {row[0] for row in result}
+
+        # asyncpg's plain execute allows several statements in one file
+        raw_connection = await conn.get_raw_connection()
+        for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+            if path.stem in applied:
+                continue
+            logging.info(f"Applying migration {path.name}")
+            await raw_connection.driver_connection.execute(path.read_text())
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version) VALUES (:version)"),
+                {"version": path.stem}
+            )
+
+
+async def main():
+    await init_models()
+    await run_migrations()
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main())
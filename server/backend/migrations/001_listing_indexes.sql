@@ -0,0 +1,6 @@
+-- Composite indexes backing keyset pagination of conversation and message listings
+CREATE INDEX IF NOT EXISTS ix_messages_conversation_id_timestamp_id
+    ON messages (conversation_id, timestamp, id);
+
+CREATE INDEX IF NOT EXISTS ix_conversations_user_id_timestamp_id
+    ON conversations (user_id, timestamp, id);
@@ -0,0 +1,4 @@
+-- Rolling conversation summary used to bound the prompt context
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary TEXT;
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary_timestamp TIMESTAMP;
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary_message_id VARCHAR;
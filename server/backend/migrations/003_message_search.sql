@@ -0,0 +1,6 @@
+-- Full-text search over chat history. Adding the stored column rewrites the messages table once
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector TSVECTOR
+    GENERATED ALWAYS AS (to_tsvector('english', coalesce(message, ''))) STORED;
+
+CREATE INDEX IF NOT EXISTS ix_messages_search_vector
+    ON messages USING gin (search_vector);
@@ -0,0 +1,51 @@
+-- Monthly range partitions of messages on timestamp, so old months can be archived (see archive.py).
+-- Copies an existing unpartitioned table into a partitioned one, a fresh database already has
+-- the partitioned table from create_all and is left alone. The copy holds a lock on messages
+-- for its whole duration, run it in a maintenance window on large tables.
+DO $$
+DECLARE
+    month_start DATE;
+    last_month DATE;
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass) THEN
+        RETURN;
+    END IF;
+
+    CREATE TABLE messages_partitioned (
+        id VARCHAR NOT NULL,
+        conversation_id VARCHAR REFERENCES conversations (id),
+        sender VARCHAR,
+        message TEXT,
+        "timestamp" TIMESTAMP NOT NULL,
+        search_vector TSVECTOR GENERATED ALWAYS AS (to_tsvector('english', coalesce(message, ''))) STORED,
+        PRIMARY KEY (id, "timestamp")
+    ) PARTITION BY RANGE ("timestamp");
+
+    CREATE TABLE messages_default PARTITION OF messages_partitioned DEFAULT;
+
+    -- One partition per month from the oldest message up to three months ahead
+    month_start := date_trunc('month', coalesce((SELECT min("timestamp") FROM messages), now() AT TIME ZONE 'utc'));
+    last_month := date_trunc('month', now() AT TIME ZONE 'utc') + INTERVAL '3 months';
+    WHILE month_start <= last_month LOOP
+        EXECUTE format(
+            'CREATE TABLE %I PARTITION OF messages_partitioned FOR VALUES FROM (%L) TO (%L)',
+            'messages_y' || to_char(month_start, 'YYYY') || 'm' || to_char(month_start, 'MM'),
+            month_start,
+            month_start + INTERVAL '1 month'
+        );
+        month_start := month_start + INTERVAL '1 month';
+    END LOOP;
+
+    INSERT INTO messages_partitioned (id, conversation_id, sender, message, "timestamp")
+    SELECT id, conversation_id, sender, message, coalesce("timestamp", now() AT TIME ZONE 'utc') FROM messages;
+
+    DROP TABLE messages;
+    ALTER TABLE messages_partitioned RENAME TO messages;
+    ALTER TABLE messages RENAME CONSTRAINT messages_partitioned_pkey TO messages_pkey;
+    ALTER TABLE messages RENAME CONSTRAINT messages_partitioned_conversation_id_fkey TO messages_conversation_id_fkey;
+
+    CREATE INDEX ix_messages_id ON messages (id);
+    CREATE INDEX ix_messages_conversation_id_timestamp_id ON messages (conversation_id, "timestamp", id);
+    CREATE INDEX ix_messages_search_vector ON messages USING gin (search_vector);
+END
+$$;
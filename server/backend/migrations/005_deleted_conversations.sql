@@ -0,0 +1,5 @@
+-- Conversations deleted while archive files may still hold their messages, see archive.py
+CREATE TABLE IF NOT EXISTS deleted_conversations (
+    conversation_id VARCHAR PRIMARY KEY,
+    deleted_at TIMESTAMP
+);
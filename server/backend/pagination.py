@@ -0,0 +1,56 @@
+# Keyset (cursor) pagination helpers for the listing endpoints.
+# A cursor is the (timestamp, id) of the last row on a page, the next page starts
+# strictly after it so the query can seek straight to it through the composite index
+# instead of counting past OFFSET rows.
+
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+from sqlalchemy import tuple_
+from sqlalchemy.sql import Select
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+# Response header that carries the cursor for the next page, absent on the last page
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(timestamp: datetime, row_id: str) -> str:
+    raw = json.dumps({"t": timestamp.isoformat(), "id": row_id})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, str]:
+    """Decode a cursor from encode_cursor, raises ValueError if it is malformed."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(raw["t"]), raw["id"]
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+
+def keyset_page(stmt: Select, timestamp_column, id_column, limit: int, cursor: Optional[str] = None) -> Select:
+    """
+    Restrict stmt to one page ordered newest first by (timestamp, id).
+    Fetches limit + 1 rows so the caller can tell whether another page exists.
+    """
+    if cursor:
+        timestamp, row_id = decode_cursor(cursor)
+        stmt = stmt.where(tuple_(timestamp_column, id_column) < tuple_(timestamp, row_id))
+
+    return stmt.order_by(timestamp_column.desc(), id_column.desc()).limit(limit + 1)
+
+
+def split_page(rows: list, limit: int, timestamp_key: str = "timestamp") -> Tuple[list, Optional[str]]:
+    """
+    Trim the extra row fetched by keyset_page and build the cursor for the next page.
+    timestamp_key names the row attribute the page was ordered by.
+    """
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(getattr(last, timestamp_key), last.id)
@@ -0,0 +1,198 @@
+# Local copies of the source PDFs for the viewer. Answers cite filings on
+# docs.cpuc.ca.gov, and downloading a whole multi-hundred-page testimony every time a
+# citation is opened is slow. GET /documents/{document_id}/pdf serves the file from
+# PDF_CACHE_DIR (or UPLOAD_DIR for uploads) with byte-range support, so pdf.js fetches
+# just the pages it shows.
+#
+# A document that isn't cached yet is downloaded from the source_url stored with its
+# chunks in Qdrant. The download runs in its own task and carries on if the request
+# that started it gives up, the request waits up to PDF_FETCH_WAIT seconds for it and
+# otherwise tells the client to retry. Only hosts in PDF_SOURCE_HOSTS are fetched from.
+# The cache is capped at PDF_CACHE_MAX_MB, least recently opened files are removed first.
+
+import asyncio
+import logging
+import os
+import re
+import uuid
+from pathlib import Path
+from typing import Dict, Optional
+from urllib.parse import urlparse
+
+import httpx
+from dotenv import load_dotenv
+from qdrant_client.http.models import FieldCondition, Filter, MatchValue
+from starlette.concurrency import run_in_threadpool
+
+from ingestion import UPLOAD_DIR
+from registry import registry
+from retrieval import DOCUMENT_COLLECTION
+
+load_dotenv(dotenv_path="../../.env")
+
+PDF_CACHE_DIR = Path(os.getenv("PDF_CACHE_DIR", "./pdf_cache"))
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_MB", 2048)) * 2**20
+PDF_SOURCE_HOSTS = {host.strip() for host in os.getenv("PDF_SOURCE_HOSTS", "docs.cpuc.ca.gov").split(",") if host.strip()}
+PDF_FETCH_WAIT = float(os.getenv("PDF_FETCH_WAIT", 10)) # seconds a request waits for a download before getting a 202
+PDF_FETCH_TIMEOUT = 120 # seconds a download may take
+PDF_RETRY_AFTER = 5 # seconds, sent with the 202 while a download is running
+MAX_PDF_BYTES = int(os.getenv("MAX_UPLOAD_MB", 100)) * 2**20 # same limit as uploads
+
+DOCUMENT_ID = re.compile(r"^[A-Za-z0-9_-]{1,128}$")
+PDF_MAGIC = b"%PDF-"
+
+
+class PdfUnavailable(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[int] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class PdfCache:
+    def __init__(self, cache_dir: Path = PDF_CACHE_DIR, max_bytes: int = PDF_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # Downloads in flight, one per document however many viewers ask for it
+        self.fetching: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.fetched = 0
+        self.failed = 0
+
+    def cache_path(self, document_id: str) -> Path:
+        return self.cache_dir / f"{document_id}.pdf"
+
+    def local_path(self, document_id: str) -> Optional[Path]:
+        for path in (UPLOAD_DIR / f"{document_id}.pdf", self.cache_path(document_id)):
+            if path.is_file():
+                return path
+        return None
+
+    async def get(self, document_id: str) -> Path:
+        """Path of the document's PDF, downloading it first if it isn't cached. Raises PdfUnavailable."""
+        if not DOCUMENT_ID.match(document_id):
+            raise PdfUnavailable(404, "Document not found")
+
+        path = self.local_path(document_id)
+        if path is not None:
+            self.hits += 1
+            # The mtime orders eviction, a file that keeps being opened stays in the cache
+            if path.parent == self.cache_dir:
+                os.utime(path)
+            return path
+
+        self.misses += 1
+        task = self.fetching.get(document_id)
+        if task is None:
+            task = asyncio.create_task(self._fetch(document_id))
+            self.fetching[document_id] = task
+            task.add_done_callback(lambda task: self._fetched(document_id, task))
+        try:
+            # Shielded so a request that times out or disconnects leaves the download running
+            return await asyncio.wait_for(asyncio.shield(task), PDF_FETCH_WAIT)
+        except asyncio.TimeoutError:
+            raise PdfUnavailable(202, "Document is being downloaded, please retry", PDF_RETRY_AFTER)
+
+    def _fetched(self, document_id: str, task: asyncio.Task):
+        self.fetching.pop(document_id, None)
+        if task.cancelled():
+            return
+        if task.exception() is None:
+            self.fetched += 1
+        else:
+            self.failed += 1
+            logging.warning(f"Error downloading the PDF of {document_id}: {task.exception()}")
+
+    async def source_url(self, document_id: str) -> Optional[str]:
+        points, _ = await run_in_threadpool(
+            registry.qdrant_client.scroll,
+            collection_name=DOCUMENT_COLLECTION,
+            scroll_filter=Filter(must=[FieldCondition(key="document_id", match=MatchValue(value=document_id))]),
+            limit=1,
+            with_payload=["source_url"],
+            with_vectors=False,
+        )
+        return points[0].payload.get("source_url") if points else None
+
+    async def _fetch(self, document_id: str) -> Path:
+        url = await self.source_url(document_id)
+        if not url:
+            raise PdfUnavailable(404, "Document not found")
+        parsed = urlparse(url)
+        if parsed.scheme not in ("http", "https") or parsed.hostname not in PDF_SOURCE_HOSTS:
+            raise PdfUnavailable(404, "Document has no downloadable source")
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        path = self.cache_path(document_id)
+        # Written under a temporary name and renamed, so a half downloaded file is never served
+        tmp_path = self.cache_dir / f".{document_id}.{uuid.uuid4().hex}.tmp"
+        try:
+            async with httpx.AsyncClient(timeout=PDF_FETCH_TIMEOUT, follow_redirects=True) as client:
+                async with client.stream("GET", url) as response:
+                    if response.status_code != 200:
+                        raise PdfUnavailable(502, f"Source returned {response.status_code}")
+                    size = 0
+                    # The start of the body is held back until it is long enough to check the magic bytes
+                    head = b""
+                    with open(tmp_path, "wb") as f:
+                        async for chunk in response.aiter_bytes():
+                            size += len(chunk)
+                            if size > MAX_PDF_BYTES:
+                                raise PdfUnavailable(502, "Source PDF is too large")
+                            if len(head) < len(PDF_MAGIC):
+                                head += chunk
+                                if len(head) < len(PDF_MAGIC):
+                                    continue
+                                if not head.startswith(PDF_MAGIC):
+                                    raise PdfUnavailable(502, "Source did not return a PDF")
+                                chunk = head
+                            f.write(chunk)
+                    if len(head) < len(PDF_MAGIC):
+                        # Empty, or too short to be a PDF
+                        raise PdfUnavailable(502, "Source did not return a PDF")
+            os.replace(tmp_path, path)
+        except httpx.HTTPError as e:
+            raise PdfUnavailable(502, f"Could not download the document: {e}")
+        finally:
+            _remove(tmp_path)
+
+        logging.info(f"Cached the PDF of {document_id} ({size / 2**20:.1f} MB) from {url}")
+        await run_in_threadpool(self.evict, path)
+        return path
+
+    def evict(self, keep: Path = None):
+        """Remove the least recently opened PDFs until the cache fits in max_bytes, except keep."""
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".pdf") and entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if path == str(keep):
+                continue
+            _remove(path)
+            total -= size
+
+    def snapshot(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetched": self.fetched,
+            "failed": self.failed,
+            "fetching": sorted(self.fetching),
+        }
+
+
+pdf_cache = PdfCache()
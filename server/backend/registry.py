@@ -0,0 +1,105 @@
+# Holds the models and clients the RAG pipeline needs so they are loaded once, when the
+# app starts, instead of as a side effect of importing modules. The API loads and warms
+# the registry in its lifespan before serving traffic. Scripts and the console session
+# load it lazily the first time the graph is needed (see llm.get_graph).
+
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+import torch
+from dotenv import load_dotenv
+from qdrant_client import QdrantClient
+from sentence_transformers import CrossEncoder, SentenceTransformer
+
+from query_classifier import query_classifier
+
+load_dotenv(dotenv_path="../../.env")
+
+QDRANT_CONNECT = os.getenv("QDRANT_CONNECT")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+CROSS_ENCODER_MODEL = os.getenv("CROSS_ENCODER_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+WARMUP_PASSES = int(os.getenv("WARMUP_PASSES", 2))
+
+WARMUP_QUERIES = [
+    "What is PG&E's revenue requirement in the 2023 GRC?",
+    "Summarize the wildfire mitigation costs SCE requested.",
+]
+WARMUP_PASSAGE = (
+    "The Commission adopts a test year revenue requirement for the utility's general rate case, "
+    "including operations and maintenance expenses, capital additions and depreciation."
+)
+
+
+class ModelRegistry:
+    def __init__(self):
+        self.embedding_model = None
+        self.cross_encoder = None
+        self.qdrant_client = None
+        self.graph = None
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.warmed_up = False
+        self.startup_timings = {} # phase -> seconds
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        self.startup_timings[name] = elapsed
+        logging.info(f"Startup phase {name} took {elapsed:.2f}s")
+
+    def load_models(self):
+        """
+        Load the model weights only. serve.py calls this before forking the workers so
+        they share the weights copy-on-write, it runs no inference since torch's thread
+        pool must not be started before a fork.
+        """
+        if self.embedding_model is None:
+            with self.phase("embedding_model"):
+                self.embedding_model = SentenceTransformer(EMBEDDING_MODEL, device=self.device)
+        if self.cross_encoder is None:
+            with self.phase("cross_encoder"):
+                self.cross_encoder = CrossEncoder(CROSS_ENCODER_MODEL, device=self.device)
+
+    def load(self, graph_builder=None):
+        """Load everything that isn't loaded yet. Blocking, run it off the event loop."""
+        self.load_models()
+        if not query_classifier.is_fitted():
+            with self.phase("query_classifier"):
+                query_classifier.fit(self.embedding_model)
+        if self.qdrant_client is None:
+            with self.phase("qdrant"):
+                self.qdrant_client = QdrantClient(url=QDRANT_CONNECT)
+                try:
+                    collections = self.qdrant_client.get_collections()
+                    logging.info(f"Qdrant collections: {[c.name for c in collections.collections]}")
+                except Exception as e:
+                    # Keep starting, /readyz reports qdrant as down until it is reachable
+                    logging.error(f"Error connecting to Qdrant: {e}")
+        if self.graph is None and graph_builder is not None:
+            with self.phase("graph"):
+                self.graph = graph_builder()
+
+    def warmup(self):
+        """Run a few inferences so the first real query doesn't pay for lazy initialization."""
+        with self.phase("warmup"):
+            for _ in range(WARMUP_PASSES):
+                self.embedding_model.encode(WARMUP_QUERIES)
+                self.cross_encoder.predict([(query, WARMUP_PASSAGE) for query in WARMUP_QUERIES])
+        self.warmed_up = True
+
+    def models_loaded(self) -> bool:
+        return all(m is not None for m in (self.embedding_model, self.cross_encoder, self.qdrant_client, self.graph))
+
+    def check_qdrant(self) -> bool:
+        try:
+            self.qdrant_client.get_collections()
+            return True
+        except Exception as e:
+            logging.warning(f"Qdrant readiness check failed: {e}")
+            return False
+
+
+registry = ModelRegistry()
@@ -1,46 +1,33 @@
 from langchain_core.documents import Document
 from langchain_core.tools import tool
-from qdrant_client import QdrantClient
-from sentence_transformers import SentenceTransformer
 
 from advanced_retrieval import query_db, crossEncoderQuery, hydeRetrieval, hydeCrossEncoderRetrieval
+from registry import registry
+from metrics import observe_stage
 
 from qdrant_client.http.models import Filter
-
-import os
-from dotenv import load_dotenv
-
-load_dotenv(dotenv_path="../../.env")
+from starlette.concurrency import run_in_threadpool
 
 K = 8
-print(f"DOCUMENT_COLLECTION: {os.getenv('DOCUMENT_COLLECTION')}")
 
 DOCUMENT_COLLECTION = "GRC_Documents_Large"
-qdrant_client = None
-embedding_model_name = os.getenv("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
-embedding_function = SentenceTransformer(embedding_model_name)
-
-def set_collection(client: QdrantClient):
-    """Set the ChromaDB collection for retrieval."""
-    global qdrant_client
-    qdrant_client = client
 
-@tool(response_format="content_and_artifact")
-def retrieve(query: str, k: int = 8, search_filter: Filter = None):
-    """Retrieve information related to a query."""
+def retrieve_documents(query: str, k: int = 8, search_filter: Filter = None):
+    """(serialized, documents) for query, blocking: embeds, searches qdrant and reranks."""
     # Query qdrant directly
 
     print("retrieve")
+    serialized, retrieved_docs = "", []
     try: 
-        results = crossEncoderQuery(
-            query=query,
-            qdrant_client=qdrant_client,
-            collection_name=DOCUMENT_COLLECTION,
-            k=k
-        )
+        with observe_stage("retrieve"):
+            results = crossEncoderQuery(
+                query=query,
+                qdrant_client=registry.qdrant_client,
+                collection_name=DOCUMENT_COLLECTION,
+                k=k
+            )
 
         # Format results for LangChain compatibility
-        retrieved_docs = []
         for result in results:
             doc_id = result.payload['document_id']
             content = result.payload['text']
@@ -57,4 +44,12 @@ def retrieve(query: str, k: int = 8, search_filter: Filter = None):
     except Exception as e:
         print (e)
 
-    return serialized, retrieved_docs
\ No newline at end of file
+    return serialized, retrieved_docs
+
+
+@tool(response_format="content_and_artifact")
+async def retrieve(query: str, k: int = 8, search_filter: Filter = None):
+    """Retrieve information related to a query."""
+    # The embedding and cross-encoder models and the qdrant client are blocking, they run
+    # on a worker thread so the event loop keeps serving the other requests
+    return await run_in_threadpool(retrieve_documents, query, k, search_filter)
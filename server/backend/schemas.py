@@ -21,6 +21,17 @@ class ConversationResponse(BaseModel):
     title: str
     timestamp: datetime
 
+# conversation with a preview of its latest message, for the sidebar
+class ConversationPreviewResponse(BaseModel):
+    id: str
+    user_id: str
+    title: str
+    timestamp: datetime
+    message_count: int
+    last_message: Optional[str] = None
+    last_sender: Optional[str] = None
+    last_activity: datetime
+
 # retrieve a message
 class MessageResponse(BaseModel):
     id: str
@@ -29,6 +40,31 @@ class MessageResponse(BaseModel):
     message: str
     timestamp: datetime
 
+# full-text search hit, see search.py
+class MessageSearchResult(BaseModel):
+    message_id: str
+    conversation_id: str
+    conversation_title: Optional[str] = None
+    sender: str
+    timestamp: datetime
+    rank: float
+    snippet: str # matched terms wrapped in <mark></mark>, the text is not HTML escaped
+
+# background job status, the result is fetched separately once completed
+class JobResponse(BaseModel):
+    id: str
+    kind: str
+    conversation_id: Optional[str] = None
+    status: str
+    stage: Optional[str] = None
+    progress_done: int = 0
+    progress_total: int = 0
+    error: Optional[str] = None
+    message_id: Optional[str] = None
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
 # Updating Title Model
 class TitleUpdate(BaseModel):
     new_title: str
@@ -0,0 +1,65 @@
+# Full-text search over a user's chat history. Messages carry a generated tsvector
+# column with a GIN index (see models.Message), so matching is an index lookup rather
+# than a scan of every message. The matches are ranked and only the page that is
+# returned gets snippets: ts_headline re-parses the whole message text, so running it
+# for every match would cost more than the search itself.
+
+from typing import Optional
+
+from sqlalchemy import func, select
+
+from models import Conversation, Message, SEARCH_CONFIG
+
+DEFAULT_SEARCH_LIMIT = 20
+MAX_SEARCH_LIMIT = 100
+MAX_SEARCH_OFFSET = 500 # deeper pages mean ranking more of the matches, refine the query instead
+
+# Matched terms in a snippet are wrapped in these, the rest of the snippet is the message's plain text
+SNIPPET_START = "<mark>"
+SNIPPET_STOP = "</mark>"
+SNIPPET_OPTIONS = f"StartSel={SNIPPET_START}, StopSel={SNIPPET_STOP}, MaxWords=35, MinWords=15, MaxFragments=2, FragmentDelimiter=\" … \""
+
+
+def search_query(user_id: str, query: str, conversation_id: Optional[str] = None,
+                 sender: Optional[str] = None, limit: int = DEFAULT_SEARCH_LIMIT, offset: int = 0):
+    """
+    Messages of user_id matching query (web search syntax: quoted phrases, OR, -term),
+    best match first. Returns message_id, conversation_id, conversation_title, sender,
+    timestamp, rank and snippet.
+    """
+    tsquery = func.websearch_to_tsquery(SEARCH_CONFIG, query)
+    rank = func.ts_rank_cd(Message.search_vector, tsquery)
+
+    matches = (
+        select(
+            Message.id.label("message_id"),
+            Message.conversation_id,
+            Conversation.title.label("conversation_title"),
+            Message.sender,
+            Message.timestamp,
+            rank.label("rank"),
+        )
+        .join(Conversation, Conversation.id == Message.conversation_id)
+        .where(Conversation.user_id == user_id, Message.search_vector.op("@@")(tsquery))
+    )
+    if conversation_id:
+        matches = matches.where(Message.conversation_id == conversation_id)
+    if sender:
+        matches = matches.where(Message.sender == sender)
+    page = (
+        matches.order_by(rank.desc(), Message.timestamp.desc(), Message.id)
+        .limit(limit)
+        .offset(offset)
+        .subquery()
+    )
+
+    # Snippets for the page only, the message text is read back by primary key (id and
+    # timestamp, so only the partition holding each row is searched)
+    return (
+        select(
+            page,
+            func.ts_headline(SEARCH_CONFIG, Message.message, tsquery, SNIPPET_OPTIONS).label("snippet"),
+        )
+        .join(Message, (Message.id == page.c.message_id) & (Message.timestamp == page.c.timestamp))
+        .order_by(page.c.rank.desc(), page.c.timestamp.desc(), page.c.message_id)
+    )
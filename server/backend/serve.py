@@ -0,0 +1,198 @@
+# Production entry point. Loads the embedding and cross-encoder weights and imports the
+# heavy libraries once, then forks WEB_WORKERS uvicorn workers that all accept on the
+# same socket. The workers share the preloaded weights copy-on-write, so adding workers
+# costs their own heap rather than another copy of every model.
+#
+# Each worker still runs the app's lifespan (database pool, Qdrant client, graph, warmup)
+# since connections and torch's thread pool must not be created before a fork. The
+# parent restarts workers that exit and logs the memory of each worker every
+# MEMORY_REPORT_INTERVAL seconds (Pss splits the shared pages between the workers).
+#
+# Everything else a worker keeps in memory is its own, so server wide settings are split:
+# - SERVE_WORKERS is set to WEB_WORKERS for the workers. The admission limits
+#   (ADMISSION_GLOBAL_RATE, _GLOBAL_BURST, _MAX_CONCURRENT, _MAX_QUEUE) and the database
+#   pool (DB_POOL_SIZE, DB_MAX_OVERFLOW) are totals for the server, each worker takes its
+#   share (admission.py, models.py). The per user buckets stay per worker.
+# - The answer cache must be shared, a memory cache would only be invalidated in the worker
+#   that ran the ingestion and the others would serve stale answers until the TTL. With
+#   more than one worker ANSWER_CACHE_BACKEND=memory is switched to disk, the SQLite file
+#   at ANSWER_CACHE_PATH holds the entries and the collection versions for all of them.
+#
+#   python serve.py
+#
+# For development keep using `uvicorn main:app --reload`.
+
+import gc
+import logging
+import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv(dotenv_path="../../.env")
+
+CPU_COUNT = os.cpu_count() or 1
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", 8000))
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", CPU_COUNT))
+# torch threads per worker, by default the cores are split between the workers
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", max(1, CPU_COUNT // WEB_WORKERS)))
+MEMORY_REPORT_INTERVAL = int(os.getenv("MEMORY_REPORT_INTERVAL", 60)) # seconds
+ANSWER_CACHE_BACKEND = os.getenv("ANSWER_CACHE_BACKEND", "memory")
+GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", 30)) # seconds workers get to finish on shutdown
+RESTART_DELAY = 1.0 # seconds before replacing a worker that exited
+
+# Read by the workers when they import admission and models, neither is imported here before the fork
+os.environ["SERVE_WORKERS"] = str(WEB_WORKERS)
+if WEB_WORKERS > 1 and ANSWER_CACHE_BACKEND == "memory":
+    os.environ["ANSWER_CACHE_BACKEND"] = "disk"
+
+# Workers write their metrics here so /metrics can add them up, must be set before prometheus_client is imported
+if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = tempfile.mkdtemp(prefix="grc-metrics-")
+else:
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"])
+
+import torch
+import uvicorn
+from prometheus_client import multiprocess
+
+# Imported for their memory, the workers get these modules already loaded. main itself
+# (and llm) is imported in each worker since it creates the Gemini client and the engine.
+import langchain_core  # noqa: F401
+import langchain_google_genai  # noqa: F401
+import langgraph.graph  # noqa: F401
+import qdrant_client  # noqa: F401
+import sentence_transformers  # noqa: F401
+
+from metrics import process_memory
+from registry import registry
+
+# Nothing in this file calls into the preloaded modules, naming them here keeps linters
+# that ignore noqa (plain pyflakes) from reporting them as unused
+PRELOADED_MODULES = (langchain_core, langchain_google_genai, langgraph, qdrant_client, sentence_transformers)
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(sock: socket.socket):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    torch.set_num_threads(TORCH_THREADS)
+    config = uvicorn.Config(
+        "main:app",
+        log_level=os.getenv("LOG_LEVEL", "info").lower(),
+        timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+    )
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def spawn_worker(sock: socket.socket) -> int:
+    pid = os.fork()
+    if pid == 0:
+        code = 0
+        try:
+            run_worker(sock)
+        except BaseException:
+            logging.exception("Worker crashed")
+            code = 1
+        finally:
+            os._exit(code)
+    return pid
+
+
+def report_memory(workers):
+    lines = []
+    for pid in sorted(workers):
+        rss, pss = process_memory(pid)
+        if rss is None:
+            continue
+        pss_text = f", pss {pss / 2**20:.0f} MiB" if pss is not None else ""
+        lines.append(f"worker {pid}: rss {rss / 2**20:.0f} MiB{pss_text}")
+    if lines:
+        logging.info("Memory: " + "; ".join(lines))
+
+
+def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
+    logging.info(f"Starting {WEB_WORKERS} workers on {HOST}:{PORT} with {TORCH_THREADS} torch threads each")
+    if os.environ["ANSWER_CACHE_BACKEND"] != ANSWER_CACHE_BACKEND:
+        logging.warning("The memory answer cache isn't shared between workers, using the disk cache instead")
+
+    if registry.device.type == "cuda":
+        # CUDA state can't cross a fork, each worker loads its own copy onto the GPU
+        logging.warning("Models run on the GPU, skipping the preload so each worker loads its own")
+    else:
+        registry.load_models()
+    # Keep the preloaded objects out of the collector's generations so gc passes in the
+    # workers don't write to (and so copy) the pages they live on
+    gc.collect()
+    gc.freeze()
+
+    sock = bind_socket(HOST, PORT)
+    workers = set()
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    for _ in range(WEB_WORKERS):
+        workers.add(spawn_worker(sock))
+
+    last_report = time.monotonic()
+    deadline = None
+    while workers:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            workers.discard(pid)
+            multiprocess.mark_process_dead(pid)
+            if not stopping:
+                logging.warning(f"Worker {pid} exited with status {status}, starting a replacement")
+                time.sleep(RESTART_DELAY)
+                workers.add(spawn_worker(sock))
+            continue
+
+        if stopping:
+            deadline = deadline or time.monotonic() + GRACEFUL_TIMEOUT + 5
+            if time.monotonic() > deadline:
+                for pid in workers:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+        elif time.monotonic() - last_report >= MEMORY_REPORT_INTERVAL:
+            report_memory(workers)
+            last_report = time.monotonic()
+        time.sleep(0.5)
+
+    sock.close()
+    logging.info("All workers stopped")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,91 @@
+# Single-flight request coalescing. Concurrent calls with the same key share one
+# execution of the underlying coroutine and all of them receive its result (or error).
+#
+# The shared execution runs in its own task, so a caller that is cancelled (e.g. the
+# client went away) only stops waiting, the run carries on for the remaining callers.
+# Once the last caller is gone the run is cancelled since nobody wants the result.
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict
+
+from metrics import SINGLEFLIGHT
+
+# Number of keys stats are kept for, the least recently seen keys are dropped first
+MAX_TRACKED_KEYS = 500
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str):
+        self.name = name
+        self.calls: Dict[str, _Call] = {}
+        self.stats = OrderedDict()
+
+    def _key_stats(self, key: str, label: str) -> Dict[str, Any]:
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = {"label": label, "executions": 0, "coalesced": 0, "cancelled": 0, "last_seen": 0.0}
+            self.stats[key] = stats
+            while len(self.stats) > MAX_TRACKED_KEYS:
+                self.stats.popitem(last=False)
+        self.stats.move_to_end(key)
+        stats["last_seen"] = time.time()
+        return stats
+
+    def _forget(self, key: str, call: _Call):
+        if self.calls.get(key) is call:
+            del self.calls[key]
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]], label: str = "") -> Any:
+        """
+        Run fn() unless a call with the same key is already in flight, in which case
+        wait for that one instead. label is a readable description kept with the stats.
+        """
+        stats = self._key_stats(key, label)
+        call = self.calls.get(key)
+
+        if call is None:
+            call = _Call(asyncio.create_task(fn()))
+            self.calls[key] = call
+            call.task.add_done_callback(lambda task, call=call: self._on_done(key, call))
+            stats["executions"] += 1
+            SINGLEFLIGHT.labels(self.name, "leader").inc()
+        else:
+            stats["coalesced"] += 1
+            SINGLEFLIGHT.labels(self.name, "coalesced").inc()
+            logging.info(f"[{self.name}] coalesced request onto in-flight run ({call.waiters} already waiting)")
+
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            stats["cancelled"] += 1
+            if call.waiters == 1 and not call.task.done():
+                # Last one waiting, new callers get a fresh run instead of this cancelled one
+                self._forget(key, call)
+                call.task.cancel()
+            raise
+        finally:
+            call.waiters -= 1
+
+    def _on_done(self, key: str, call: _Call):
+        self._forget(key, call)
+        # Mark the exception as retrieved when nobody was left waiting for it
+        if not call.task.cancelled():
+            call.task.exception()
+
+    def in_flight(self) -> int:
+        return len(self.calls)
+
+    def snapshot(self, top: int = 20):
+        """Stats for the most coalesced keys."""
+        ranked = sorted(self.stats.items(), key=lambda item: item[1]["coalesced"], reverse=True)
+        return [{"key": key, **stats} for key, stats in ranked[:top]]
@@ -0,0 +1,61 @@
+# Shared fixtures. The backend uses flat imports and is run from server/backend, the tests
+# import its modules the same way. Gemini, the models and Qdrant are replaced by stubs that
+# only sleep, so graph runs need no services and their timing is predictable.
+#
+#   cd server/backend && python -m pytest tests
+
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage
+
+import llm
+import retrieval
+from query_classifier import query_classifier
+
+LLM_DELAY = 0.2 # seconds every stubbed Gemini call takes
+RETRIEVAL_DELAY = 0.2 # seconds every stubbed retrieval takes, on a worker thread like the real one
+RETRIEVED_CONTENT = "Source: {'document_id': 'doc-1'}\nContent: PG&E requested $13.5 billion for 2023."
+
+
+class StubLLM:
+    """Answers every prompt after LLM_DELAY, classification prompts with GRC_SPECIFIC."""
+
+    def __init__(self, delay: float = LLM_DELAY):
+        self.delay = delay
+        self.calls = 0
+        self.prompts = []
+
+    async def ainvoke(self, messages, config=None):
+        self.calls += 1
+        self.prompts.append(messages)
+        await asyncio.sleep(self.delay)
+        if "classifier" in str(messages[0].content):
+            return AIMessage(content="GRC_SPECIFIC")
+        return AIMessage(content="Stub answer.")
+
+
+def stub_retrieve_documents(query, k=8, search_filter=None):
+    # Blocking on purpose, the real one holds a worker thread for the models and Qdrant
+    time.sleep(RETRIEVAL_DELAY)
+    return RETRIEVED_CONTENT, [Document(page_content="PG&E requested $13.5 billion for 2023.", metadata={"document_id": "doc-1"})]
+
+
+@pytest.fixture
+def stub_services(monkeypatch):
+    """Stubs Gemini, retrieval and the local classifier, which is never confident so Gemini classifies."""
+    stub_llm = StubLLM()
+    monkeypatch.setattr(llm, "llm", stub_llm)
+    monkeypatch.setattr(retrieval, "retrieve_documents", stub_retrieve_documents)
+    monkeypatch.setattr(query_classifier, "classify", lambda query: ("GRC_SPECIFIC", 0.0))
+    monkeypatch.setattr(llm, "CLASSIFIER_SHADOW_RATE", 0.0)
+    return stub_llm
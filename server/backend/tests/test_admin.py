@@ -0,0 +1,30 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+
+# No lifespan, the admin check runs before any endpoint touches the services
+client = TestClient(main.app)
+
+
+@pytest.mark.parametrize("headers", [{}, {"X-Admin-Token": ""}, {"X-Admin-Token": "anything"}])
+def test_unset_admin_token_denies_access(monkeypatch, headers):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", None)
+
+    assert client.get("/admin/singleflight", headers=headers).status_code == 403
+    assert client.post("/admin/cache/invalidate", headers=headers).status_code == 403
+
+
+def test_wrong_admin_token_is_refused(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+
+    assert client.get("/admin/singleflight").status_code == 403
+    assert client.get("/admin/singleflight", headers={"X-Admin-Token": "secreT"}).status_code == 403
+
+
+def test_admin_token_grants_access(monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+
+    response = client.get("/admin/singleflight", headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert "in_flight" in response.json()
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected, PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, PRIORITY_STREAM
+
+
+def controller(**kwargs) -> AdmissionController:
+    # Buckets that barely refill, so every token taken or refunded shows
+    settings = dict(global_rate=0.001, global_burst=10, user_rate=0.001, user_burst=3, max_concurrent=1, max_queue=1)
+    settings.update(kwargs)
+    return AdmissionController(**settings)
+
+
+def tokens(admission: AdmissionController, user_id: str):
+    return int(admission.user_buckets[user_id].tokens), int(admission.global_bucket.tokens)
+
+
+def test_queue_full_refunds_the_tokens():
+    async def run():
+        admission = controller()
+        running = await admission.acquire("busy")
+        queued = asyncio.create_task(admission.acquire("busy"))
+        await asyncio.sleep(0)
+        before = tokens(admission, "busy")
+
+        # More rejected retries than the user has tokens, none of them ends up as user_rate
+        for _ in range(5):
+            with pytest.raises(AdmissionRejected) as rejected:
+                await admission.acquire("busy")
+            assert rejected.value.reason == "queue_full"
+        assert tokens(admission, "busy") == before
+
+        running.release()
+        (await queued).release()
+
+    asyncio.run(run())
+
+
+def test_queue_timeout_refunds_the_tokens():
+    async def run():
+        admission = controller(max_queue_wait=0.05)
+        running = await admission.acquire("user")
+        before = tokens(admission, "user")
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            await admission.acquire("user")
+        assert rejected.value.reason == "queue_timeout"
+        assert tokens(admission, "user") == before
+        running.release()
+
+    asyncio.run(run())
+
+
+def test_plain_answers_get_a_slot_before_streams():
+    async def run():
+        admission = controller(max_queue=2)
+        running = await admission.acquire("a")
+        order = []
+
+        async def wait(user_id, priority):
+            ticket = await admission.acquire(user_id, priority)
+            order.append(user_id)
+            ticket.release()
+
+        stream = asyncio.create_task(wait("stream", PRIORITY_STREAM))
+        await asyncio.sleep(0)
+        plain = asyncio.create_task(wait("plain", PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0)
+        running.release()
+        await asyncio.gather(stream, plain)
+        assert order == ["plain", "stream"]
+
+    asyncio.run(run())
+
+
+def test_background_work_is_shed_while_requests_queue():
+    async def run():
+        admission = controller()
+        admission.charge("jobs", PRIORITY_BACKGROUND)
+        running = await admission.acquire("a")
+        queued = asyncio.create_task(admission.acquire("b"))
+        await asyncio.sleep(0)
+
+        with pytest.raises(AdmissionRejected) as rejected:
+            admission.charge("jobs", PRIORITY_BACKGROUND)
+        assert rejected.value.reason == "background_shed"
+
+        running.release()
+        (await queued).release()
+        admission.charge("jobs", PRIORITY_BACKGROUND)
+
+    asyncio.run(run())
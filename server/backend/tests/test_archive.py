@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+import archive
+from archive import ARCHIVE_SCHEMA, archiver, rewrite_archive_file
+from models import MessageArchive
+
+DELETED = "conversation-deleted"
+KEPT = "conversation-kept"
+MONTH = datetime(2025, 1, 1)
+
+
+def write_archive(path):
+    # Sorted by conversation, timestamp and id like archive_partition writes them
+    rows = [
+        {"id": f"{conversation}-{index}", "conversation_id": conversation, "sender": "user",
+         "message": f"message {index}", "timestamp": datetime(2025, 1, 1 + index)}
+        for conversation in sorted([DELETED, KEPT]) for index in range(3)
+    ]
+    pq.write_table(pa.Table.from_pylist(rows, schema=ARCHIVE_SCHEMA), path, row_group_size=2)
+
+
+def stub_archives(monkeypatch, path):
+    record = MessageArchive(name="messages_y2025m01", range_start=MONTH, range_end=datetime(2025, 2, 1), path=str(path), row_count=6)
+
+    async def archives_for(db, conversation_id):
+        return [record]
+
+    async def archive_paths(since=None, until=None):
+        return [str(path)]
+
+    monkeypatch.setattr(archiver, "archives_for", archives_for)
+    monkeypatch.setattr(archiver, "archive_paths", archive_paths)
+
+
+async def exported(conversation_ids):
+    return [row async for row in archiver.export_rows(conversation_ids)]
+
+
+def test_deleted_conversation_is_rewritten_out_of_the_archive(tmp_path, monkeypatch):
+    path = tmp_path / "messages_y2025m01.parquet"
+    write_archive(path)
+    stub_archives(monkeypatch, path)
+    assert len(asyncio.run(archiver.fill(None, DELETED, [], 10))) == 3
+
+    assert rewrite_archive_file(str(path), [DELETED]) == 3
+
+    assert asyncio.run(archiver.fill(None, DELETED, [], 10)) == []
+    assert asyncio.run(exported([DELETED])) == []
+    kept = asyncio.run(exported([DELETED, KEPT]))
+    assert [row["id"] for row in kept] == [f"{KEPT}-{index}" for index in range(3)]
+    assert [message.id for message in asyncio.run(archiver.fill(None, KEPT, [], 10))] == [f"{KEPT}-{index}" for index in (2, 1, 0)]
+
+
+def test_file_without_the_conversation_is_left_alone(tmp_path, monkeypatch):
+    path = tmp_path / "messages_y2025m01.parquet"
+    write_archive(path)
+    modified = path.stat().st_mtime_ns
+
+    assert rewrite_archive_file(str(path), ["conversation-elsewhere"]) is None
+    assert path.stat().st_mtime_ns == modified
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_old_conversation_is_recorded_for_the_purge(monkeypatch):
+    added = []
+
+    class Session:
+        async def merge(self, instance):
+            added.append(instance)
+
+    class Conversation:
+        def __init__(self, id, timestamp):
+            self.id = id
+            self.timestamp = timestamp
+
+    monkeypatch.setattr(archive, "archive_cutoff", lambda: datetime(2025, 6, 1))
+    asyncio.run(archiver.forget_conversation(Session(), Conversation(DELETED, MONTH)))
+    asyncio.run(archiver.forget_conversation(Session(), Conversation("conversation-new", datetime(2025, 7, 1))))
+
+    assert [record.conversation_id for record in added] == [DELETED]
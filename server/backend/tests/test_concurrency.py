@@ -0,0 +1,49 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.messages import HumanMessage
+
+import llm
+
+RUNS = 10
+TICK = 0.01 # seconds between the event loop probes
+
+
+async def probe_loop(ticks: list, done: asyncio.Event):
+    """Largest delay of a TICK sleep while the graph runs, a blocking node shows up here."""
+    while not done.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(TICK)
+        ticks.append(time.perf_counter() - start - TICK)
+
+
+@pytest.mark.parametrize("speculative_mode", ["off", "uncertain"])
+def test_graph_runs_progress_in_parallel(stub_services, monkeypatch, speculative_mode):
+    monkeypatch.setattr(llm, "SPECULATIVE_MODE", speculative_mode)
+    graph = llm.build_graph()
+
+    async def run_one(index: int):
+        start = time.perf_counter()
+        result = await graph.ainvoke({"messages": [HumanMessage(content=f"What did PG&E request in filing {index}?")]})
+        return result, time.perf_counter() - start
+
+    async def run_all():
+        ticks = []
+        done = asyncio.Event()
+        prober = asyncio.create_task(probe_loop(ticks, done))
+        start = time.perf_counter()
+        runs = await asyncio.gather(*(run_one(index) for index in range(RUNS)))
+        elapsed = time.perf_counter() - start
+        done.set()
+        await prober
+        return runs, elapsed, ticks
+
+    runs, elapsed, ticks = asyncio.run(run_all())
+
+    assert all(result["messages"][-1].content == "Stub answer." for result, _ in runs)
+    # Each run waits on the stubbed Gemini and retrieval for a few hundred ms, run one after
+    # another they would take the sum of their times
+    serial = sum(seconds for _, seconds in runs)
+    assert elapsed < serial / 4
+    assert max(ticks) < 0.1
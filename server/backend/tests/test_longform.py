@@ -0,0 +1,34 @@
+import asyncio
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+import llm
+
+
+def test_classified_message_skips_the_classifier(stub_services):
+    graph_input = llm.build_graph_input("What did PG&E request?", classification="GRC_SPECIFIC")
+
+    result = asyncio.run(llm.build_graph().ainvoke(graph_input))
+
+    assert result["query_classification"] == "GRC_SPECIFIC"
+    assert result["messages"][-1].content == "Stub answer."
+    # Only the generate node asked Gemini
+    assert stub_services.calls == 1
+
+
+def test_longform_decomposition_sees_the_conversation(stub_services):
+    history = [HumanMessage(content="What did PG&E request in A.21-06-021?"), AIMessage(content="About $15 billion.")]
+
+    asyncio.run(llm.run_longform("Write a full analysis of that request", history=history, summary="Rate case questions."))
+
+    decomposition = stub_services.prompts[0][0].content
+    assert "User: What did PG&E request in A.21-06-021?" in decomposition
+    assert "Assistant: About $15 billion." in decomposition
+    assert "Summary: Rate case questions." in decomposition
+    assert decomposition.rstrip().endswith("User Query: Write a full analysis of that request")
+
+
+def test_longform_without_context_keeps_the_prompt(stub_services):
+    asyncio.run(llm.run_longform("Write a full analysis of PG&E's 2023 GRC"))
+
+    assert stub_services.prompts[0][0].content == llm.SUBQUERY_PROMPT + "\nUser Query: Write a full analysis of PG&E's 2023 GRC\n"
@@ -0,0 +1,47 @@
+import asyncio
+
+from langchain_core.messages import HumanMessage
+from prometheus_client import REGISTRY
+
+import llm
+from conftest import RETRIEVED_CONTENT
+
+
+def speculation_count(result: str) -> float:
+    return REGISTRY.get_sample_value("grc_speculative_retrieval_total", {"result": result}) or 0.0
+
+
+def test_uncertain_query_uses_speculative_retrieval(stub_services, monkeypatch):
+    monkeypatch.setattr(llm, "SPECULATIVE_MODE", "uncertain")
+    used = speculation_count("used")
+
+    result = asyncio.run(llm.build_graph().ainvoke({"messages": [HumanMessage(content="What did PG&E request?")]}))
+
+    assert result["query_classification"] == "GRC_SPECIFIC"
+    tool_messages = [message for message in result["messages"] if message.type == "tool"]
+    assert [message.content for message in tool_messages] == [RETRIEVED_CONTENT]
+    assert result["messages"][-1].content == "Stub answer."
+    assert speculation_count("used") == used + 1
+
+
+def test_speculation_for_another_branch_is_counted_as_wasted(stub_services):
+    async def run():
+        speculation = llm.SpeculativeRetrieval("What is a GRC?")
+        speculation.start()
+        assert not speculation.keep_for("GRC_GENERAL")
+        await asyncio.gather(*llm.background_tasks)
+
+    wasted = speculation_count("wasted")
+    asyncio.run(run())
+    assert speculation_count("wasted") == wasted + 1
+
+
+def test_speculation_for_another_query_is_not_used(stub_services):
+    async def run():
+        speculation = llm.SpeculativeRetrieval("What did PG&E request?")
+        speculation.start()
+        assert speculation.keep_for("GRC_SPECIFIC")
+        assert await speculation.result("Something else", speculation.k) is None
+        await asyncio.gather(*llm.background_tasks)
+
+    asyncio.run(run())
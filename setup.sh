@@ -37,11 +37,8 @@ pip install --upgrade pip
 pip install -r requirements.txt
 
 echo "Initializing database tables..."
-python << END
-from models import Base, engine
-Base.metadata.create_all(bind=engine)
-print("Database tables created.")
-END
+python migrate.py
+echo "Database tables created."
 
 deactivate
 cd ../../